@@ -0,0 +1,397 @@
+"""
+Read-only HTTP API over the cleaned database, so that other teams can query the map without
+copying TampaFlorida.db. Every answer is JSON:
+
+    GET /node/<id>, /way/<id>, /relation/<id>    an element with its tags (and nodes/members)
+    GET /tags?key=amenity&value=cafe&limit=100   elements with a tag (value is optional)
+    GET /bbox?bbox=27.9,-82.5,28.0,-82.4         nodes in a box (south,west,north,east)
+    GET /address?q=1100 N Tampa St, Tampa        address lookup (see geocode.parse_address)
+    GET /query/query05                           the reports of query_db.py
+    GET /metrics                                 latency of every route and cache statistics
+
+Requests are served by a thread each (ThreadingMixIn) and share a pool of read-only
+connections (query_runner.SQLitePool), which also bounds the number of queries running at the
+same time. The server never writes to the database: the reports that read myview need
+make_a_view.py to have been run on it. Answers are kept in a cache of at most CACHE_SIZE
+entries for CACHE_TTL seconds, the least recently used ones being evicted first; the database
+does not change while it is served, so only memory limits the cache.
+
+    python api_server.py [--db TampaFlorida.db] [--port 8000]
+
+load_test.py measures the latency and throughput of a running server.
+"""
+import argparse
+import json
+import math
+import re
+import sqlite3
+import threading
+import time
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from collections import OrderedDict, deque
+from SocketServer import ThreadingMixIn
+
+import create_db
+import make_a_view
+import quadtiles
+from geocode import parse_address
+from query_db import QUERIES
+from query_runner import SQLitePool
+
+database = "TampaFlorida.db"
+PORT = 8000
+WORKERS = 4  # connections of the pool
+CACHE_SIZE = 10000  # answers
+CACHE_TTL = 300  # seconds
+MAX_LIMIT = 1000  # rows of /tags and /bbox
+LATENCIES = 10000  # latencies kept per route for the percentiles
+BBOX_TILES = 16  # tiles at most that cover a box
+
+# (name, table, query) of the rows of an element. {0} is the order of the rows of the table
+# (see create_db.row_order).
+ELEMENTS = {
+    'node': [('tags', 'nodes_tags',
+              'SELECT key, value, type FROM nodes_tags WHERE id = ? ORDER BY {0};')],
+    'way': [('tags', 'ways_tags', 'SELECT key, value, type FROM ways_tags WHERE id = ? '
+                                  'ORDER BY {0};'),
+            ('nodes', 'ways_nodes', 'SELECT node_id FROM ways_nodes WHERE id = ? '
+                                    'ORDER BY position;')],
+    'relation': [('tags', 'relations_tags', 'SELECT key, value, type FROM relations_tags '
+                                            'WHERE id = ? ORDER BY {0};'),
+                 ('members', 'relations_members', 'SELECT member_type, member_id, role FROM '
+                                                  'relations_members WHERE id = ? '
+                                                  'ORDER BY position;')],
+}
+
+TAG_SEARCH = """SELECT 'node', id, value FROM nodes_tags WHERE key = :key {0}
+UNION ALL SELECT 'way', id, value FROM ways_tags WHERE key = :key {0} LIMIT :limit;"""
+
+BBOX_NODES = """SELECT id, lat, lon FROM nodes
+WHERE lat BETWEEN :s AND :n AND lon BETWEEN :w AND :e LIMIT :limit;"""
+# The same with the table tiles: only the nodes of the tiles that cover the box are read
+# (one range of tiles per subquery: SQLite does not search the ranges of an OR)
+BBOX_TILE_NODES = """SELECT n.id, n.lat, n.lon FROM ({0}) t JOIN nodes n ON n.id = t.id
+WHERE n.lat BETWEEN :s AND :n AND n.lon BETWEEN :w AND :e LIMIT :limit;"""
+
+# The best match first: same street and number, then the same postcode and city
+ADDRESS_LOOKUP = """SELECT id, element, lat, lon, housenumber, street, suite, postcode, city
+FROM addresses WHERE u_street = :u_street AND housenumber IS :housenumber
+ORDER BY (postcode IS :postcode) * 2 + (city IS :city) DESC LIMIT :limit;"""
+ADDRESS_FIELDS = ['id', 'element', 'lat', 'lon', 'housenumber', 'street', 'suite', 'postcode',
+                  'city']
+
+
+class NotFound(Exception):
+    pass
+
+
+class TTLCache(object):
+    """Dictionary of at most size entries, each valid for ttl seconds. The least recently used
+    entry is evicted when it is full."""
+
+    def __init__(self, size=CACHE_SIZE, ttl=CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                self.misses += 1
+                return None
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + self.ttl, value)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions}
+
+
+def percentile(values, p):
+    """p-th percentile (0-100) of a sorted list, nearest rank"""
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+class Metrics(object):
+    """Number of requests, errors and the latest LATENCIES latencies of every route"""
+
+    def __init__(self):
+        self.routes = {}
+        self.lock = threading.Lock()
+        self.start = time.time()
+
+    def record(self, route, seconds, status):
+        with self.lock:
+            r = self.routes.get(route)
+            if r is None:
+                r = self.routes[route] = {'requests': 0, 'errors': 0,
+                                          'latencies': deque(maxlen=LATENCIES)}
+            r['requests'] += 1
+            r['errors'] += status >= 400
+            r['latencies'].append(seconds * 1000.0)
+
+    def report(self):
+        with self.lock:
+            routes = dict((name, (r['requests'], r['errors'], sorted(r['latencies'])))
+                          for name, r in self.routes.items())
+        report = {'uptime': time.time() - self.start, 'routes': {}}
+        for name, (requests, errors, latencies) in routes.items():
+            report['routes'][name] = {
+                'requests': requests, 'errors': errors,
+                'p50_ms': percentile(latencies, 50), 'p99_ms': percentile(latencies, 99),
+                'mean_ms': sum(latencies) / len(latencies)}
+        return report
+
+
+def int_param(params, name, default=None, maximum=None):
+    """Integer parameter name, at least 1 (a limit of -1 is no limit at all for SQLite) and
+    at most maximum. ValueError if it is missing without a default or below 1."""
+    if name not in params:
+        if default is None:
+            raise ValueError('missing parameter ' + name)
+        return default
+    value = int(params[name])
+    if value < 1:
+        raise ValueError('{0} has to be at least 1'.format(name))
+    return min(value, maximum) if maximum is not None else value
+
+
+def bbox_ranges(s, w, n, e, zoom):
+    """Ranges [lo, hi) of the tile keys at zoom that cover a box: the tiles of the highest
+    zoom (up to zoom) at which at most BBOX_TILES of them cover it, adjacent keys merged"""
+    level = zoom
+    while True:
+        (x0, x1), (y1, y0) = quadtiles.tile_xy([s, n], [w, e], level)
+        if level == 0 or (x1 - x0 + 1) * (y1 - y0 + 1) <= BBOX_TILES:
+            break
+        level -= 1
+    keys = sorted(int(quadtiles.xy_key(x, y, level)) for x in range(x0, x1 + 1)
+                  for y in range(y0, y1 + 1))
+    ranges = []
+    for lo, hi in (quadtiles.key_range(k, level, zoom) for k in keys):
+        if ranges and ranges[-1][1] == lo:
+            ranges[-1] = (ranges[-1][0], hi)
+        else:
+            ranges.append((lo, hi))
+    return ranges
+
+
+class API(object):
+    """The routes of the server, run on a connection of the pool"""
+
+    def __init__(self, database=database, workers=WORKERS, cache_size=CACHE_SIZE,
+                 cache_ttl=CACHE_TTL):
+        self.pool = SQLitePool(database, workers, wal=False)
+        self.cache = TTLCache(cache_size, cache_ttl)
+        self.metrics = Metrics()
+        with self.pool.connection() as con:
+            self.tables = set(t for t, in con.execute(
+                "SELECT name FROM sqlite_master WHERE type IN ('table', 'view');"))
+            self.view = make_a_view.is_current(con)
+            self.tile_zoom = quadtiles.table_zoom(con) if 'tiles' in self.tables and \
+                con.execute('SELECT 1 FROM tiles LIMIT 1;').fetchone() else None
+            self.element_queries = dict(
+                (element, [(name, sql.format(create_db.row_order(con, table)))
+                           for name, table, sql in queries])
+                for element, queries in ELEMENTS.items())
+        self.routes = [
+            (re.compile(r'^/(node|way|relation)/(-?\d+)$'), 'element', self.element),
+            (re.compile(r'^/tags$'), 'tags', self.tags),
+            (re.compile(r'^/bbox$'), 'bbox', self.bbox),
+            (re.compile(r'^/address$'), 'address', self.address),
+            (re.compile(r'^/query/(\w+)$'), 'query', self.query),
+        ]
+
+    def element(self, con, params, element, element_id):
+        table = element + 's'
+        if table not in self.tables:
+            raise NotFound('no {0} in this database'.format(table))
+        cur = con.execute('SELECT * FROM {0} WHERE id = ?;'.format(table), (int(element_id),))
+        row = cur.fetchone()
+        if row is None:
+            raise NotFound('{0} {1} not found'.format(element, element_id))
+        result = dict(zip([d[0] for d in cur.description], row))
+        result['type'] = element
+        if result.get('timestamp') is not None:
+            result['timestamp'] = time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                                time.gmtime(result['timestamp']))
+        for name, sql in self.element_queries[element]:
+            rows = con.execute(sql, (int(element_id),)).fetchall()
+            if name == 'tags':
+                result[name] = [{'key': k, 'value': v, 'type': t} for k, v, t in rows]
+            elif name == 'nodes':
+                result[name] = [n for n, in rows]
+            else:
+                result[name] = [{'type': t, 'ref': r, 'role': role} for t, r, role in rows]
+        return result
+
+    def tags(self, con, params):
+        if 'key' not in params:
+            raise ValueError('missing parameter key')
+        args = {'key': params['key'], 'limit': int_param(params, 'limit', 100, MAX_LIMIT)}
+        where = ''
+        if 'value' in params:
+            where = 'AND value = :value'
+            args['value'] = params['value']
+        if 'type' in params:
+            where += ' AND type = :type'
+            args['type'] = params['type']
+        rows = con.execute(TAG_SEARCH.format(where), args).fetchall()
+        return [{'type': e, 'id': i, 'value': v} for e, i, v in rows]
+
+    def bbox(self, con, params):
+        try:
+            s, w, n, e = [float(v) for v in params['bbox'].split(',')]
+        except (KeyError, ValueError):
+            raise ValueError('bbox must be south,west,north,east')
+        if any(math.isnan(v) or math.isinf(v) for v in (s, w, n, e)):
+            raise ValueError('bbox must be finite numbers')
+        if s > n or w > e:
+            raise ValueError('bbox must be south,west,north,east')
+        args = {'s': s, 'w': w, 'n': n, 'e': e,
+                'limit': int_param(params, 'limit', 100, MAX_LIMIT)}
+        sql = BBOX_NODES
+        if self.tile_zoom is not None:
+            ranges = bbox_ranges(s, w, n, e, self.tile_zoom)
+            sql = BBOX_TILE_NODES.format(' UNION ALL '.join(
+                quadtiles.TILE_NODES.replace('tile >= ?', 'tile >= :lo{0}').replace(
+                    'tile < ?', 'tile < :hi{0}').format(i) for i in range(len(ranges))))
+            for i, (lo, hi) in enumerate(ranges):
+                args['lo{0}'.format(i)], args['hi{0}'.format(i)] = lo, hi
+        rows = con.execute(sql, args).fetchall()
+        return [{'id': i, 'lat': lat, 'lon': lon} for i, lat, lon in rows]
+
+    def address(self, con, params):
+        if not params.get('q'):
+            raise ValueError('missing parameter q')
+        if 'addresses' not in self.tables:
+            raise NotFound('no addresses in this database '
+                           '(see create_db.create_address_table)')
+        parsed = parse_address(params['q'])
+        if not parsed['u_street']:
+            return []
+        parsed['limit'] = int_param(params, 'limit', 10, MAX_LIMIT)
+        rows = con.execute(ADDRESS_LOOKUP, parsed).fetchall()
+        return [dict(zip(ADDRESS_FIELDS, row)) for row in rows]
+
+    def query(self, con, params, name):
+        if name not in QUERIES:
+            raise NotFound('unknown query {0}, use one of {1}'.format(
+                name, ', '.join(sorted(QUERIES))))
+        if 'myview' in QUERIES[name] and not self.view:
+            raise NotFound('{0} needs myview, run make_a_view.py on the database'.format(name))
+        cur = con.execute(QUERIES[name])
+        return {'columns': [d[0] for d in cur.description], 'rows': cur.fetchall()}
+
+    def handle(self, url):
+        """(route name, HTTP status, JSON body) of a GET of url"""
+        parsed = urlparse.urlparse(url)
+        if parsed.path == '/metrics':
+            report = self.metrics.report()
+            report['cache'] = self.cache.stats()
+            return 'metrics', 200, json.dumps(report, sort_keys=True)
+        for pattern, name, func in self.routes:
+            match = pattern.match(parsed.path)
+            if match:
+                break
+        else:
+            return 'unknown', 404, json.dumps({'error': 'no such route ' + parsed.path})
+        body = self.cache.get(url)
+        if body is not None:
+            return name, 200, body
+        try:
+            params = dict((k, v.decode('utf-8')) for k, v in
+                          urlparse.parse_qsl(parsed.query, keep_blank_values=True))
+            with self.pool.connection() as con:
+                result = func(con, params, *match.groups())
+        except NotFound as e:
+            return name, 404, json.dumps({'error': str(e)})
+        except UnicodeDecodeError:
+            return name, 400, json.dumps({'error': 'parameters must be UTF-8'})
+        except ValueError as e:
+            return name, 400, json.dumps({'error': str(e)})
+        except sqlite3.Error as e:
+            return name, 500, json.dumps({'error': str(e)})
+        except Exception as e:
+            # Any other bug still answers (and is counted in the metrics) instead of killing
+            # the thread of the request
+            return name, 500, json.dumps({'error': '{0}: {1}'.format(type(e).__name__, e)})
+        body = json.dumps(result)
+        self.cache.put(url, body)
+        return name, 200, body
+
+    def close(self):
+        self.pool.close()
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, so clients can reuse their connection
+    # The response is written in one send (unbuffered, every header is a packet of its own
+    # and Nagle's algorithm holds it for the delayed ACK of the client, 40 ms)
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        start = time.time()
+        name, status, body = self.server.api.handle(self.path)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.api.metrics.record(name, time.time() - start, status)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, api):
+        HTTPServer.__init__(self, address, Handler)
+        self.api = api
+
+
+def serve(database=database, host='127.0.0.1', port=PORT, workers=WORKERS,
+          cache_size=CACHE_SIZE, cache_ttl=CACHE_TTL):
+    """Server listening on (host, port); call serve_forever() on it (port 0 picks a free one,
+    see server.server_address)"""
+    return Server((host, port), API(database, workers, cache_size, cache_ttl))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve the database as a read-only JSON API')
+    parser.add_argument('--db', default=database)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--workers', type=int, default=WORKERS)
+    parser.add_argument('--cache-size', type=int, default=CACHE_SIZE)
+    parser.add_argument('--cache-ttl', type=float, default=CACHE_TTL)
+    args = parser.parse_args()
+    server = serve(args.db, args.host, args.port, args.workers, args.cache_size,
+                   args.cache_ttl)
+    print 'Serving {0} on http://{1}:{2}/'.format(args.db, *server.server_address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    server.api.close()
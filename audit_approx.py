@@ -0,0 +1,136 @@
+"""
+Approximate audit of tags and contributors for files too large for the exact audits
+(audit_tags.py, audit_zipcodes.py...) and the matching summary of a database (query04 and
+query05 of query_db.py). Memory stays fixed however large the input is.
+
+It reports the number of distinct users, keys and values of some keys (HyperLogLog) and the
+top keys and contributors (Count-Min sketch). The error bounds are set with --error (relative
+error of the distinct counts) and --epsilon (error of the counts, as a fraction of the total).
+
+Every audit can be saved and merged with the audits of other shards or regions:
+
+    python audit_approx.py --osm tampa_florida.osm --save tampa.pkl
+    python audit_approx.py --db orlando.db --save orlando.pkl
+    python audit_approx.py --merge tampa.pkl orlando.pkl
+"""
+import argparse
+import cPickle as pickle
+import sqlite3
+import xml.etree.cElementTree as ET
+
+from sketches import CountMinSketch, HyperLogLog
+
+OSMFILE = 'tampa_florida.osm'
+database = "TampaFlorida.db"
+
+# Keys whose number of distinct values is audited
+VALUE_KEYS = ['addr:postcode', 'addr:street', 'addr:city', 'tiger:county']
+# The same keys once cleaned by clean_data.py (type:key in the database)
+DB_VALUE_KEYS = [('addr', 'postcode'), ('addr', 'street'), ('addr', 'city'),
+                 ('tiger', 'county')]
+
+
+def new_audit(error=0.01, epsilon=0.001, delta=0.01, top_n=20):
+    return {'users': HyperLogLog.from_error(error),
+            'keys': HyperLogLog.from_error(error),
+            'values': dict((k, HyperLogLog.from_error(error)) for k in VALUE_KEYS),
+            'top_keys': CountMinSketch(epsilon, delta, top_n),
+            'top_users': CountMinSketch(epsilon, delta, top_n),
+            'elements': 0}
+
+
+def audit_osm(osmfile, audit):
+    context = iter(ET.iterparse(osmfile, events=('start', 'end')))
+    _, root = next(context)
+    for event, element in context:
+        if event == 'end' and element.tag in ('node', 'way', 'relation'):
+            audit['elements'] += 1
+            user = element.attrib.get('user')
+            if user is not None:
+                audit['users'].add(element.attrib['uid'])
+                audit['top_users'].add(user)
+            for tag in element.iter('tag'):
+                k = tag.attrib['k']
+                audit['keys'].add(k)
+                audit['top_keys'].add(k)
+                if k in audit['values']:
+                    audit['values'][k].add(tag.attrib['v'])
+            root.clear()
+    return audit
+
+
+def audit_db(database, audit):
+    """Summary of a database, streaming its rows instead of running COUNT(DISTINCT...)"""
+    db = sqlite3.connect(database)
+    for uid, user in db.execute('SELECT uid, user FROM nodes UNION ALL '
+                                'SELECT uid, user FROM ways;'):
+        audit['elements'] += 1
+        audit['users'].add(str(uid))
+        audit['top_users'].add(user)
+    db_keys = dict(((t, k), '{0}:{1}'.format(t, k)) for t, k in DB_VALUE_KEYS)
+    for key, value, tag_type in db.execute('SELECT key, value, type FROM nodes_tags UNION ALL '
+                                           'SELECT key, value, type FROM ways_tags;'):
+        k = key if tag_type in ('regular', None) else '{0}:{1}'.format(tag_type, key)
+        audit['keys'].add(k)
+        audit['top_keys'].add(k)
+        if (tag_type, key) in db_keys:
+            audit['values'][db_keys[(tag_type, key)]].add(value)
+    db.close()
+    return audit
+
+
+def merge_audits(audits):
+    merged = audits[0]
+    for audit in audits[1:]:
+        merged['elements'] += audit['elements']
+        for name in ['users', 'keys', 'top_keys', 'top_users']:
+            merged[name].merge(audit[name])
+        for k in merged['values']:
+            merged['values'][k].merge(audit['values'][k])
+    return merged
+
+
+def print_audit(audit):
+    hll_error = audit['users'].error()
+    print 'Elements: ', audit['elements']
+    print 'Distinct users: {0:.0f} (+/- {1:.1%})'.format(audit['users'].count(), hll_error)
+    print 'Distinct keys: {0:.0f} (+/- {1:.1%})'.format(audit['keys'].count(), hll_error)
+    for k in VALUE_KEYS:
+        print 'Distinct values of {0}: {1:.0f}'.format(k, audit['values'][k].count())
+    print ' '
+    print 'Top keys (counts overestimated by at most {0:.0f}): '.format(
+        audit['top_keys'].error()), audit['top_keys'].most_common()
+    print ' '
+    print 'Top contributors (counts overestimated by at most {0:.0f}): '.format(
+        audit['top_users'].error()), audit['top_users'].most_common(10)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Approximate audit of tags and users')
+    parser.add_argument('--osm', nargs='*', default=[], help='.osm files to audit')
+    parser.add_argument('--db', nargs='*', default=[], help='databases to summarize')
+    parser.add_argument('--merge', nargs='*', default=[], help='saved audits to merge')
+    parser.add_argument('--save', help='save the (merged) audit to this file')
+    parser.add_argument('--error', type=float, default=0.01,
+                        help='relative error of the distinct counts')
+    parser.add_argument('--epsilon', type=float, default=0.001,
+                        help='error of the top counts as a fraction of the total')
+    parser.add_argument('--delta', type=float, default=0.01,
+                        help='probability of exceeding the error of the top counts')
+    args = parser.parse_args()
+    if not (args.osm or args.db or args.merge):
+        args.osm = [OSMFILE]
+
+    audits = []
+    for path in args.merge:
+        with open(path, 'rb') as f:
+            audits.append(pickle.load(f))
+    for path in args.osm:
+        audits.append(audit_osm(path, new_audit(args.error, args.epsilon, args.delta)))
+    for path in args.db:
+        audits.append(audit_db(path, new_audit(args.error, args.epsilon, args.delta)))
+    audit = merge_audits(audits)
+    if args.save:
+        with open(args.save, 'wb') as f:
+            pickle.dump(audit, f, pickle.HIGHEST_PROTOCOL)
+    print_audit(audit)
@@ -0,0 +1,264 @@
+"""
+Finds near-duplicate street, city and county names, like the typos 'St Petersbug',
+'Clearwarer Beach' or 'Bolevard' that were spotted by eye and fixed in CITY_FIXES and in the
+mapping of clean_data.py, and suggests the entries that would fix them.
+
+Every distinct value of addr:street, addr:city, tiger:county and the derived u_street is
+gathered as clean_data.py leaves it (so a suggestion only lists what the current rules still
+miss) and compared with the others by edit distance. Comparing every pair would grow with the
+square of the number of values, so candidates are found with an index of character trigrams:
+two strings within k edits share at least one of the first 4k + 1 trigrams of each, once the
+trigrams are sorted from the rarest to the most common, so only those prefixes are indexed
+(the prefix filter of Ed-Join). Candidates that share too few trigrams are dropped before
+their edit distance is computed, and the cost grows with the number of candidates instead.
+
+Pairs within the allowed number of edits are clustered and every value of a cluster is
+suggested to become its most frequent one. The suggestions for cities go to "city_names" and
+the misspelled street types and cardinals of street names to "mapping", in the format of a
+rules file (the other street clusters are only reported):
+
+    python audit_near_duplicates.py --osm tampa_florida.osm --out suggestions.json
+    python audit_near_duplicates.py --db TampaFlorida.db
+
+Once reviewed, they are applied with clean_data.load_rules (or merged into clean_rules.json).
+"""
+import argparse
+import json
+import re
+import sqlite3
+import time
+from collections import Counter, defaultdict
+
+import clean_data
+
+OSMFILE = 'tampa_florida.osm'
+database = "TampaFlorida.db"
+
+# Audited (type, key) of the cleaned tags, as stored in the database
+FIELDS = [('addr', 'street'), ('addr', 'u_street'), ('addr', 'city'), ('tiger', 'county')]
+Q = 3
+LOST = Q + 1  # trigrams an edit can change at most (a swap of two characters)
+MIN_LENGTH = 4  # shorter values are not compared
+EDIT_RATIO = 0.12  # edits allowed per character of the shorter value...
+MAX_EDITS = 2  # ...but never more than this
+digits_re = re.compile(r'\d+')
+
+# Words that are different streets, not typos of each other ('Bay Street' / 'Bay Court')
+KNOWN_WORDS = set(w.lower() for w in clean_data.expected + clean_data.cardinals +
+                  clean_data.mapping.values())
+
+
+def max_edits(length):
+    return min(MAX_EDITS, max(1, int(length * EDIT_RATIO)))
+
+
+def qgrams(s, q=Q):
+    """Distinct q-grams of s, padded so that its first and last characters count as much as
+    the others"""
+    s = '#' * (q - 1) + s + '$' * (q - 1)
+    return set(s[i:i + q] for i in range(len(s) - q + 1))
+
+
+def edit_distance(a, b, limit):
+    """Edit distance between a and b counting a swap of two adjacent characters as one edit
+    (optimal string alignment), or limit + 1 as soon as it is known to exceed limit. Only the
+    band of the matrix within limit of the diagonal is computed."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    if len(a) > len(b):
+        a, b = b, a
+    big = limit + 1
+    before, previous = None, range(len(b) + 1)
+    for i in range(1, len(a) + 1):
+        lo, hi = max(1, i - limit), min(len(b), i + limit)
+        current = [big] * (len(b) + 1)
+        current[0] = i if i <= limit else big
+        for j in range(lo, hi + 1):
+            d = min(previous[j] + 1, current[j - 1] + 1,
+                    previous[j - 1] + (a[i - 1] != b[j - 1]))
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                d = min(d, before[j - 2] + 1)
+            current[j] = d
+        if min(current[lo - 1:hi + 1]) > limit:
+            return big
+        before, previous = previous, current
+    return min(previous[len(b)], big)
+
+
+def different_words(a, b):
+    """Whether a and b differ in a number or only in known words, so they are names of
+    different streets and not typos"""
+    if digits_re.findall(a) != digits_re.findall(b):
+        return True
+    wa, wb = a.lower().split(), b.lower().split()
+    if len(wa) == len(wb):
+        diff = [(x, y) for x, y in zip(wa, wb) if x != y]
+        if diff and all(x in KNOWN_WORDS and y in KNOWN_WORDS for x, y in diff):
+            return True
+    return False
+
+
+def similar_pairs(values):
+    """(a, b, distance) of the values within max_edits of each other (compared in
+    lowercase), found with the prefix-filtered trigram index. Also returns the number of
+    candidates verified."""
+    keys = [v.lower() for v in values]
+    grams = [qgrams(k) for k in keys]
+    frequency = Counter(g for gs in grams for g in gs)
+    index = defaultdict(list)
+    pairs = []
+    candidates = 0
+    # Shortest first: a value is only compared with the values already indexed
+    for i in sorted(range(len(values)), key=lambda i: (len(keys[i]), keys[i])):
+        if len(keys[i]) < MIN_LENGTH:
+            continue
+        k = max_edits(len(keys[i]))
+        prefix = sorted(grams[i], key=lambda g: (frequency[g], g))[:LOST * k + 1]
+        seen = set()
+        for g in prefix:
+            for j in index[g]:
+                if j in seen:
+                    continue
+                seen.add(j)
+                limit = max_edits(min(len(keys[i]), len(keys[j])))
+                # Count filter: every edit changes at most LOST trigrams of either string
+                shared = len(grams[i] & grams[j])
+                if shared < max(len(grams[i]), len(grams[j])) - LOST * limit:
+                    continue
+                d = edit_distance(keys[i], keys[j], limit)
+                if d <= limit and not different_words(values[i], values[j]):
+                    pairs.append((values[j], values[i], d))
+            index[g].append(i)
+        candidates += len(seen)
+    return pairs, candidates
+
+
+def brute_force_pairs(values):
+    """The same pairs as similar_pairs, comparing every pair (to check it on small inputs)"""
+    pairs = []
+    for i, a in enumerate(values):
+        for b in values[i + 1:]:
+            if min(len(a), len(b)) < MIN_LENGTH:
+                continue
+            limit = max_edits(min(len(a), len(b)))
+            d = edit_distance(a.lower(), b.lower(), limit)
+            if d <= limit and not different_words(a, b):
+                pairs.append((a, b, d))
+    return pairs
+
+
+def clusters(counts, pairs):
+    """Groups the values linked by pairs. Returns a list of (canonical value, [variants]),
+    the canonical value being the most frequent of its cluster"""
+    parent = {}
+
+    def find(v):
+        while parent.get(v, v) != v:
+            v = parent[v]
+        return v
+    for a, b, d in pairs:
+        ra, rb = find(a), find(b)
+        if ra != rb:
+            parent[ra] = rb
+    groups = defaultdict(list)
+    for v in set(v for a, b, d in pairs for v in (a, b)):
+        groups[find(v)].append(v)
+    result = []
+    for members in groups.values():
+        members.sort(key=lambda v: (-counts[v], v))
+        result.append((members[0], members[1:]))
+    return sorted(result, key=lambda c: (-counts[c[0]], c[0]))
+
+
+def word_fixes(canonical, variant):
+    """{misspelled word: word} when variant differs from canonical in a single word, which is
+    a street type or a cardinal of canonical, e.g. 'Bolevard' for 'Boulevard'"""
+    a, b = variant.split(), canonical.split()
+    if len(a) != len(b):
+        return {}
+    diff = [(x, y) for x, y in zip(a, b) if x != y]
+    if len(diff) == 1 and diff[0][0].lower() not in KNOWN_WORDS and \
+            diff[0][1].lower() in KNOWN_WORDS:
+        return dict(diff)
+    return {}
+
+
+def values_osm(osmfile):
+    """{(type, key): Counter of values} of the audited fields, cleaned by clean_data.py"""
+    values = defaultdict(Counter)
+    fields = set(FIELDS)
+    for element in clean_data.get_element(osmfile, tags=('node', 'way')):
+        element_id = element.attrib['id']
+        for tag in element.iter('tag'):
+            for t in clean_data.shape_tag(tag.attrib['k'], tag.attrib['v'], element_id):
+                if (t['type'], t['key']) in fields:
+                    values[(t['type'], t['key'])][t['value']] += 1
+    return values
+
+
+def values_db(database):
+    values = defaultdict(Counter)
+    db = sqlite3.connect(database)
+    for tag_type, key in FIELDS:
+        for value, n in db.execute(
+                'SELECT value, COUNT(*) FROM (SELECT type, key, value FROM nodes_tags '
+                'UNION ALL SELECT type, key, value FROM ways_tags) '
+                'WHERE type = ? AND key = ? GROUP BY value;', (tag_type, key)):
+            values[(tag_type, key)][value] = n
+    db.close()
+    return values
+
+
+def audit(values):
+    """Clusters of every field and the rules they suggest"""
+    report = {}
+    suggestions = {'city_names': {}, 'mapping': {}}
+    for field in FIELDS:
+        counts = values.get(field, Counter())
+        start = time.time()
+        pairs, candidates = similar_pairs(sorted(counts))
+        found = clusters(counts, pairs)
+        report[field] = {'values': len(counts), 'candidates': candidates,
+                         'pairs': len(pairs), 'clusters': found,
+                         'seconds': time.time() - start, 'counts': counts}
+        for canonical, variants in found:
+            for variant in variants:
+                if field == ('addr', 'city'):
+                    suggestions['city_names'][variant] = canonical
+                elif field[1] in ('street', 'u_street'):
+                    suggestions['mapping'].update(word_fixes(canonical, variant))
+    return report, suggestions
+
+
+def print_report(report):
+    for field in FIELDS:
+        r = report[field]
+        n = r['values']
+        print '{0}:{1}: {2} distinct values, {3} candidates verified (all pairs: {4}), ' \
+              '{5} clusters in {6:.2f}s'.format(field[0], field[1], n, r['candidates'],
+                                                n * (n - 1) // 2, len(r['clusters']),
+                                                r['seconds'])
+        for canonical, variants in r['clusters']:
+            print u'    {0} ({1}) <- {2}'.format(canonical, r['counts'][canonical], ', '.join(
+                u'{0} ({1})'.format(v, r['counts'][v]) for v in variants)).encode('utf-8')
+        print ' '
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Find near-duplicate street, city and '
+                                                 'county names')
+    parser.add_argument('--osm', help='.osm file to audit (default: {0})'.format(OSMFILE))
+    parser.add_argument('--db', help='database to audit instead of an .osm file')
+    parser.add_argument('--rules', help='cleaning rules to apply first (see load_rules)')
+    parser.add_argument('--out', help='write the suggested rules to this JSON file')
+    args = parser.parse_args()
+    if args.rules:
+        clean_data.load_rules(args.rules)
+    values = values_db(args.db) if args.db else values_osm(args.osm or OSMFILE)
+    report, suggestions = audit(values)
+    print_report(report)
+    print 'Suggested rules: '
+    print json.dumps(suggestions, indent=2, sort_keys=True)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(suggestions, f, indent=2, sort_keys=True)
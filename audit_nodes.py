@@ -0,0 +1,372 @@
+"""
+Sanity audit of the coordinates and attributes of the nodes, none of which is checked by the
+cleaning: the whole nodes table is loaded column by column into NumPy arrays (from nodes.csv,
+in chunks of CHUNK_SIZE rows, or from the nodes table of a database) and every check is a
+vectorized operation over those arrays.
+
+    invalid_coordinates    lat or lon missing or out of [-90, 90] x [-180, 180]
+    outside_bbox           valid coordinates outside of the bounding box of the region
+    duplicate_coordinates  the same position as another node (to 1e-7 degree, the
+                           precision of OSM)
+    invalid_version        version missing or below 1
+    invalid_uid            uid missing or negative
+    impossible_timestamp   timestamp missing, malformed, before OSM started or in the future
+    edit_burst             one of BURST_EDITS or more nodes of the same user with timestamps
+                           less than BURST_SECONDS apart (imports and mass edits)
+
+The exact count of offending nodes is printed for every check with a few of their ids, and
+the users behind the bursts; --out writes every offending id to a .csv file. --benchmark
+times the same audit done row by row in Python (the results have to be the same):
+
+    python audit_nodes.py [nodes.csv | file.db] [--bbox s,w,n,e] [--until 2017-01-01]
+                          [--out node_audit.csv] [--benchmark]
+"""
+import argparse
+import calendar
+import csv
+import datetime
+import re
+import sqlite3
+import time
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+
+from compressed_csv import open_csv
+
+NODES_PATH = 'nodes.csv'
+BBOX = (27.3, -83.0, 28.5, -81.9)  # south, west, north, east: Tampa Bay with a margin
+OSM_START = calendar.timegm((2004, 8, 9, 0, 0, 0))  # first day of OpenStreetMap
+TIMESTAMP_RE = re.compile(r'(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)Z$')
+INTEGER_RE = r'\s*[+-]?\d+\s*$'  # what int() parses
+TIMESTAMP_MASK = '9999-99-99T99:99:99Z'  # 9: a digit
+TIMESTAMP_WIDTH = len(TIMESTAMP_MASK)
+MONTH_DAYS = np.array([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+BURST_EDITS = 1000
+BURST_SECONDS = 60
+SCALE = 10 ** 7  # coordinates are compared in units of 1e-7 degree
+CHUNK_SIZE = 500000
+SAMPLE_SIZE = 10
+COLUMNS = ['id', 'lat', 'lon', 'uid', 'version', 'timestamp']
+CHECKS = ['invalid_coordinates', 'outside_bbox', 'duplicate_coordinates', 'invalid_version',
+          'invalid_uid', 'impossible_timestamp', 'edit_burst']
+
+
+################################### Loading ##################################################
+
+def epoch_seconds(timestamps):
+    """Seconds since 1970 of an array of OSM timestamps (YYYY-MM-DDTHH:MM:SSZ, see
+    TIMESTAMP_RE), -1 where they do not parse. The strings are read as fixed-width bytes,
+    which is several times faster than pandas.to_datetime with a format."""
+    # One byte more than the format, so that longer strings are not cut to a valid one
+    raw = np.asarray(timestamps).astype('S{0}'.format(TIMESTAMP_WIDTH + 1))
+    b = raw.view(np.uint8).reshape(len(raw), TIMESTAMP_WIDTH + 1).astype(np.int64)
+    ok = (b[:, TIMESTAMP_WIDTH] == 0)
+    for i, c in enumerate(TIMESTAMP_MASK):
+        digit = (b[:, i] >= ord('0')) & (b[:, i] <= ord('9'))
+        ok &= digit if c == '9' else (b[:, i] == ord(c))
+    d = b - ord('0')
+    year = d[:, 0] * 1000 + d[:, 1] * 100 + d[:, 2] * 10 + d[:, 3]
+    month, day, hour, minute, second = [d[:, i] * 10 + d[:, i + 1] for i in (5, 8, 11, 14, 17)]
+    leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+    month_days = MONTH_DAYS[np.clip(month - 1, 0, 11)] + (leap & (month == 2))
+    ok &= (year >= 1) & (month >= 1) & (month <= 12) & (day >= 1) & (day <= month_days) & \
+        (hour < 24) & (minute < 60) & (second < 60)
+    # Days since 1970-01-01 of a proleptic Gregorian date (H. Hinnant's days_from_civil)
+    y = year - (month <= 2)
+    era = y // 400
+    yoe = y - era * 400
+    doy = (153 * ((month + 9) % 12) + 2) // 5 + day - 1
+    days = era * 146097 + yoe * 365 + yoe // 4 - yoe // 100 + doy - 719468
+    return np.where(ok, days * 86400 + hour * 3600 + minute * 60 + second, -1)
+
+
+def parse_timestamp(timestamp):
+    """Seconds since 1970 of an OSM timestamp, None if it does not parse"""
+    match = TIMESTAMP_RE.match(timestamp or '')
+    if match is None:
+        return None
+    try:
+        return calendar.timegm(datetime.datetime(*map(int, match.groups())).timetuple())
+    except ValueError:
+        return None
+
+
+def integers(values):
+    """int64 array of a Series of numbers or strings, -1 where they are missing or are not
+    integers (astype would cut a version of 1.5 to a valid 1)"""
+    numbers = pd.to_numeric(values, errors='coerce')
+    if numbers.dtype.kind in 'iu':
+        return numbers.values.astype(np.int64)
+    numbers = numbers.values.astype(float)
+    with np.errstate(invalid='ignore'):
+        ok = np.isfinite(numbers) & (numbers == np.floor(numbers))
+    strings = np.array([isinstance(v, basestring) for v in values.values], dtype=bool)
+    if strings.any():
+        # Strings such as 1.0 or 1e3 are not integers for int() either
+        ok[strings] &= values[strings].str.match(INTEGER_RE).values.astype(bool)
+    return np.where(ok, np.where(ok, numbers, 0).astype(np.int64), -1)
+
+
+def load_csv(path=NODES_PATH, chunk_size=CHUNK_SIZE):
+    """{column: array} of the COLUMNS of the nodes .csv file path (which may be compressed).
+    lat and lon are NaN and uid, version and timestamp -1 where they are missing or do not
+    parse (or are not integers)."""
+    chunks = dict((c, []) for c in COLUMNS)
+    with open_csv(path) as f:
+        for df in pd.read_csv(f, usecols=COLUMNS, chunksize=chunk_size):
+            chunks['id'].append(df['id'].values.astype(np.int64))
+            for c in ('lat', 'lon'):
+                chunks[c].append(pd.to_numeric(df[c], errors='coerce').values.astype(float))
+            for c in ('uid', 'version'):
+                chunks[c].append(integers(df[c]))
+            chunks['timestamp'].append(epoch_seconds(df['timestamp'].fillna('').values))
+    return dict((c, np.concatenate(chunks[c]) if chunks[c] else
+                 np.zeros(0, float if c in ('lat', 'lon') else np.int64)) for c in COLUMNS)
+
+
+def load_db(path, chunk_size=CHUNK_SIZE):
+    """The same arrays as load_csv, from the nodes table of the database path (whose
+    timestamps are already seconds since 1970)"""
+    con = sqlite3.connect(path)
+    cursor = con.execute('SELECT id, lat, lon, uid, version, timestamp FROM nodes;')
+    chunks = []
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        chunks.append(np.array(rows, dtype=object))
+    con.close()
+    rows = np.concatenate(chunks) if chunks else np.zeros((0, len(COLUMNS)), dtype=object)
+    columns = {}
+    for i, c in enumerate(COLUMNS):
+        if c in ('lat', 'lon'):
+            columns[c] = pd.to_numeric(pd.Series(rows[:, i]), errors='coerce').values \
+                .astype(float)
+        else:
+            columns[c] = integers(pd.Series(rows[:, i]))
+    return columns
+
+
+def load(path):
+    if path.endswith('.db'):
+        return load_db(path)
+    return load_csv(path)
+
+
+################################### Vectorized audit #########################################
+
+def fixed(degrees):
+    """Degrees in integer units of 1/SCALE"""
+    return np.round(np.asarray(degrees) * SCALE).astype(np.int64)
+
+
+def duplicates(lat, lon, ok):
+    """Mask of the nodes (among ok) at the same position as another one, and the number of
+    positions shared. lat and lon are in units of 1/SCALE."""
+    index = np.flatnonzero(ok)
+    # One sort key for both, much faster to sort than the two columns with np.lexsort
+    key = (lat[index] + 90 * SCALE) * (360 * SCALE + 1) + lon[index] + 180 * SCALE
+    order = np.argsort(key)
+    key, order = key[order], index[order]
+    same = key[1:] == key[:-1]
+    mask = np.zeros(len(lat), bool)
+    mask[order[1:][same]] = True
+    mask[order[:-1][same]] = True
+    groups = np.count_nonzero(same[1:] & ~same[:-1]) + int(same[:1].sum())
+    return mask, groups
+
+
+def bursts(uid, timestamp, ok, edits=BURST_EDITS, seconds=BURST_SECONDS):
+    """Mask of the nodes in a burst (see the docstring of the module) and {uid: (nodes in
+    bursts, most nodes within seconds)} of the users who made them"""
+    index = np.flatnonzero(ok)
+    # One sort key for both: timestamps fit in 32 bits until 2106
+    key = (uid[index] << 32) | timestamp[index]
+    order = np.argsort(key)
+    key, index = key[order], index[order]
+    n = len(key)
+    # Nodes of the same user at most seconds - 1 after every node
+    counts = np.searchsorted(key, key + seconds, 'left') - np.arange(n)
+    starts = np.flatnonzero(counts >= edits)
+    inside = np.cumsum(np.bincount(starts, minlength=n + 1) -
+                       np.bincount(starts + counts[starts], minlength=n + 1))[:n] > 0
+    mask = np.zeros(len(uid), bool)
+    mask[index[inside]] = True
+    users = {}
+    if inside.any():
+        burst_uid = uid[index[inside]]
+        flagged = np.bincount(np.searchsorted(np.unique(burst_uid), burst_uid))
+        peaks = pd.Series(counts[starts]).groupby(uid[index[starts]]).max()
+        for u, count in zip(np.unique(burst_uid), flagged):
+            users[int(u)] = (int(count), int(peaks[u]))
+    return mask, users
+
+
+def audit(nodes, bbox=BBOX, until=None, edits=BURST_EDITS, seconds=BURST_SECONDS):
+    """({check: sorted ids of the offending nodes}, {uid: (nodes in bursts, most nodes within
+    seconds)}, number of shared positions) of the arrays of load_csv or load_db"""
+    until = time.time() if until is None else until
+    ids, uid, version, timestamp = nodes['id'], nodes['uid'], nodes['version'], \
+        nodes['timestamp']
+    with np.errstate(invalid='ignore'):
+        valid = (np.abs(nodes['lat']) <= 90) & (np.abs(nodes['lon']) <= 180)
+    lat = np.where(valid, fixed(np.where(valid, nodes['lat'], 0)), 0)
+    lon = np.where(valid, fixed(np.where(valid, nodes['lon'], 0)), 0)
+    south, west, north, east = [int(v) for v in fixed(bbox)]
+    inside = (lat >= south) & (lat <= north) & (lon >= west) & (lon <= east)
+    duplicate, groups = duplicates(lat, lon, valid)
+    good_time = (timestamp >= OSM_START) & (timestamp <= until)
+    burst, users = bursts(uid, timestamp, (uid >= 0) & good_time, edits, seconds)
+    masks = {'invalid_coordinates': ~valid,
+             'outside_bbox': valid & ~inside,
+             'duplicate_coordinates': duplicate,
+             'invalid_version': version < 1,
+             'invalid_uid': uid < 0,
+             'impossible_timestamp': ~good_time,
+             'edit_burst': burst}
+    return dict((c, np.sort(ids[masks[c]])) for c in CHECKS), users, groups
+
+
+################################### Row by row ###############################################
+
+def number(value, kind):
+    try:
+        return kind(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def audit_rows(path, bbox=BBOX, until=None, edits=BURST_EDITS, seconds=BURST_SECONDS):
+    """The same audit as audit(load_csv(path)), one row at a time in plain Python"""
+    until = time.time() if until is None else until
+    south, west, north, east = [int(round(v * SCALE)) for v in bbox]
+    found = dict((c, []) for c in CHECKS)
+    positions = defaultdict(list)
+    edits_by_user = defaultdict(list)
+    with open_csv(path) as f:
+        for row in csv.DictReader(f):
+            node_id = int(row['id'])
+            lat, lon = number(row['lat'], float), number(row['lon'], float)
+            if lat is None or lon is None or not (abs(lat) <= 90 and abs(lon) <= 180):
+                found['invalid_coordinates'].append(node_id)
+            else:
+                lat, lon = int(round(lat * SCALE)), int(round(lon * SCALE))
+                if not (south <= lat <= north and west <= lon <= east):
+                    found['outside_bbox'].append(node_id)
+                positions[(lat, lon)].append(node_id)
+            version = number(row['version'], int)
+            if version is None or version < 1:
+                found['invalid_version'].append(node_id)
+            uid = number(row['uid'], int)
+            if uid is None or uid < 0:
+                found['invalid_uid'].append(node_id)
+            timestamp = parse_timestamp(row['timestamp'])
+            if timestamp is None or not OSM_START <= timestamp <= until:
+                found['impossible_timestamp'].append(node_id)
+            elif uid is not None and uid >= 0:
+                edits_by_user[uid].append((timestamp, node_id))
+    groups = 0
+    for shared in positions.itervalues():
+        if len(shared) > 1:
+            found['duplicate_coordinates'].extend(shared)
+            groups += 1
+    users = {}
+    for uid, user_edits in edits_by_user.iteritems():
+        user_edits.sort()
+        end = 0
+        last = -1  # last index already flagged
+        peak = 0
+        flagged = 0
+        for i, (timestamp, node_id) in enumerate(user_edits):
+            end = max(end, i)
+            while end < len(user_edits) and user_edits[end][0] < timestamp + seconds:
+                end += 1
+            if end - i >= edits:
+                peak = max(peak, end - i)
+                for t, burst_id in user_edits[max(i, last + 1):end]:
+                    found['edit_burst'].append(burst_id)
+                    flagged += 1
+                last = max(last, end - 1)
+        if flagged:
+            users[uid] = (flagged, peak)
+    return dict((c, sorted(found[c])) for c in CHECKS), users, groups
+
+
+################################### Report ###################################################
+
+def write_ids(found, out):
+    with open(out, 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerow(['check', 'id'])
+        for c in CHECKS:
+            for node_id in found[c]:
+                writer.writerow([c, node_id])
+
+
+def print_report(found, users, groups, total, sample=SAMPLE_SIZE):
+    print '{0} nodes'.format(total)
+    print '{0:<24s} {1:>10s}  {2}'.format('check', 'nodes', 'ids')
+    for c in CHECKS:
+        ids = list(found[c][:sample])
+        print '{0:<24s} {1:>10d}  {2}{3}'.format(c, len(found[c]), ' '.join(map(str, ids)),
+                                                 ' ...' if len(found[c]) > sample else '')
+    print ' '
+    print '{0} positions shared by more than one node'.format(groups)
+    if users:
+        print 'Users with edit bursts (uid: nodes in bursts, most nodes within the window):'
+        for uid, (count, peak) in sorted(users.items(), key=lambda u: -u[1][0])[:sample]:
+            print '    {0:<12d} {1:>10d} {2:>10d}'.format(uid, count, peak)
+
+
+def benchmark(path, **options):
+    """Seconds to load and audit path with NumPy and row by row, and whether both found the
+    same"""
+    start = time.time()
+    nodes = load_csv(path)
+    loaded = time.time()
+    vectorized = audit(nodes, **options)
+    end = time.time()
+    rows = audit_rows(path, **options)
+    python = time.time() - end
+    same = all(list(vectorized[0][c]) == rows[0][c] for c in CHECKS) and \
+        vectorized[1:] == rows[1:]
+    return len(nodes['id']), loaded - start, end - loaded, python, same
+
+
+def parse_date(value):
+    return calendar.timegm(time.strptime(value, '%Y-%m-%d'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Vectorized sanity audit of the nodes')
+    parser.add_argument('path', nargs='?', default=NODES_PATH, help='nodes .csv file or '
+                                                                   'database')
+    parser.add_argument('--bbox', default=','.join(map(str, BBOX)),
+                        help='bounding box of the region: south,west,north,east')
+    parser.add_argument('--until', type=parse_date,
+                        help='latest valid timestamp, YYYY-MM-DD (default: now)')
+    parser.add_argument('--burst-edits', type=int, default=BURST_EDITS)
+    parser.add_argument('--burst-seconds', type=int, default=BURST_SECONDS)
+    parser.add_argument('--out', help='write every offending id to this .csv file')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='compare with the same audit row by row in Python')
+    args = parser.parse_args()
+    options = dict(bbox=[float(v) for v in args.bbox.split(',')],
+                   until=time.time() if args.until is None else args.until,
+                   edits=args.burst_edits, seconds=args.burst_seconds)
+    if args.benchmark:
+        total, load_s, audit_s, python_s, same = benchmark(args.path, **options)
+        print '{0} nodes'.format(total)
+        print 'NumPy:  {0:.2f}s to load, {1:.2f}s to audit'.format(load_s, audit_s)
+        print 'Python: {0:.2f}s row by row ({1:.1f}x slower){2}'.format(
+            python_s, python_s / (load_s + audit_s), '' if same else ' (results differ!)')
+    else:
+        start = time.time()
+        nodes = load(args.path)
+        found, users, groups = audit(nodes, **options)
+        print_report(found, users, groups, len(nodes['id']))
+        if args.out:
+            write_ids(found, args.out)
+        print 'Audited in {0:.2f}s'.format(time.time() - start)
@@ -0,0 +1,301 @@
+"""
+Runs the whole pipeline (clean -> check -> audit -> load -> areas -> index -> tiles -> graph ->
+query-report) for many metro extracts.
+
+The regions are read from a JSON manifest:
+
+    [{"name": "tampa", "osm": "tampa_florida.osm"},
+     {"name": "orlando", "osm": "orlando_florida.osm", "tile_zoom": 14,
+      "compression": "gzip"}]
+
+("tile_zoom" partitions the region in quadtiles, see quadtiles.py; "compression" writes its
+.csv files compressed with gzip or zstd, see compressed_csv.py; "vector_tiles": [10, 14]
+renders the vector tiles of those zooms to <name>.mbtiles, see vector_tiles.py; "hashes":
+true writes the content hash of every element to hashes.csv, see diff_builds.py; "profile"
+only keeps the elements and tags of a filter profile, see tag_profiles.py; "layout":
+"clustered" stores the tag and way-node tables as WITHOUT ROWID tables, see create_db.py;
+"tag_blobs": true also stores the tags of nodes and ways in their rows, see
+query_db.BLOB_QUERIES; "bbox": [south, west, north, east] is the bounding box the nodes are
+audited against, see audit_nodes.py.)
+
+Every region gets its own output directory (out_dir/<name>/) holding its .csv files, its
+database (<name>.db), the problems found in its nodes (node_audit.json), the areas of its
+multipolygons (areas.geojson, also in the table multipolygons) and a reports/ folder with one
+.csv per query of query_db.py. Regions are scheduled largest input first over a pool of workers
+whose size depends on the number of cores and on the memory available. A stage is skipped when
+the size and modification time of its inputs are the same as in its last successful run (see
+stages.json).
+
+Usage:
+    python batch_pipeline.py manifest.json [--out regions] [--workers N] [--force]
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import time
+
+import audit_nodes
+import check_integrity
+import clean_data
+import compressed_csv
+import create_db
+import make_a_view
+import multipolygons
+import query_db
+import street_graph
+import vector_tiles
+
+OUT_DIR = 'regions'
+STAMP_FILE = 'stages.json'
+CSV_FILES = [clean_data.NODES_PATH, clean_data.NODE_TAGS_PATH, clean_data.WAYS_PATH,
+             clean_data.WAY_NODES_PATH, clean_data.WAY_TAGS_PATH, clean_data.RELATIONS_PATH,
+             clean_data.RELATION_TAGS_PATH, clean_data.RELATION_MEMBERS_PATH,
+             clean_data.RAW_TAGS_PATH]
+
+# Peak memory of a region is dominated by create_db.py, which keeps a whole csv in a list.
+# A job is budgeted MEMORY_FACTOR times the size of its .osm file (and at least
+# MIN_JOB_MEMORY).
+MEMORY_FACTOR = 1.5
+MIN_JOB_MEMORY = 256 * 1024 ** 2
+
+
+################################### Stages ###################################################
+
+def region_paths(region, out_dir):
+    region_dir = os.path.join(out_dir, region['name'])
+    return {'dir': region_dir,
+            'csvs': [os.path.join(region_dir, f) +
+                     compressed_csv.CODECS.get(region.get('compression'), '')
+                     for f in CSV_FILES],
+            'db': os.path.join(region_dir, region['name'] + '.db'),
+            'integrity': os.path.join(region_dir, 'integrity.json'),
+            'node_audit': os.path.join(region_dir, 'node_audit.json'),
+            'areas': os.path.join(region_dir, 'areas.geojson'),
+            'mbtiles': os.path.join(region_dir, region['name'] + '.mbtiles'),
+            'graph': os.path.join(region_dir, street_graph.GRAPH_DIR),
+            'reports': os.path.join(region_dir, 'reports')}
+
+
+def run_clean(region, paths):
+    clean_data.process_map(region['osm'], validate=False, out_dir=paths['dir'],
+                           tile_zoom=region.get('tile_zoom'),
+                           compression=region.get('compression'),
+                           compress_level=region.get('compress_level'),
+                           hashes=region.get('hashes', False),
+                           profile=region.get('profile'),
+                           tag_blobs=region.get('tag_blobs', False))
+
+
+def run_check(region, paths):
+    """Counts the references to missing nodes and ways in the .csv files. Samples are full
+    of them, so they are reported in integrity.json instead of failing the region."""
+    results = check_integrity.check(paths['dir'])
+    report = dict(('{0}.{1} -> {2}.id'.format(*c), results[c]) for c in check_integrity.CHECKS)
+    with open(paths['integrity'], 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+
+def run_audit(region, paths):
+    """Counts of the nodes failing each check of audit_nodes.py, with a sample of their ids
+    and the users behind the edit bursts"""
+    nodes = audit_nodes.load_csv(os.path.join(paths['dir'], clean_data.NODES_PATH))
+    found, users, groups = audit_nodes.audit(nodes, bbox=region.get('bbox', audit_nodes.BBOX))
+    report = {'nodes': len(nodes['id']), 'shared_positions': groups,
+              'burst_users': dict((str(u), {'nodes': c, 'peak': p})
+                                  for u, (c, p) in users.items())}
+    for c in audit_nodes.CHECKS:
+        report[c] = {'count': len(found[c]),
+                     'sample': [int(i) for i in found[c][:audit_nodes.SAMPLE_SIZE]]}
+    with open(paths['node_audit'], 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+
+def run_load(region, paths):
+    create_db.create_db(paths['db'], csv_dir=paths['dir'],
+                        layout=region.get('layout', 'rowid'),
+                        tag_blobs=region.get('tag_blobs', False))
+
+
+def run_areas(region, paths):
+    areas, stats = multipolygons.build(region['osm'])
+    multipolygons.save(areas, paths['db'], paths['areas'])
+
+
+def run_index(region, paths):
+    create_db.create_indexes(paths['db'])
+    create_db.create_search_index(paths['db'])
+    create_db.create_address_table(paths['db'])
+    make_a_view.make_view(paths['db'])
+
+
+def run_tiles(region, paths):
+    if region.get('vector_tiles'):
+        min_zoom, max_zoom = region['vector_tiles']
+        # The regions already run in a process pool, whose workers can not have their own
+        # pool (daemonic processes can not have children), so the tiles are rendered
+        # in-process
+        vector_tiles.generate(paths['db'], paths['mbtiles'], min_zoom, max_zoom, workers=1)
+
+
+def run_graph(region, paths):
+    street_graph.StreetGraph.build(paths['db']).save(paths['graph'])
+
+
+def run_report(region, paths):
+    if not os.path.isdir(paths['reports']):
+        os.makedirs(paths['reports'])
+    for name in sorted(region.get('queries', query_db.QUERIES)):
+        df = query_db.run_query(query_db.QUERIES[name], paths['db'])
+        df.to_csv(os.path.join(paths['reports'], name + '.csv'), index=False,
+                  encoding='utf-8')
+
+
+# (name, function, inputs, outputs) in the order they have to run.
+STAGES = [
+    ('clean', run_clean, lambda r, p: [r['osm']], lambda r, p: p['csvs']),
+    ('check', run_check, lambda r, p: p['csvs'], lambda r, p: [p['integrity']]),
+    ('audit', run_audit, lambda r, p: p['csvs'][:1], lambda r, p: [p['node_audit']]),
+    ('load', run_load, lambda r, p: p['csvs'], lambda r, p: [p['db']]),
+    # Writes to the database too, so it runs before the indexes are stamped
+    ('areas', run_areas, lambda r, p: [r['osm']], lambda r, p: [p['areas']]),
+    ('index', run_index, lambda r, p: [p['db']], lambda r, p: [p['db']]),
+    ('tiles', run_tiles, lambda r, p: [p['db']],
+     lambda r, p: [p['mbtiles']] if r.get('vector_tiles') else []),
+    ('graph', run_graph, lambda r, p: [p['db']], lambda r, p: [p['graph']]),
+    ('report', run_report, lambda r, p: [p['db']], lambda r, p: [p['reports']]),
+]
+
+
+def fingerprint(paths):
+    """Size and modification time of every file in paths"""
+    d = {}
+    for path in paths:
+        st = os.stat(path)
+        d[path] = [st.st_size, st.st_mtime]
+    return d
+
+
+def load_stamps(region_dir):
+    try:
+        with open(os.path.join(region_dir, STAMP_FILE)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_stamps(region_dir, stamps):
+    with open(os.path.join(region_dir, STAMP_FILE), 'w') as f:
+        json.dump(stamps, f, indent=2, sort_keys=True)
+
+
+def run_region(job):
+    """Runs every stage of a region. Skips the stages whose inputs did not change since their
+    last run. Returns a summary dict with the time spent on each stage."""
+    region, out_dir, force = job
+    paths = region_paths(region, out_dir)
+    if not os.path.isdir(paths['dir']):
+        os.makedirs(paths['dir'])
+    stamps = load_stamps(paths['dir'])
+    summary = {'name': region['name'], 'stages': [], 'error': None}
+    changed = force
+    try:
+        for name, func, inputs, outputs in STAGES:
+            before = fingerprint(inputs(region, paths))
+            done = all(os.path.exists(p) for p in outputs(region, paths))
+            # A stage whose upstream stage ran again cannot be skipped either.
+            if not changed and done and stamps.get(name) == json.loads(json.dumps(before)):
+                summary['stages'].append((name, 'skipped', 0.0))
+                continue
+            start = time.time()
+            func(region, paths)
+            summary['stages'].append((name, 'done', time.time() - start))
+            # Indexing modifies its own input, so the stamp is taken after the run.
+            stamps[name] = fingerprint(inputs(region, paths))
+            save_stamps(paths['dir'], stamps)
+            changed = True
+    except Exception as e:
+        summary['error'] = '{0}: {1}'.format(type(e).__name__, e)
+    return summary
+
+
+################################### Scheduling ###############################################
+
+def available_memory():
+    """Available physical memory in bytes, None if it can not be found out"""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def job_memory(region):
+    return max(MIN_JOB_MEMORY, int(MEMORY_FACTOR * os.path.getsize(region['osm'])))
+
+
+def plan(regions, workers=None):
+    """Sorts the regions largest input first (the longest jobs start first, so the pool
+    finishes as evenly as possible) and chooses how many workers can run at the same time
+    without running out of cores or memory."""
+    regions = sorted(regions, key=lambda r: os.path.getsize(r['osm']), reverse=True)
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+        memory = available_memory()
+        if memory is not None and regions:
+            # Budget for the worst case: the largest jobs running all at once.
+            budget, fits = 0, 0
+            for region in regions[:workers]:
+                budget += job_memory(region)
+                if budget > memory:
+                    break
+                fits += 1
+            workers = max(1, fits)
+    return regions, max(1, min(workers, len(regions)))
+
+
+def run_batch(manifest, out_dir=OUT_DIR, workers=None, force=False):
+    with open(manifest) as f:
+        regions = json.load(f)
+    names = [r['name'] for r in regions]
+    if len(set(names)) != len(names):
+        raise ValueError('Region names in {0} must be unique'.format(manifest))
+    regions, workers = plan(regions, workers)
+    print 'Running {0} regions over {1} workers'.format(len(regions), workers)
+
+    start = time.time()
+    jobs = [(region, out_dir, force) for region in regions]
+    if workers == 1:
+        results = (run_region(job) for job in jobs)
+    else:
+        pool = multiprocessing.Pool(workers)
+        results = pool.imap_unordered(run_region, jobs, chunksize=1)
+
+    summaries = []
+    for summary in results:
+        summaries.append(summary)
+        stages = ', '.join('{0} {1} ({2:.1f}s)'.format(*s) for s in summary['stages'])
+        print '{0:.<30s}: {1}'.format(summary['name'], stages)
+        if summary['error']:
+            print '    FAILED: {0}'.format(summary['error'])
+    if workers > 1:
+        pool.close()
+        pool.join()
+    print 'Total time: {0:.1f}s'.format(time.time() - start)
+    return summaries
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the pipeline for many regions')
+    parser.add_argument('manifest', help='JSON list of {"name": ..., "osm": ...}')
+    parser.add_argument('--out', default=OUT_DIR, help='root of the region directories')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--force', action='store_true', help='rerun every stage')
+    args = parser.parse_args()
+    run_batch(args.manifest, args.out, args.workers, args.force)
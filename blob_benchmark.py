@@ -0,0 +1,171 @@
+"""
+Compares the queries of query_db.py that join the tag tables with their rewrites for tag
+blobs (query_db.BLOB_QUERIES), which read the tags from the row of the element: the generated
+columns of create_db.BLOB_COLUMNS, with their indexes, or the JSON object itself.
+
+Two databases are loaded from the same .csv files into a temporary directory, one without and
+one with tag blobs (the .csv files need a tag_blobs.csv, see clean_data.process_map), both
+with their indexes. The join runs on the first and the rewrite on the second:
+
+    python blob_benchmark.py [csv_dir] [--repeat 5]
+
+--check runs both on the small map of CHECK_OSM instead, whose tags are those a rewrite could
+miss (counties of another type than tiger, amenities and names of another type than regular,
+keys repeated in an element), and fails if any result differs:
+
+    python blob_benchmark.py --check
+"""
+import argparse
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+import clean_data
+import create_db
+from layout_benchmark import timed
+from query_db import BLOB_QUERIES, QUERIES
+
+REPEAT = 5
+CHECK_OSM = """<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6">
+ <node id="1" lat="27.9" lon="-82.5"
+  user="a" uid="1" version="1" changeset="1" timestamp="2016-01-01T00:00:00Z">
+  <tag k="amenity" v="restaurant"/>
+  <tag k="addr:street" v="Main St"/>
+  <tag k="tiger:county" v="Pinellas, FL"/>
+ </node>
+ <node id="2" lat="27.9" lon="-82.5"
+  user="a" uid="1" version="1" changeset="1" timestamp="2016-01-01T00:00:00Z">
+  <tag k="amenity" v="restaurant"/>
+  <tag k="amenity" v="cafe"/>
+  <tag k="addr:street" v="Main Street"/>
+  <tag k="gnis:county" v="Pasco"/>
+ </node>
+ <node id="3" lat="27.9" lon="-82.5"
+  user="a" uid="1" version="1" changeset="1" timestamp="2016-01-01T00:00:00Z">
+  <tag k="disused:amenity" v="restaurant"/>
+  <tag k="addr:street" v="Bay Street"/>
+  <tag k="is_in:county" v="Hillsborough"/>
+  <tag k="tiger:county" v="Hillsborough, FL"/>
+ </node>
+ <node id="4" lat="27.9" lon="-82.5"
+  user="a" uid="1" version="1" changeset="1" timestamp="2016-01-01T00:00:00Z">
+  <tag k="name" v="Oldsmar"/>
+  <tag k="population" v="13591"/>
+  <tag k="tiger:county" v="Pinellas, FL; Hillsborough, FL"/>
+ </node>
+ <node id="5" lat="27.9" lon="-82.5"
+  user="a" uid="1" version="1" changeset="1" timestamp="2016-01-01T00:00:00Z">
+  <tag k="name" v="Largo"/>
+  <tag k="name" v="City of Largo"/>
+  <tag k="population" v="82244"/>
+ </node>
+ <node id="6" lat="27.9" lon="-82.5"
+  user="a" uid="1" version="1" changeset="1" timestamp="2016-01-01T00:00:00Z">
+  <tag k="gnis:name" v="Dunedin"/>
+  <tag k="population" v="36068"/>
+  <tag k="amenity" v="restaurant"/>
+  <tag k="addr:street" v="100 Main Street, Tampa"/>
+ </node>
+ <way id="10"
+  user="a" uid="1" version="1" changeset="1" timestamp="2016-01-01T00:00:00Z">
+  <nd ref="1"/>
+  <nd ref="2"/>
+  <tag k="postal_code" v="33701"/>
+  <tag k="postal_code" v="33702"/>
+  <tag k="gnis:county" v="Pinellas"/>
+ </way>
+ <way id="11"
+  user="a" uid="1" version="1" changeset="1" timestamp="2016-01-01T00:00:00Z">
+  <nd ref="3"/>
+  <tag k="tiger:county" v="Pasco, FL"/>
+  <tag k="tiger:postal_code" v="33523"/>
+  <tag k="postal_code" v="33523"/>
+ </way>
+</osm>
+"""
+
+
+def build(csv_dir, path, tag_blobs):
+    """Seconds to load and index the database path"""
+    start = time.time()
+    create_db.create_db(path, csv_dir=csv_dir, tag_blobs=tag_blobs)
+    create_db.create_indexes(path)
+    return time.time() - start
+
+
+def build_both(csv_dir, tmp):
+    """Paths of the databases without and with tag blobs built in tmp, and their load times"""
+    paths = [os.path.join(tmp, 'joins.db'), os.path.join(tmp, 'blobs.db')]
+    loads = [build(csv_dir, path, tag_blobs) for path, tag_blobs in zip(paths, [False, True])]
+    return paths, loads
+
+
+def check():
+    """{query: whether the rewrite gives the result of the join} on CHECK_OSM"""
+    tmp = tempfile.mkdtemp()
+    try:
+        osm = os.path.join(tmp, 'check.osm')
+        with open(osm, 'w') as f:
+            f.write(CHECK_OSM)
+        clean_data.process_map(osm, False, tmp, tag_blobs=True)
+        joins, blobs = [sqlite3.connect(path) for path in build_both(tmp, tmp)[0]]
+        same = dict((name, sorted(joins.execute(QUERIES[name]).fetchall()) ==
+                     sorted(blobs.execute(BLOB_QUERIES[name]).fetchall()))
+                    for name in BLOB_QUERIES)
+        joins.close()
+        blobs.close()
+        return same
+    finally:
+        shutil.rmtree(tmp)
+
+
+def benchmark(csv_dir='', repeat=REPEAT):
+    tmp = tempfile.mkdtemp()
+    try:
+        paths, loads = build_both(csv_dir, tmp)
+        sizes = [os.path.getsize(path) for path in paths]
+        joins, blobs = [sqlite3.connect(path) for path in paths]
+        rows = []
+        for name in sorted(BLOB_QUERIES):
+            join_ms, join_result = timed(joins, QUERIES[name], repeat)
+            blob_ms, blob_result = timed(blobs, BLOB_QUERIES[name], repeat)
+            plan = blobs.execute('EXPLAIN QUERY PLAN ' + BLOB_QUERIES[name]).fetchall()
+            rows.append((name, join_ms, blob_ms, sorted(join_result) == sorted(blob_result),
+                         '; '.join(r[-1] for r in plan)))
+        joins.close()
+        blobs.close()
+        return loads, sizes, rows
+    finally:
+        shutil.rmtree(tmp)
+
+
+def print_report(loads, sizes, rows):
+    print '{0:<10s} {1:>10s} {2:>10s} {3:>8s}  {4}'.format('query', 'join (ms)', 'blob (ms)',
+                                                           'speedup', 'plan of the rewrite')
+    for name, join_ms, blob_ms, same, plan in rows:
+        print '{0:<10s} {1:>10.2f} {2:>10.2f} {3:>7.1f}x  {4}{5}'.format(
+            name, join_ms, blob_ms, join_ms / max(blob_ms, 1e-6), plan,
+            '' if same else ' (differs!)')
+    print ' '
+    print 'Load + indexes: {0:.2f}s without tag blobs, {1:.2f}s with them'.format(*loads)
+    print 'Database size: {0:.1f} MB without tag blobs, {1:.1f} MB with them'.format(
+        *[s / 1024.0 ** 2 for s in sizes])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Self-joins of the tag tables vs tag blobs')
+    parser.add_argument('csv_dir', nargs='?', default='')
+    parser.add_argument('--repeat', type=int, default=REPEAT, help='runs of every query')
+    parser.add_argument('--check', action='store_true',
+                        help='compare the results on CHECK_OSM instead of timing')
+    args = parser.parse_args()
+    if args.check:
+        same = check()
+        for name in sorted(same):
+            print '{0:<10s} {1}'.format(name, 'same' if same[name] else 'differs!')
+        sys.exit(0 if all(same.values()) else 1)
+    print_report(*benchmark(args.csv_dir, args.repeat))
@@ -0,0 +1,299 @@
+"""
+Referential-integrity check of the .csv files written by clean_data.py or of a database
+built from them. create_db.py declares FOREIGN KEY constraints but SQLite does not enforce
+them unless PRAGMA foreign_keys is on, so dangling references (very common in the samples of
+create_sample_osm.py) go unnoticed.
+
+Every reference of CHECKS is tested against the set of ids of its parent table. The set is
+held in NumPy, as a bitmap over the range of ids when the ids are dense or as a sorted array
+when they are sparse, whichever is smaller. When it does not fit in half the memory budget
+the range of ids is split into windows that do, and the files (or tables) are read once per
+window, so the memory used stays the same however many ids there are. The distinct orphan
+ids of a window are kept in the other half (a window with too many is split as well); the
+first and last windows also take the references below and above the range of parent ids.
+
+Usage:
+    python check_integrity.py TampaFlorida.db
+    python check_integrity.py regions/tampa/ --memory 64
+"""
+import argparse
+import csv
+import os
+import sqlite3
+import time
+
+import numpy as np
+
+from compressed_csv import csv_exists, open_csv
+
+database = "TampaFlorida.db"
+MEMORY = 256 * 1024 ** 2  # bytes for the id set of a window
+CHUNK_SIZE = 1000000  # ids read at a time
+SAMPLE_SIZE = 10  # orphan ids reported per check
+
+# (child table, column, parent table): every child.column has to be a parent.id
+CHECKS = [
+    ('ways_nodes', 'node_id', 'nodes'),
+    ('nodes_tags', 'id', 'nodes'),
+    ('ways_nodes', 'id', 'ways'),
+    ('ways_tags', 'id', 'ways'),
+    ('relations_tags', 'id', 'relations'),
+    ('relations_members', 'id', 'relations'),
+]
+
+
+def id_chunks(source, table, column, lo=None, hi=None, chunk_size=CHUNK_SIZE):
+    """Yields the values of table.column between lo (included) and hi (excluded) as int64
+    arrays. source is a database file or a directory with the .csv files of clean_data.py
+    (plain or compressed)"""
+    if os.path.isdir(source):
+        if not csv_exists(os.path.join(source, table + '.csv')):
+            return  # relations of .csv files written before they were kept
+        with open_csv(os.path.join(source, table + '.csv')) as f:
+            reader = csv.reader(f)
+            index = next(reader).index(column)
+            chunk = []
+            for row in reader:
+                chunk.append(row[index])
+                if len(chunk) == chunk_size:
+                    ids = np.array(chunk, dtype=np.int64)
+                    chunk = []
+                    yield ids if lo is None else ids[(ids >= lo) & (ids < hi)]
+            if chunk:
+                ids = np.array(chunk, dtype=np.int64)
+                yield ids if lo is None else ids[(ids >= lo) & (ids < hi)]
+    else:
+        con = sqlite3.connect(source)
+        if lo is None:
+            cur = con.execute('SELECT {0} FROM {1};'.format(column, table))
+        else:
+            cur = con.execute('SELECT {0} FROM {1} WHERE {0} >= ? AND {0} < ?;'.format(
+                column, table), (lo, hi))
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield np.array(rows, dtype=np.int64).reshape(-1)
+        con.close()
+
+
+def id_range(source, table, chunk_size=CHUNK_SIZE):
+    """(smallest id, largest id, number of ids) of a parent table"""
+    if not os.path.isdir(source):
+        con = sqlite3.connect(source)
+        lo, hi, count = con.execute('SELECT MIN(id), MAX(id), COUNT(*) FROM {0};'.format(
+            table)).fetchone()
+        con.close()
+        return lo, hi, count
+    lo, hi, count = None, None, 0
+    for ids in id_chunks(source, table, 'id', chunk_size=chunk_size):
+        if len(ids):
+            lo = int(ids.min()) if lo is None else min(lo, int(ids.min()))
+            hi = int(ids.max()) if hi is None else max(hi, int(ids.max()))
+            count += len(ids)
+    return lo, hi, count
+
+
+class BitmapIdSet(object):
+    """One bit per id of the window [lo, hi)"""
+
+    def __init__(self, lo, hi):
+        self.lo = lo
+        self.hi = hi
+        self.bits = np.zeros((hi - lo + 7) // 8, dtype=np.uint8)
+
+    def add(self, ids):
+        offsets = ids - self.lo
+        positions = offsets & 7
+        # One pass per bit position: repeated bytes within a pass get the same value, so
+        # fancy indexing is safe (and much faster than np.bitwise_or.at)
+        for bit in range(8):
+            selected = offsets[positions == bit] >> 3
+            self.bits[selected] |= np.uint8(1 << bit)
+
+    def contains(self, ids):
+        inside = (ids >= self.lo) & (ids < self.hi)
+        offsets = np.where(inside, ids - self.lo, 0)
+        return inside & ((self.bits[offsets >> 3] >> (offsets & 7).astype(np.uint8)) & 1 == 1)
+
+
+class SortedIdSet(object):
+    """The ids of the window in a sorted array, searched with a binary search"""
+
+    def __init__(self):
+        self.chunks = []
+        self.ids = None
+
+    def add(self, ids):
+        self.chunks.append(ids)
+
+    def freeze(self):
+        self.ids = np.concatenate(self.chunks) if self.chunks else np.zeros(0, np.int64)
+        self.chunks = []
+        self.ids.sort()
+
+    def contains(self, ids):
+        if not len(self.ids):
+            return np.zeros(len(ids), dtype=bool)
+        positions = np.minimum(np.searchsorted(self.ids, ids), len(self.ids) - 1)
+        return self.ids[positions] == ids
+
+
+class OrphanIds(object):
+    """Distinct orphan ids: the sorted unique ids of every chunk, merged into one sorted array
+    once they hold as many ids as it (so every id is merged a logarithmic number of times)"""
+
+    def __init__(self):
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.pending = []
+        self.pending_size = 0
+
+    def add(self, ids):
+        ids = np.unique(ids)
+        self.pending.append(ids)
+        self.pending_size += len(ids)
+        if self.pending_size >= len(self.ids):
+            self.merge()
+
+    def merge(self):
+        self.ids = np.unique(np.concatenate([self.ids] + self.pending))
+        self.pending = []
+        self.pending_size = 0
+
+    def nbytes(self):
+        # twice the ids while they are being merged
+        return (len(self.ids) + self.pending_size) * 8 * 2
+
+    def freeze(self):
+        self.merge()
+        return self.ids
+
+
+def plan_windows(lo, hi, count, memory=MEMORY):
+    """Chooses the kind of id set and splits [lo, hi] into windows whose set fits in memory"""
+    span = hi - lo + 1
+    bitmap_bytes = (span + 7) // 8
+    # A sorted array needs twice its size while it is being built
+    array_bytes = count * 8 * 2
+    kind = 'bitmap' if bitmap_bytes <= array_bytes else 'sorted'
+    passes = max(1, -(-min(bitmap_bytes, array_bytes) // memory))
+    step = -(-span // passes)
+    return kind, [(lo + i * step, min(hi + 1, lo + (i + 1) * step)) for i in range(passes)]
+
+
+def build_set(source, table, kind, lo, hi, memory=MEMORY, chunk_size=CHUNK_SIZE):
+    """The id set of the window [lo, hi) of a parent table. None if a sorted array turns out
+    not to fit in memory (the ids are not spread evenly), so the window has to be split."""
+    if kind == 'bitmap':
+        id_set = BitmapIdSet(lo, hi)
+        for ids in id_chunks(source, table, 'id', lo, hi, chunk_size):
+            id_set.add(ids)
+        return id_set
+    id_set = SortedIdSet()
+    size = 0
+    for ids in id_chunks(source, table, 'id', lo, hi, chunk_size):
+        size += len(ids) * 8 * 2
+        if size > memory and hi - lo > 1:
+            return None
+        id_set.add(ids)
+    id_set.freeze()
+    return id_set
+
+
+def check_window(source, children, id_set, lo, hi, memory=MEMORY, chunk_size=CHUNK_SIZE):
+    """([(rows, orphan rows, sorted distinct orphan ids)] of every (child, column) of
+    children for the references in [lo, hi), id_set holding the parent ids among them (None
+    for none), None). (None, orphan ids seen) if the distinct orphan ids do not fit in
+    memory, so the window has to be split."""
+    found = []
+    for child, column in children:
+        rows = orphans = 0
+        distinct = OrphanIds()
+        for ids in id_chunks(source, child, column, lo, hi, chunk_size):
+            rows += len(ids)
+            missing = ids if id_set is None else ids[~id_set.contains(ids)]
+            if len(missing):
+                orphans += len(missing)
+                distinct.add(missing)
+                if distinct.nbytes() > memory and hi - lo > 1:
+                    return None, distinct.freeze()
+        found.append((rows, orphans, distinct.freeze()))
+    return found, None
+
+
+def split_points(lo, hi, seen=None):
+    """Ids that split the window [lo, hi) in smaller ones: the quartiles of the orphan ids
+    seen (the window may span most of the int64 range while they are close together), or
+    its middle"""
+    if seen is not None and len(seen):
+        points = sorted(set(int(seen[len(seen) * k // 4]) for k in (1, 2, 3)) - set([lo]))
+        if points:
+            return points
+    return [lo + (hi - lo) // 2]
+
+
+def check(source, memory=MEMORY, chunk_size=CHUNK_SIZE):
+    """Checks every reference of CHECKS. Returns a dict per check with the number of rows,
+    of orphan rows, of distinct orphan ids and a sample of them."""
+    start = time.time()
+    results = dict(((child, column, parent), {'rows': 0, 'orphans': 0, 'orphan_ids': 0,
+                                              'sample': []})
+                   for child, column, parent in CHECKS)
+    half = max(1, memory // 2)  # for the id set of a window, the other half for its orphans
+    for parent in sorted(set(p for c, col, p in CHECKS)):
+        children = [(c, col) for c, col, p in CHECKS if p == parent]
+        lo, hi, count = id_range(source, parent, chunk_size)
+        if lo is None:
+            # Empty parent table: every reference is an orphan
+            lo, hi, count = 0, 0, 0
+        kind, windows = plan_windows(lo, hi, count, half)
+        # The references below and above the range of parent ids are orphans too: they are
+        # read with the first and the last window
+        windows[0] = (-2 ** 63, windows[0][1])
+        windows[-1] = (windows[-1][0], 2 ** 63 - 1)
+        while windows:
+            w_lo, w_hi = windows.pop(0)
+            set_lo, set_hi = max(w_lo, lo), min(w_hi, hi + 1)
+            id_set = None
+            found = seen = None
+            if set_lo < set_hi:
+                id_set = build_set(source, parent, kind, set_lo, set_hi, half, chunk_size)
+            if id_set is not None or set_lo >= set_hi:
+                found, seen = check_window(source, children, id_set, w_lo, w_hi, half,
+                                           chunk_size)
+            del id_set
+            if found is None:
+                bounds = [w_lo] + split_points(w_lo, w_hi, seen) + [w_hi]
+                windows[:0] = zip(bounds[:-1], bounds[1:])
+                continue
+            for (child, column), (rows, orphans, distinct) in zip(children, found):
+                result = results[(child, column, parent)]
+                result['rows'] += rows
+                result['orphans'] += orphans
+                result['orphan_ids'] += len(distinct)
+                result['sample'].extend(int(i) for i in
+                                        distinct[:SAMPLE_SIZE - len(result['sample'])])
+    results['seconds'] = time.time() - start
+    return results
+
+
+def print_results(results):
+    for child, column, parent in CHECKS:
+        r = results[(child, column, parent)]
+        print '{0:.<30s}: {1:>10d} rows {2:>10d} orphans ({3} distinct ids){4}'.format(
+            '{0}.{1} -> {2}.id'.format(child, column, parent), r['rows'], r['orphans'],
+            r['orphan_ids'],
+            ', e.g. ' + ', '.join(str(i) for i in r['sample']) if r['sample'] else '')
+    print 'Checked in {0:.2f}s'.format(results['seconds'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Find references to missing nodes and ways')
+    parser.add_argument('source', nargs='?', default=database,
+                        help='database file or directory with the .csv files')
+    parser.add_argument('--memory', type=int, default=MEMORY // 1024 ** 2,
+                        help='memory for the id sets, in MB')
+    args = parser.parse_args()
+    if args.memory < 1:
+        parser.error('--memory has to be at least 1 MB')
+    print_results(check(args.source, args.memory * 1024 ** 2))
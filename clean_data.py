@@ -159,6 +159,9 @@ The final return value for a "way" element should look something like:
 
 import csv
 import codecs
+import hashlib
+import json
+import os
 import pprint
 import re
 import xml.etree.cElementTree as ET
@@ -166,14 +169,24 @@ import xml.etree.cElementTree as ET
 import cerberus
 
 import schema
+from compressed_csv import open_output
+from tag_profiles import load_profile
 
 OSM_PATH = "tampa_florida.osm"
+RULES_PATH = "clean_rules.json"  # optional, see load_rules
 
 NODES_PATH = "nodes.csv"
 NODE_TAGS_PATH = "nodes_tags.csv"
 WAYS_PATH = "ways.csv"
 WAY_NODES_PATH = "ways_nodes.csv"
 WAY_TAGS_PATH = "ways_tags.csv"
+RAW_TAGS_PATH = "raw_tags.csv"
+TILES_PATH = "tiles.csv"
+RELATIONS_PATH = "relations.csv"
+RELATION_TAGS_PATH = "relations_tags.csv"
+RELATION_MEMBERS_PATH = "relations_members.csv"
+HASHES_PATH = "hashes.csv"
+TAG_BLOBS_PATH = "tag_blobs.csv"
 
 # By introducing a slight modification in the patterns a lot more of data can be included
 #LOWER = re.compile(r'^([a-z]|_)*$')
@@ -195,6 +208,24 @@ comma_patt = re.compile(r'^\d+,\d+$')
 
 state_roads_patt = re.compile(r'^((SR)|(FL))[\s-]', re.IGNORECASE)
 
+expected = ["Street", "Avenue", "Boulevard", "Drive", "Court", "Place",
+            "Square", "Lane", "Road", "Trail", "Parkway", "Commons", "Way", "Terrace",
+            "Circle", "Highway", "Bayway", "Causeway", "Loop"]
+mapping = {"St": "Street", "St.": "Street", "Ave": "Avenue", "Rd.": "Road",
+           "Blvd": "Boulevard", "Blvd.": "Boulevard", "Dr": "Drive", "Dr.": "Drive",
+           "Ct": "Court", "Cswy": "Causeway", "Pkwy": "Parkway", "Av": "Avenue",
+           "AVE": "Avenue", "Ave.": "Avenue", "Pky": "Parkway", "drive": "Drive",
+           "lane": "Lane", "road": "Road", "st": "Street", "Cir": "Circle",
+           "Bolevard": "Boulevard", "Hwy": "Highway", "Ln": "Lane", "Notth": "North",
+           "Rd": "Road", "HWY": "Highway"}
+
+# Misspelled or abbreviated city names (once capitalized by fix_city_names)
+CITY_FIXES = {'St. Petersburg': 'Saint Petersburg', 'St Petersbug': 'Saint Petersburg',
+              'St Petersburg': 'Saint Petersburg', 'St Petersburg ': 'Saint Petersburg',
+              'St. Petersburg, Fl': 'Saint Petersburg', 'Land O Lakes, Fl': "Land O' Lakes",
+              'Land O Lakes': "Land O' Lakes", 'Tampa Bay': 'Tampa',
+              'Palm Harbor, Fl.': 'Palm Harbor', 'Clearwarer Beach': 'Clearwater Beach'}
+
 cardinals = ['North','South', 'East', 'West', 'Northeast', 'Northwest', 'Southeast',
                  'Southwest', 'N', 'S', 'E', 'W', 'NE', 'NW', 'SE', 'SW']
 
@@ -206,6 +237,22 @@ NODE_TAGS_FIELDS = ['id', 'key', 'value', 'type']
 WAY_FIELDS = ['id', 'user', 'uid', 'version', 'changeset', 'timestamp']
 WAY_TAGS_FIELDS = ['id', 'key', 'value', 'type']
 WAY_NODES_FIELDS = ['id', 'node_id', 'position']
+RELATION_FIELDS = ['id', 'user', 'uid', 'version', 'changeset', 'timestamp']
+RELATION_TAGS_FIELDS = ['id', 'key', 'value', 'type']
+RELATION_MEMBERS_FIELDS = ['id', 'member_type', 'member_id', 'role', 'position']
+# Tags as found in the .osm file, before any cleaning (see reclean.py)
+RAW_TAGS_FIELDS = ['element', 'id', 'k', 'v']
+# Content hash of every element and the cleaning rules that changed its tags
+# (see diff_builds.py)
+HASHES_FIELDS = ['element', 'id', 'hash', 'rules']
+# All the shaped tags of a node or way as one JSON object (see create_db(..., tag_blobs=True))
+TAG_BLOBS_FIELDS = ['element', 'id', 'tags']
+# Keys also found in a tag blob by the key alone, whatever their type (see tag_blob). They are
+# the generated columns of create_db.py.
+BLOB_KEYS = ['amenity', 'name', 'street', 'u_street', 'postcode', 'postal_code', 'population',
+             'county', 'county1']
+# Quadtile of every element when process_map is given a tile_zoom (see quadtiles.py)
+TILES_FIELDS = ['element', 'tile', 'id', 'zoom']
 
 ################################### MY FUNCTIONS #############################################
 
@@ -338,10 +385,6 @@ def strip_cardinals(name):
 
 def fix_city_names(name):
 
-    saint_pete_fixlist = ['St. Petersburg', 'St Petersbug',
-                      'St Petersburg', 'St Petersburg ', 'St. Petersburg, Fl']
-    land_o_lakes_fixlist = ['Land O Lakes, Fl', 'Land O Lakes']
-
     name_list = name.split()
     if len(name_list) == 1:
         name = name.capitalize().strip()
@@ -350,18 +393,7 @@ def fix_city_names(name):
     else:
         name = 'FIXME'
 
-    if name in saint_pete_fixlist:
-        name = 'Saint Petersburg'
-    elif name in land_o_lakes_fixlist:
-        name = "Land O' Lakes"
-    elif name == 'Tampa Bay':
-        name = 'Tampa'
-    elif name == 'Palm Harbor, Fl.':
-        name = 'Palm Harbor'
-    elif name == 'Clearwarer Beach':
-        name = 'Clearwater Beach'
-
-    return name
+    return CITY_FIXES.get(name, name)
 
 def fix_county_name(name):
     """ Returns a list with the name(s) of the county(ies) that appeared in name"""
@@ -385,226 +417,303 @@ def update_name(name, mapping):
         name = re.sub(pat,mapping.get(pat), name)
     return name
 
+def fix_street_name(name):
+    """Returns the long street name and the unique street name (without leading or trailing
+    cardinals) for a street name that has already been split from its suite and homenumber"""
+    street_type = re.search(street_type_re, name).group()
+    if street_type not in expected:
+        long_street_name = update_name_2(update_name(name, mapping), mapping)
+    else:
+        long_street_name = update_name_2(name, mapping)
+    return long_street_name, strip_cardinals(long_street_name)
+
+
+################################### CLEANING RULES ###########################################
+# shape_element does not test keys and element ids one by one: it looks them up in the tables
+# below. They can be extended or overridden from a JSON file (see load_rules and dump_rules).
+
+ADDR_KEYS = ['city', 'postcode', 'state', 'country']
+
+# Keys that are not simply split at the first colon into type:key
+# Cleaning census and source to avoid the overwriting of existing 'population' keys
+KEY_RENAMES = {'census:population': ('census', 'year'),
+               'source:population': ('refpopulation', 'source')}
+
+# (key, value) -> key, for values stored under the wrong key
+VALUE_OVERRIDES = {('postal_code', '(813) 643-1700'): 'phone'}  # Fixing a particular mistake
+
+# Nodes left out of the output
+DROPPED_NODES = set(['2061928287'])  # Bowling alley out of business with problematic zip code
+
+_key_cache = {}
+
+
+def classify_key(k):
+    """Returns (lowercase k, key, type) for the "k" attribute of a tag or None if the tag has
+    to be ignored. Every distinct k goes through the regular expressions only once."""
+    try:
+        return _key_cache[k]
+    except KeyError:
+        pass
+
+    s = k.lower()
+    if re.search(LOWER, s):
+        # 'fixme' keeps consistency with 'fixme: ...' in LOWER_COLON.
+        result = (s, s, 'fixme' if 'fixme' in s else 'regular')
+    elif re.search(LOWER_COLON, s):
+        result = (s, s[s.find(':')+1:], s[: s.find(':')])
+    # Fixing a particular case of problemchars
+    elif re.search(SPACE_PROBLEMCHARS, s):
+        result = (s, re.sub(r'\s', char_repl, s), 'regular')
+    #Including the last two items:
+    elif re.search(DASH, s):
+        result = (s, re.sub(r'\-', char_repl, s), 'regular')
+    else:
+        result = None
+
+    if result is not None and s in KEY_RENAMES:
+        result = (s,) + tuple(KEY_RENAMES[s])
+    _key_cache[k] = result
+    return result
+
+
+def new_tags(element_id, tag_type, keys, values, tags):
+    for key, value in zip(keys, values):
+        tags.append({'id': element_id, 'key': key, 'value': value, 'type': tag_type})
+
+
+def clean_population(tag_att, val, element_id, tags):
+    """Fix for some population numbers with thousand separator"""
+    val = val.strip()
+    if re.search(comma_patt, val):
+        val = val[:val.find(',')]+val[val.find(',')+1:]
+    tag_att['value'] = val
+
+
+def clean_census(tag_att, val, element_id, tags):
+    tag_att['value'] = val.split(';')[1]
+
+
+def patch_street_city_zip(val, element_id, tags):
+    """'<street>, <city> <zip>' -> street, plus city, postcode, state and country tags"""
+    my_values = val.split(',')
+    y = my_values[1].split() # splits up the city and the zip code
+    my_values[1] = y[0]
+    val = my_values.pop(0) # New street name, contains homenumber
+    my_values.append(y[1])
+    my_values.append('FL')
+    my_values.append('US')
+    new_tags(element_id, 'addr', ADDR_KEYS, my_values, tags)
+    return val
+
+
+def patch_street_city(val, element_id, tags):
+    """'<street> St <city>, ...' -> street, plus city, state and country tags (the zip code
+    already exists)"""
+    my_values = val.split(',')
+    a = my_values[0][:my_values[0].find('St')].strip()
+    b = my_values[0][my_values[0].find('St'):].strip()
+    my_values[0] = a
+    my_values[1] = b
+    my_values.append('00000')
+    my_values.append('FL')
+    my_values.append('US')
+    val = my_values.pop(0)
+    new_tags(element_id, 'addr', ADDR_KEYS[:1] + ADDR_KEYS[2:], my_values[:1] + my_values[2:],
+             tags)
+    return val
+
+
+# Fixes for single elements whose addr:street holds a whole address, by element id
+STREET_PATCHES = {'1029614792': patch_street_city_zip,
+                  '2266845486': patch_street_city}
+
+
+def clean_street(tag_att, val, element_id, tags):
+    # Cleaning for 'suite' in street names
+    if ' suite' in val.lower() or '#' in val.lower() :
+        addr_dict = split_suite(val)
+        suite_dict = fix_suite(val)
+        suite_dict['id'] = element_id
+        tags.append(suite_dict)
+
+        val = addr_dict['name']
+
+    ######### This is a fix for two nodes with german names. ###########
+    elif 'Vereinigte Staaten' in val:
+        my_values = val.split(',')
+        y = my_values[2].split() # splits up FL and the zip code
+        my_values[2]= y[1]
+        val = my_values.pop(0) # New street name, contains homenumber
+        my_values.pop()
+        my_values.append(y[0])
+        my_values.append('US')
+        new_tags(element_id, 'addr', ADDR_KEYS, my_values, tags)
+
+    elif element_id in STREET_PATCHES:
+        val = STREET_PATCHES[element_id](val, element_id, tags)
+
+    #Cleaning for home numbers in street names
+    if re.search(homenumber_re, val):
+        h_dict = split_homenumber(val)
+        new_tags(element_id, 'addr', ['homenumber'], [h_dict['homenumber']], tags)
+        val = h_dict['name']
+
+    #Cleaning for oversimplified street names
+    if re.search(street_type_re, val):
+        #Creating a new tag to unify the street names (same street names
+        # without leading or trailing cardinals)
+        long_street_name, unique_name = fix_street_name(val)
+        tag_att['value'] = long_street_name
+        new_tags(element_id, 'addr', ['u_street'], [unique_name], tags)
+
+
+def clean_housenumber(tag_att, val, element_id, tags):
+    # More cleaning for suites
+    if  ' suite' in val.lower():
+        addr_dict = split_suite(val)
+        suite_dict = fix_suite(val)
+        suite_dict['id'] = element_id
+        tags.append(suite_dict)
+
+        tag_att['value'] = addr_dict['name']
+
+
+def clean_postcode(tag_att, val, element_id, tags):
+    if not re.search(zip_tampa, val):
+        tag_att['value'] = fix_zipcodes(val)
+
+
+def clean_city(tag_att, val, element_id, tags):
+    tag_att['value'] = fix_city_names(val)
+
+
+def clean_county(tag_att, val, element_id, tags):
+    extra_counties ={}
+    county_names = fix_county_name(val)
+    tag_att['value'] = county_names[0]
+    if len(county_names) > 1:
+        del county_names[0]
+        extra_counties['id'] = element_id
+        extra_counties['type'] = 'tiger'
+        for i, name in enumerate(county_names):
+            extra_counties['key'] = 'county' + str(i + 1)
+            extra_counties['value'] = name
+            tags.append(extra_counties)
+
+
+# Rules and patches by the name used for them in a rules file
+RULES = {'population': clean_population, 'census': clean_census, 'street': clean_street,
+         'housenumber': clean_housenumber, 'postcode': clean_postcode, 'city': clean_city,
+         'county': clean_county}
+PATCHES = {'street_city_zip': patch_street_city_zip, 'street_city': patch_street_city}
+RULE_NAMES = dict((f, name) for name, f in RULES.items())
+
+# Full (lowercase) tag key -> cleaning rule
+KEY_RULES = {'population': clean_population,
+             'census:population': clean_census,
+             'addr:street': clean_street,
+             'addr:housenumber': clean_housenumber,
+             'addr:postcode': clean_postcode,
+             'addr:city': clean_city,
+             'tiger:county': clean_county}
+
+
+def load_rules(path):
+    """Updates the cleaning tables with those of a JSON file like the one written by
+    dump_rules. Dicts are merged into the current ones, "expected" replaces the list and a
+    rule set to null removes the rule of that key."""
+    with open(path) as f:
+        config = json.load(f)
+
+    mapping.update(config.get('mapping', {}))
+    if 'expected' in config:
+        expected[:] = config['expected']
+    CITY_FIXES.update(config.get('city_names', {}))
+    for s, key_type in config.get('key_renames', {}).items():
+        KEY_RENAMES[s] = tuple(key_type)
+    for s, name in config.get('key_rules', {}).items():
+        if name is None:
+            KEY_RULES.pop(s, None)
+        else:
+            KEY_RULES[s] = RULES[name]
+    for s, val, key in config.get('value_overrides', []):
+        VALUE_OVERRIDES[(s, val)] = key
+    for element_id, name in config.get('street_patches', {}).items():
+        STREET_PATCHES[element_id] = PATCHES[name]
+    DROPPED_NODES.update(config.get('dropped_nodes', []))
+    _key_cache.clear()
+
+
+def dump_rules(path):
+    """Writes the current cleaning tables to a JSON file that load_rules can read back"""
+    names = dict((f, name) for name, f in RULES.items() + PATCHES.items())
+    config = {'mapping': mapping,
+              'expected': expected,
+              'city_names': CITY_FIXES,
+              'key_renames': KEY_RENAMES,
+              'key_rules': dict((s, names[f]) for s, f in KEY_RULES.items()),
+              'value_overrides': sorted([s, val, key]
+                                        for (s, val), key in VALUE_OVERRIDES.items()),
+              'street_patches': dict((i, names[f]) for i, f in STREET_PATCHES.items()),
+              'dropped_nodes': sorted(DROPPED_NODES)}
+    with open(path, 'w') as f:
+        json.dump(config, f, indent=2, sort_keys=True)
+
+
+def shape_tag(k, v, element_id, fired=None, profile=None):
+    """Cleaned tags (dicts) of a single tag of an element: the extra tags that its cleaning
+    produces followed by the tag itself. An empty list if the tag has to be ignored, or is
+    not kept by profile (see tag_profiles.py). The names of the rules that changed the tag are
+    added to the set fired, if given."""
+    key_type = classify_key(k)
+    if key_type is None:
+        return []
+
+    tags = []
+    s, key, tag_type = key_type
+    if profile is not None and not profile.keep(s, tag_type):
+        return tags
+    tag_att = {'id': element_id, 'key': VALUE_OVERRIDES.get((s, v), key), 'value': v,
+               'type': tag_type}
+    rule = KEY_RULES.get(s)
+    if rule is not None:
+        rule(tag_att, v, element_id, tags)
+    if fired is not None:
+        if s in KEY_RENAMES:
+            fired.add('key_renames')
+        if (s, v) in VALUE_OVERRIDES:
+            fired.add('value_overrides')
+        if rule is not None and (tags or tag_att['value'] != v):
+            fired.add(RULE_NAMES.get(rule, rule.__name__))
+    tags.append(tag_att)
+    return tags
+
 
 def shape_element(element, node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIELDS,
-                  problem_chars=PROBLEMCHARS, default_tag_type='regular'):
-    """Clean and shape node or way XML element to Python dict"""
+                  problem_chars=PROBLEMCHARS, default_tag_type='regular', fired=None,
+                  profile=None):
+    """Clean and shape node, way or relation XML element to Python dict. The names of the
+    cleaning rules that changed its tags are added to the set fired, if given. None if the
+    element is dropped (see DROPPED_NODES and tag_profiles.py)."""
 
     node_attribs = {}
     way_attribs = {}
     way_nodes = []
-    tags = []  # Handle secondary tags the same way for both node and way elements
+    tags = []  # Handle secondary tags the same way for nodes, ways and relations
 
-    # YOUR CODE HERE
-    expected = ["Street", "Avenue", "Boulevard", "Drive", "Court", "Place",
-            "Square", "Lane", "Road", "Trail", "Parkway", "Commons", "Way", "Terrace",
-            "Circle", "Highway", "Bayway", "Causeway", "Loop"]
-    mapping = {"St": "Street", "St.": "Street", "Ave": "Avenue", "Rd.": "Road",
-            "Blvd": "Boulevard", "Blvd.": "Boulevard", "Dr": "Drive", "Dr.": "Drive",
-            "Ct": "Court", "Cswy": "Causeway", "Pkwy": "Parkway", "Av": "Avenue",
-            "AVE": "Avenue", "Ave.": "Avenue", "Pky": "Parkway", "drive": "Drive",
-            "lane": "Lane", "road": "Road", "st": "Street", "Cir": "Circle",
-            "Bolevard": "Boulevard", "Hwy": "Highway", "Ln": "Lane", "Notth": "North",
-            "Rd": "Road", "HWY": "Highway"}
-
-    addr_keys =['city', 'postcode', 'state', 'country']
-
-    if element.tag == 'node' or element.tag == 'way':
-        tags = []
+    if element.tag in ('node', 'way', 'relation'):
+        element_id = element.attrib['id']
         for tag in element.iter('tag'):
-            tag_att = {}
-            tag_att['id']= element.attrib['id']
-            tag_att['value']= tag.attrib['v']
-
-
-            s = tag.attrib['k'].lower()
-            val = tag.attrib['v']
-
-            if re.search(LOWER, s):
-                tag_att['key'] = s
-                if s == 'postal_code' and val == '(813) 643-1700':
-                    tag_att['key'] = 'phone' # Fixing a  particular mistake
-
-                if 'fixme' in s:       # Keeps consistency with 'fixme: ...' in LOWER_COLON.
-                    tag_att['type'] = 'fixme'
-                else:
-                    tag_att['type'] = 'regular'
-
-                # Fix for some population numbers with thousand separator.
-                if s == 'population':
-                    val = val.strip()
-                    if re.search(comma_patt, val):
-                        val = val[:val.find(',')]+val[val.find(',')+1:]
-                    tag_att['value'] = val
-
-            elif re.search(LOWER_COLON, s):
-                # Cleaning census and source to avoid the overwriting of
-                # existing 'population' keys
-                if s =='census:population':
-                    tag_att['key'] = 'census'
-                    tag_att['type'] = 'year'
-                    tag_att['value'] = val.split(';')[1]
-                elif s == 'source:population':
-                    tag_att['key'] = 'refpopulation'
-                    tag_att['type'] = s[: s.find(':')]
-                else:
-                    tag_att['key'] = s[s.find(':')+1:]
-                    tag_att['type'] = s[: s.find(':')]
-
-                if s == 'addr:street':
-                # Cleaning for 'suite' in street names
-                    if ' suite' in val.lower() or '#' in val.lower() :
-                        addr_dict = split_suite(val)
-                        suite_dict = fix_suite(val)
-                        suite_dict['id'] = element.attrib['id']
-                        tags.append(suite_dict)
-
-                        val = addr_dict['name']
-
-            ######### This is a fix for two nodes with german names. ###########
-                    elif 'Vereinigte Staaten' in val:
-
-                        my_values = val.split(',')
-                        y = my_values[2].split() # splits up FL and the zip code
-                        my_values[2]= y[1]
-                        val = my_values.pop(0) # New street name, contains homenumber
-                        my_values.pop()
-                        my_values.append(y[0])
-                        my_values.append('US')
-
-                        for i in range(len(addr_keys)):
-                            new_addr = {}
-                            new_addr['key']= addr_keys[i]
-                            new_addr['type'] = 'addr'
-                            new_addr['value'] = my_values[i]
-                            new_addr['id'] = element.attrib['id']
-                            tags.append(new_addr)
-
-                    # Fix for a single node
-                    elif element.attrib['id'] == '1029614792':
-                        my_values = val.split(',')
-                        y = my_values[1].split() # splits up the city and the zip code
-                        my_values[1] = y[0]
-                        val = my_values.pop(0) # New street name, contains homenumber
-                        my_values.append(y[1])
-                        my_values.append('FL')
-                        my_values.append('US')
-                        for i in range(len(addr_keys)):
-                            new_addr = {}
-                            new_addr['key']= addr_keys[i]
-                            new_addr['type'] = 'addr'
-                            new_addr['value'] = my_values[i]
-                            new_addr['id'] = element.attrib['id']
-                            tags.append(new_addr)
-
-                    # Fix for a single node
-                    elif element.attrib['id'] == '2266845486':
-                        my_values = val.split(',')
-                        a = my_values[0][:my_values[0].find('St')].strip()
-                        b = my_values[0][my_values[0].find('St'):].strip()
-                        my_values[0] = a
-                        my_values[1] = b
-                        my_values.append('00000')# zip code already exists.
-                        my_values.append('FL')
-                        my_values.append('US')
-                        val = my_values.pop(0)
-                        for i in range(len(addr_keys)):
-                            if i != 1:
-                                new_addr = {}
-                                new_addr['key']= addr_keys[i]
-                                new_addr['type'] = 'addr'
-                                new_addr['value'] = my_values[i]
-                                new_addr['id'] = element.attrib['id']
-                                tags.append(new_addr)
-
-                    #Cleaning for home numbers in street names
-                    if re.search(homenumber_re, val):
-                        new_homenum ={}
-                        h_dict = split_homenumber(val)
-                        new_homenum['id'] = element.attrib['id']
-                        new_homenum['key'] = 'homenumber'
-                        new_homenum['type'] = 'addr'
-                        new_homenum['value'] = h_dict['homenumber']
-                        tags.append(new_homenum)
-
-                        val = h_dict['name']
-
-                    #Cleaning for oversimplified street names
-                    m = re.search(street_type_re, val)
-                    if m:
-                        street_type = m.group()
-
-                        #Creating a new tag to unify the street names (same street names
-                        # without leading or trailing cardinals)
-                        uniq_names = {}
-                        uniq_names['id'] = element.attrib['id']
-                        uniq_names['key'] = 'u_street'
-                        uniq_names['type'] = 'addr'
-
-                        if street_type not in expected:
-                            long_street_name = update_name_2(update_name(val, mapping),
-                                                            mapping)
-
-                        else:
-                            long_street_name = update_name_2(val, mapping)
-
-                        uniq_names['value'] = strip_cardinals(long_street_name)
-                        tag_att['value'] = long_street_name
-                        tags.append(uniq_names)
-
-                # More cleaning for suites
-                if s == 'addr:housenumber':
-                    if  ' suite' in val.lower():
-                        addr_dict = split_suite(val)
-                        suite_dict = fix_suite(val)
-                        suite_dict['id'] = element.attrib['id']
-                        tags.append(suite_dict)
-
-                        tag_att['value'] = addr_dict['name']
-
-                #Cleaning postal codes
-                if s == 'addr:postcode':
-                    if not re.search(zip_tampa, val):
-                        tag_att['value'] = fix_zipcodes(val)
-
-                #Cleaning city names
-                if s == 'addr:city':
-                    tag_att['value'] = fix_city_names(val)
-
-                #Cleaning county names
-                if s == 'tiger:county':
-                    extra_counties ={}
-                    county_names = fix_county_name(val)
-                    tag_att['value'] = county_names[0]
-                    if len(county_names) > 1:
-                        del county_names[0]
-                        extra_counties['id'] = element.attrib['id']
-                        extra_counties['type'] = 'tiger'
-                        for i, name in enumerate(county_names):
-                            extra_counties['key'] = 'county' + str(i + 1)
-                            extra_counties['value'] = name
-                            tags.append(extra_counties)
-
-            # Fixing a particular case of problemchars
-            elif re.search(SPACE_PROBLEMCHARS, s):
-                tag_att['key'] = re.sub(r'\s', char_repl, s)
-                tag_att['type'] = 'regular'
-
-            #Including the last two items:
-            elif re.search(DASH, s):
-                    tag_att['key'] = re.sub(r'\-', char_repl, s)
-                    tag_att['type'] = 'regular'
-
-            else:
-                continue
-
-            tags.append(tag_att)
+            tags.extend(shape_tag(tag.attrib['k'], tag.attrib['v'], element_id, fired,
+                                  profile))
+        if profile is not None and profile.tagged_only and not tags:
+            return None
 
         if element.tag == 'node':
             for field in NODE_FIELDS:
                 node_attribs[field] = element.attrib[field]
-            # Bowling alley out of business with problematic zip code
-            if node_attribs['id'] != '2061928287':
+            if element_id not in DROPPED_NODES:
                 return {'node': node_attribs, 'node_tags': tags}
 
         elif element.tag == 'way':
@@ -613,15 +722,76 @@ def shape_element(element, node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIE
 
 
             way_nodes =[]
-            for i, nd in enumerate(element.iter('nd')):
+            for i, nd in enumerate(element.iter('nd') if profile is None or profile.way_nodes
+                                   else ()):
                 nd_att ={}
-                nd_att['id'] = element.attrib['id']
+                nd_att['id'] = element_id
                 nd_att['node_id'] = nd.attrib['ref']
                 nd_att['position'] = i
                 way_nodes.append(nd_att)
 
             return {'way': way_attribs, 'way_nodes': way_nodes, 'way_tags': tags}
 
+        elif element.tag == 'relation':
+            relation_attribs = {}
+            for field in RELATION_FIELDS:
+                relation_attribs[field] = element.attrib[field]
+
+            members = []
+            for i, member in enumerate(element.iter('member')):
+                members.append({'id': element_id, 'member_type': member.attrib['type'],
+                                'member_id': member.attrib['ref'],
+                                'role': member.attrib.get('role', ''), 'position': i})
+
+            return {'relation': relation_attribs, 'relation_members': members,
+                    'relation_tags': tags}
+
+
+# (attribute fields, [(list of dicts, fields)]) hashed for every kind of shaped element
+HASHED = {'node': (NODE_FIELDS, [('node_tags', ['key', 'value', 'type'])]),
+          'way': (WAY_FIELDS, [('way_nodes', ['node_id']),
+                               ('way_tags', ['key', 'value', 'type'])]),
+          'relation': (RELATION_FIELDS, [('relation_members', ['member_type', 'member_id',
+                                                               'role']),
+                                         ('relation_tags', ['key', 'value', 'type'])])}
+
+
+def content_hash(tag, el):
+    """First 16 hex digits of the md5 of the attributes, the shaped tags (in order) and the
+    nodes or members of el, a shaped element of type tag"""
+    fields, lists = HASHED[tag]
+    parts = [unicode(el[tag][f]) for f in fields]
+    for name, list_fields in lists:
+        parts.append(u'\x1e')
+        parts.extend(unicode(d[f]) for d in el[name] for f in list_fields)
+    return hashlib.md5(u'\x1f'.join(parts).encode('utf-8')).hexdigest()[:16]
+
+
+def tag_blob(tags):
+    """JSON object of shaped tags by their full key: the key alone for the 'regular' type,
+    'type:key' for the others ('addr:street', 'tiger:county'). The values of a key repeated
+    in the element are a list. '#keys' holds the BLOB_KEYS the element has once, by the key
+    alone ({"county": "Pinellas"} for tiger:county or gnis:county), and '#repeated' those it
+    has more than once, of any type."""
+    blob = {}
+    found = {}
+    for t in tags:
+        full_key = t['key'] if t['type'] == 'regular' else t['type'] + ':' + t['key']
+        if full_key not in blob:
+            blob[full_key] = t['value']
+        elif isinstance(blob[full_key], list):
+            blob[full_key].append(t['value'])
+        else:
+            blob[full_key] = [blob[full_key], t['value']]
+        if t['key'] in BLOB_KEYS:
+            found.setdefault(t['key'], []).append(t['value'])
+    once = dict((k, v[0]) for k, v in found.items() if len(v) == 1)
+    if once:
+        blob['#keys'] = once
+    if len(once) < len(found):
+        blob['#repeated'] = sorted(k for k, v in found.items() if len(v) > 1)
+    return json.dumps(blob, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+
 
 # ================================================== #
 #               Helper Functions                     #
@@ -635,6 +805,9 @@ def get_element(osm_file, tags=('node', 'way', 'relation')):
         if event == 'end' and elem.tag in tags:
             yield elem
             root.clear()
+        elif event == 'end' and elem.tag in ('node', 'way', 'relation'):
+            # Elements of the other kinds are thrown away as soon as they are parsed
+            root.clear()
 
 
 def validate_element(element, validator, schema=SCHEMA):
@@ -663,29 +836,83 @@ class UnicodeDictWriter(csv.DictWriter, object):
 # ================================================== #
 #               Main Function                        #
 # ================================================== #
-def process_map(file_in, validate):
-    """Iteratively process each XML element and write to csv(s)"""
-
-    with codecs.open(NODES_PATH, 'w') as nodes_file,          codecs.open(NODE_TAGS_PATH, 'w') as nodes_tags_file,          codecs.open(WAYS_PATH, 'w') as ways_file,          codecs.open(WAY_NODES_PATH, 'w') as way_nodes_file,          codecs.open(WAY_TAGS_PATH, 'w') as way_tags_file:
+def keeps(profile, tag):
+    """Whether profile keeps the raw tag (an XML element)"""
+    key_type = classify_key(tag.attrib['k'])
+    return key_type is not None and profile.keep(key_type[0], key_type[2])
+
+
+def process_map(file_in, validate, out_dir='', rules=None, tile_zoom=None, compression=None,
+                compress_level=None, hashes=False, profile=None, tag_blobs=False):
+    """Iteratively process each XML element and write to csv(s) inside out_dir. rules is an
+    optional JSON file with cleaning rules (see load_rules). With a tile_zoom the quadtile
+    of every node, and of every way by its first node, is written to tiles.csv. compression
+    ('gzip' or 'zstd') compresses every file in a background thread (see compressed_csv.py).
+    With hashes the content hash of every element and the rules that changed it are written
+    to hashes.csv, in the order of the .osm file (see diff_builds.py). profile (a name in
+    tag_profiles.PROFILES or a JSON file) only keeps some of the elements and tags. With
+    tag_blobs the tags of every tagged node and way are also written to tag_blobs.csv as one
+    JSON object (see tag_blob)."""
+    if rules is not None:
+        load_rules(rules)
+    profile = load_profile(profile)
+    if tile_zoom is not None:
+        from quadtiles import point_key, NodeTiles
+        node_tiles = NodeTiles()
+
+    def output(path):
+        return open_output(os.path.join(out_dir, path), compression, compress_level)
+
+    with output(NODES_PATH) as nodes_file, \
+         output(NODE_TAGS_PATH) as nodes_tags_file, \
+         output(WAYS_PATH) as ways_file, \
+         output(WAY_NODES_PATH) as way_nodes_file, \
+         output(WAY_TAGS_PATH) as way_tags_file, \
+         output(RELATIONS_PATH) as relations_file, \
+         output(RELATION_TAGS_PATH) as relation_tags_file, \
+         output(RELATION_MEMBERS_PATH) as members_file, \
+         output(RAW_TAGS_PATH) as raw_tags_file, \
+         (output(TILES_PATH) if tile_zoom is not None
+          else codecs.open(os.devnull, 'w')) as tiles_file, \
+         (output(HASHES_PATH) if hashes else codecs.open(os.devnull, 'w')) as hashes_file, \
+         (output(TAG_BLOBS_PATH) if tag_blobs
+          else codecs.open(os.devnull, 'w')) as tag_blobs_file:
 
         nodes_writer = UnicodeDictWriter(nodes_file, NODE_FIELDS)
         node_tags_writer = UnicodeDictWriter(nodes_tags_file, NODE_TAGS_FIELDS)
         ways_writer = UnicodeDictWriter(ways_file, WAY_FIELDS)
         way_nodes_writer = UnicodeDictWriter(way_nodes_file, WAY_NODES_FIELDS)
         way_tags_writer = UnicodeDictWriter(way_tags_file, WAY_TAGS_FIELDS)
+        relations_writer = UnicodeDictWriter(relations_file, RELATION_FIELDS)
+        relation_tags_writer = UnicodeDictWriter(relation_tags_file, RELATION_TAGS_FIELDS)
+        members_writer = UnicodeDictWriter(members_file, RELATION_MEMBERS_FIELDS)
+        raw_tags_writer = UnicodeDictWriter(raw_tags_file, RAW_TAGS_FIELDS)
+        tiles_writer = UnicodeDictWriter(tiles_file, TILES_FIELDS)
+        hashes_writer = UnicodeDictWriter(hashes_file, HASHES_FIELDS)
+        tag_blobs_writer = UnicodeDictWriter(tag_blobs_file, TAG_BLOBS_FIELDS)
 
         nodes_writer.writeheader()
         node_tags_writer.writeheader()
         ways_writer.writeheader()
         way_nodes_writer.writeheader()
         way_tags_writer.writeheader()
+        relations_writer.writeheader()
+        relation_tags_writer.writeheader()
+        members_writer.writeheader()
+        raw_tags_writer.writeheader()
+        tiles_writer.writeheader()
+        hashes_writer.writeheader()
+        tag_blobs_writer.writeheader()
 
         validator = cerberus.Validator()
 
-        for element in get_element(file_in, tags=('node', 'way')):
-            el = shape_element(element)
+        elements = ('node', 'way', 'relation') if profile is None else profile.elements
+        for element in get_element(file_in, tags=elements):
+            fired = set() if hashes else None
+            el = shape_element(element, fired=fired, profile=profile)
             if el:
-                if validate is True:
+                # The schema has no relations
+                if validate is True and element.tag != 'relation':
                     validate_element(el, validator)
 
                 if element.tag == 'node':
@@ -695,9 +922,41 @@ def process_map(file_in, validate):
                     ways_writer.writerow(el['way'])
                     way_nodes_writer.writerows(el['way_nodes'])
                     way_tags_writer.writerows(el['way_tags'])
+                elif element.tag == 'relation':
+                    relations_writer.writerow(el['relation'])
+                    members_writer.writerows(el['relation_members'])
+                    relation_tags_writer.writerows(el['relation_tags'])
+                raw_tags_writer.writerows({'element': element.tag, 'id': element.attrib['id'],
+                                           'k': tag.attrib['k'], 'v': tag.attrib['v']}
+                                          for tag in element.iter('tag')
+                                          if profile is None or keeps(profile, tag))
+                if tag_blobs and element.tag != 'relation' and el[element.tag + '_tags']:
+                    tag_blobs_writer.writerow({'element': element.tag,
+                                               'id': element.attrib['id'],
+                                               'tags': tag_blob(el[element.tag + '_tags'])})
+                if hashes:
+                    hashes_writer.writerow({'element': element.tag,
+                                            'id': element.attrib['id'],
+                                            'hash': content_hash(element.tag, el),
+                                            'rules': ';'.join(sorted(fired))})
+
+            if tile_zoom is not None and element.tag != 'relation':
+                if element.tag == 'node':
+                    tile = point_key(float(element.attrib['lat']),
+                                     float(element.attrib['lon']), tile_zoom)
+                    node_tiles.add(int(element.attrib['id']), tile)
+                else:
+                    # Ways are placed in the tile of their first known node (they come after
+                    # every node in an .osm file). Ways without known nodes get none.
+                    tile = node_tiles.first([int(nd.attrib['ref'])
+                                             for nd in element.iter('nd')])
+                if el and tile is not None:
+                    tiles_writer.writerow({'element': element.tag, 'tile': tile,
+                                           'id': element.attrib['id'], 'zoom': tile_zoom})
 
 
 if __name__ == '__main__':
     # Note: Validation is ~ 10X slower. For the project consider using a small
     # sample of the map when validating.
-    process_map(OSM_PATH, validate=False)
+    process_map(OSM_PATH, validate=False,
+                rules=RULES_PATH if os.path.exists(RULES_PATH) else None)
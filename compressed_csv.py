@@ -0,0 +1,269 @@
+"""
+Compressed .csv files for clean_data.py and the scripts that read its output.
+
+clean_data.process_map(..., compression='gzip') (or 'zstd') writes nodes.csv.gz, ... instead
+of nodes.csv. Every file gets a background thread that compresses and writes what the parser
+hands it in blocks of BLOCK_SIZE bytes, so the parser only ever joins strings: zlib and
+zstandard release the GIL while they compress, and the files are compressed in parallel with
+each other and with the parsing.
+
+open_csv and csv_exists take the name of the plain .csv file and use whichever of nodes.csv,
+nodes.csv.gz or nodes.csv.zst is there, so create_db.py, merge_db.py and check_integrity.py
+read compressed files without being told.
+
+Running the script compresses the .csv files of a directory with every codec and level of
+LEVELS and reports the throughput and the size of each:
+
+    python compressed_csv.py [csv_dir]
+"""
+import os
+import Queue
+import sys
+import threading
+import time
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CODECS = {'gzip': '.gz', 'zstd': '.zst'}
+DEFAULT_LEVELS = {'gzip': 6, 'zstd': 3}
+LEVELS = {'gzip': [1, 6, 9], 'zstd': [1, 3, 9, 19]}
+BLOCK_SIZE = 1024 ** 2  # bytes handed to the compression thread at a time
+QUEUE_SIZE = 8  # blocks waiting per file, at most
+READ_SIZE = 256 * 1024
+
+
+def compressor(codec, level=None):
+    """Streaming compressor object (compress/flush) of a codec"""
+    level = DEFAULT_LEVELS[codec] if level is None else level
+    if codec == 'gzip':
+        # wbits 31: zlib stream with a gzip header, readable by gzip and zcat
+        return zlib.compressobj(level, zlib.DEFLATED, 31)
+    if codec == 'zstd':
+        if zstandard is None:
+            raise ImportError('zstandard is needed to write .zst files')
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    raise ValueError('Unknown codec {0!r}, use one of {1}'.format(codec, sorted(CODECS)))
+
+
+def decompressor(codec):
+    if codec == 'gzip':
+        return zlib.decompressobj(31)
+    if codec == 'zstd':
+        if zstandard is None:
+            raise ImportError('zstandard is needed to read .zst files')
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise ValueError('Unknown codec {0!r}'.format(codec))
+
+
+class CompressedWriter(object):
+    """Write-only file that compresses in a background thread. write() only buffers; every
+    BLOCK_SIZE bytes the buffer is queued for the thread, which blocks the writer when
+    QUEUE_SIZE blocks are already waiting. Errors of the thread are raised by close()."""
+
+    def __init__(self, path, codec, level=None):
+        self.path = path
+        self.compressor = compressor(codec, level)
+        self.f = open(path, 'wb')
+        self.buffer = []
+        self.buffered = 0
+        self.queue = Queue.Queue(QUEUE_SIZE)
+        self.error = None
+        self.thread = threading.Thread(target=self._compress)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _compress(self):
+        while True:
+            block = self.queue.get()
+            if block is None:
+                break
+            if self.error is None:
+                try:
+                    self.f.write(self.compressor.compress(block))
+                except Exception as e:
+                    self.error = e
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= BLOCK_SIZE:
+            self.queue.put(''.join(self.buffer))
+            self.buffer = []
+            self.buffered = 0
+
+    def close(self):
+        if self.f.closed:
+            return
+        if self.buffer:
+            self.queue.put(''.join(self.buffer))
+            self.buffer = []
+        self.queue.put(None)
+        self.thread.join()
+        try:
+            if self.error is None:
+                self.f.write(self.compressor.flush())
+        finally:
+            self.f.close()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_output(path, compression=None, level=None):
+    """Opens path (a .csv file) for writing, compressed with the codec compression (None for
+    a plain file). The other variants of the file are removed, so that readers cannot pick
+    up the output of an earlier run."""
+    for codec, extension in [(None, '')] + sorted(CODECS.items()):
+        if codec != compression and os.path.exists(path + extension):
+            os.remove(path + extension)
+    if compression is None:
+        return open(path, 'wb')
+    return CompressedWriter(path + CODECS[compression], compression, level)
+
+
+def find_csv(path):
+    """(path of the file, codec) of the .csv file path or of its compressed variant, (None,
+    None) if there is none"""
+    if os.path.exists(path):
+        return path, None
+    for codec, extension in sorted(CODECS.items()):
+        if os.path.exists(path + extension):
+            return path + extension, codec
+    return None, None
+
+
+def csv_exists(path):
+    return find_csv(path)[0] is not None
+
+
+class CompressedReader(object):
+    """Iterates over the lines of a compressed file, decompressing READ_SIZE bytes at a time
+    (much faster than gzip.GzipFile.readline). Concatenated gzip members are read too. read()
+    hands the same data to readers that want a file, like pandas.read_csv."""
+
+    def __init__(self, path, codec):
+        self.f = open(path, 'rb')
+        self.codec = codec
+        self.pending = None
+        self.buffer = ''
+
+    def blocks(self):
+        """Yields the decompressed data of every READ_SIZE bytes of the file"""
+        d = decompressor(self.codec)
+        while True:
+            data = self.f.read(READ_SIZE)
+            if not data:
+                break
+            while data:
+                text = d.decompress(data)
+                data = getattr(d, 'unused_data', '')
+                if data:
+                    d = decompressor(self.codec)
+                if text:
+                    yield text
+
+    def __iter__(self):
+        rest = ''
+        for text in self.blocks():
+            lines = (rest + text).split('\n')
+            rest = lines.pop()
+            for line in lines:
+                yield line + '\n'
+        if rest:
+            yield rest
+
+    def read(self, size=-1):
+        """Up to size decompressed bytes (all of them if size is negative)"""
+        if self.pending is None:
+            self.pending = self.blocks()
+        while size < 0 or len(self.buffer) < size:
+            text = next(self.pending, None)
+            if text is None:
+                break
+            self.buffer += text
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_csv(path):
+    """Opens the .csv file path, or its compressed variant, for reading. IOError if neither
+    exists."""
+    found, codec = find_csv(path)
+    if found is None:
+        raise IOError('No such file: {0} (nor {1})'.format(
+            path, ', '.join(path + e for c, e in sorted(CODECS.items()))))
+    if codec is None:
+        return open(found, 'rb')
+    return CompressedReader(found, codec)
+
+
+def compress_file(path, codec, level):
+    """(seconds to compress, compressed size, seconds to read back) of the file path"""
+    out = path + '.bench' + CODECS[codec]
+    start = time.time()
+    with open(path, 'rb') as fin, CompressedWriter(out, codec, level) as fout:
+        for block in iter(lambda: fin.read(BLOCK_SIZE), ''):
+            fout.write(block)
+    seconds = time.time() - start
+    size = os.path.getsize(out)
+    start = time.time()
+    for _ in CompressedReader(out, codec):
+        pass
+    read = time.time() - start
+    os.remove(out)
+    return seconds, size, read
+
+
+def benchmark(csv_dir=''):
+    paths = [os.path.join(csv_dir, f) for f in sorted(os.listdir(csv_dir or '.'))
+             if f.endswith('.csv')]
+    total = sum(os.path.getsize(p) for p in paths)
+    if not total:
+        print 'No .csv files in', csv_dir or '.'
+        return
+    mb = total / 1024.0 ** 2
+    start = time.time()
+    for p in paths:
+        with open(p, 'rb') as f:
+            for _ in f:
+                pass
+    plain_read = time.time() - start
+    print '{0} .csv files, {1:.1f} MB, read in {2:.2f}s'.format(len(paths), mb, plain_read)
+    print '{0:<6s} {1:>5s} {2:>10s} {3:>8s} {4:>14s} {5:>12s}'.format(
+        'codec', 'level', 'size (MB)', 'ratio', 'write (MB/s)', 'read (MB/s)')
+    for codec in sorted(CODECS):
+        if codec == 'zstd' and zstandard is None:
+            print '{0:<6s} (zstandard is not installed)'.format(codec)
+            continue
+        for level in LEVELS[codec]:
+            seconds = size = read = 0
+            for p in paths:
+                s, n, r = compress_file(p, codec, level)
+                seconds, size, read = seconds + s, size + n, read + r
+            print '{0:<6s} {1:>5d} {2:>10.1f} {3:>7.1f}x {4:>14.1f} {5:>12.1f}'.format(
+                codec, level, size / 1024.0 ** 2, total / float(size), mb / seconds,
+                mb / read)
+
+
+if __name__ == '__main__':
+    benchmark(sys.argv[1] if len(sys.argv) > 1 else '')
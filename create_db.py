@@ -1,78 +1,462 @@
+import calendar
 import csv
+import os
 import sqlite3
 
+from clean_data import BLOB_KEYS
+from compressed_csv import csv_exists, open_csv
+
 sql_file="TampaFlorida.db"
-con = sqlite3.connect(sql_file)
-cur = con.cursor()
-############################## Table nodes ################################################
-cur.execute('''DROP TABLE IF EXISTS nodes; ''')
-con.commit()
-# use your column names here
-cur.execute("""CREATE TABLE nodes (id INTEGER PRIMARY KEY NOT NULL, lat REAL, lon REAL,
-            user TEXT, uid INTEGER, version TEXT, changeset INTEGER, timestamp DATE);""")
-con.commit()
-with open('nodes.csv','rb') as fin:
-    # csv.DictReader uses first line in file for column headings by default
-    dr = csv.DictReader(fin) # comma is default delimiter
-    to_db = [(i['id'].decode("utf-8"),i['lat'].decode("utf-8"),i['lon'].decode("utf-8"),
-               i['user'].decode("utf-8"),i['uid'].decode("utf-8"),i['version'].decode("utf-8"),
-               i['changeset'].decode("utf-8"), i['timestamp'].decode("utf-8")) for i in dr]
-
-    cur.executemany("""INSERT INTO nodes (id, lat, lon, user, uid, version, changeset,
-                    timestamp) VALUES (?,?,?,?,?,?,?,?);""", to_db)
-con.commit()
-############################ Table nodes_tags ###############################################
-cur.execute('''DROP TABLE IF EXISTS nodes_tags; ''')
-con.commit()
-cur.execute("""CREATE TABLE nodes_tags (id INTEGER, key TEXT, value TEXT, type TEXT,
-            FOREIGN KEY (id) REFERENCES nodes(id));""")
-con.commit()
-with open('nodes_tags.csv','rb') as fin:
-    dr = csv.DictReader(fin) # comma is default delimiter
-    to_db = [(i['id'].decode("utf-8"),i['key'].decode("utf-8"),i['value'].decode("utf-8"),
-              i['type'].decode("utf-8")) for i in dr]
-    cur.executemany("""INSERT INTO nodes_tags (id, key, value, type)
-                    VALUES (?,?,?,?);""", to_db)
-con.commit()
-########################## Table ways #######################################################
-cur.execute('''DROP TABLE IF EXISTS ways; ''')
-con.commit()
-cur.execute("""CREATE TABLE ways ( id INTEGER PRIMARY KEY NOT NULL, user TEXT, uid INTEGER,
-            version TEXT, changeset INTEGER, timestamp TEXT);""")
-con.commit()
-with open('ways.csv','rb') as fin:
-    dr = csv.DictReader(fin) # comma is default delimiter
-    to_db = [(i['id'].decode("utf-8"),i['user'].decode("utf-8"),i['uid'].decode("utf-8"),
-             i['version'].decode("utf-8"), i['changeset'].decode("utf-8"),
-             i['timestamp'].decode("utf-8")) for i in dr]
-    cur.executemany("""INSERT INTO ways (id, user, uid, version, changeset,
-                    timestamp) VALUES (?,?,?,?,?,?);""", to_db)
-con.commit()
-######################### Table ways_tags ###################################################
-cur.execute('''DROP TABLE IF EXISTS ways_tags; ''')
-con.commit()
-cur.execute("""CREATE TABLE ways_tags (id INTEGER NOT NULL, key TEXT NOT NULL,
-            value TEXT NOT NULL, type TEXT, FOREIGN KEY (id) REFERENCES ways(id));""")
-con.commit()
-with open('ways_tags.csv','rb') as fin:
-    dr = csv.DictReader(fin) # comma is default delimiter
-    to_db = [(i['id'].decode("utf-8"),i['key'].decode("utf-8"),i['value'].decode("utf-8"),
-             i['type'].decode("utf-8")) for i in dr]
-    cur.executemany("""INSERT INTO ways_tags (id, key, value, type)
-                    VALUES (?,?,?,?);""", to_db)
-con.commit()
-########################### Table ways_nodes #################################################
-cur.execute('''DROP TABLE IF EXISTS ways_nodes; ''')
-con.commit()
-cur.execute("""CREATE TABLE ways_nodes (id INTEGER NOT NULL, node_id INTEGER NOT NULL,
-            position INTEGER NOT NULL, FOREIGN KEY (id) REFERENCES ways(id),
-            FOREIGN KEY (node_id) REFERENCES nodes(id));""")
-con.commit()
-with open('ways_nodes.csv','rb') as fin:
-    dr = csv.DictReader(fin) # comma is default delimiter
-    to_db = [(i['id'].decode("utf-8"),i['node_id'].decode("utf-8"),
-              i['position'].decode("utf-8")) for i in dr]
-    cur.executemany("""INSERT INTO ways_nodes (id, node_id, position)
-                    VALUES (?,?,?);""", to_db)
-con.commit()
-con.close()
+
+TABLE_SCHEMAS = {
+    'nodes': """CREATE TABLE nodes (id INTEGER PRIMARY KEY NOT NULL, lat REAL, lon REAL,
+             user TEXT, uid INTEGER, version TEXT, changeset INTEGER, timestamp INTEGER,
+             year INTEGER, month INTEGER);""",
+    'nodes_tags': """CREATE TABLE nodes_tags (id INTEGER, key TEXT, value TEXT, type TEXT,
+                  FOREIGN KEY (id) REFERENCES nodes(id));""",
+    'ways': """CREATE TABLE ways ( id INTEGER PRIMARY KEY NOT NULL, user TEXT, uid INTEGER,
+            version TEXT, changeset INTEGER, timestamp INTEGER, year INTEGER,
+            month INTEGER);""",
+    'ways_tags': """CREATE TABLE ways_tags (id INTEGER NOT NULL, key TEXT NOT NULL,
+                 value TEXT NOT NULL, type TEXT, FOREIGN KEY (id) REFERENCES ways(id));""",
+    'ways_nodes': """CREATE TABLE ways_nodes (id INTEGER NOT NULL, node_id INTEGER NOT NULL,
+                  position INTEGER NOT NULL, FOREIGN KEY (id) REFERENCES ways(id),
+                  FOREIGN KEY (node_id) REFERENCES nodes(id));""",
+    'relations': """CREATE TABLE relations (id INTEGER PRIMARY KEY NOT NULL, user TEXT,
+                 uid INTEGER, version TEXT, changeset INTEGER, timestamp INTEGER,
+                 year INTEGER, month INTEGER);""",
+    'relations_tags': """CREATE TABLE relations_tags (id INTEGER NOT NULL, key TEXT NOT NULL,
+                      value TEXT NOT NULL, type TEXT,
+                      FOREIGN KEY (id) REFERENCES relations(id));""",
+    # member_id is not a foreign key: members are often outside of the extract
+    'relations_members': """CREATE TABLE relations_members (id INTEGER NOT NULL,
+                         member_type TEXT NOT NULL, member_id INTEGER NOT NULL, role TEXT,
+                         position INTEGER NOT NULL,
+                         FOREIGN KEY (id) REFERENCES relations(id));""",
+    'raw_tags': """CREATE TABLE raw_tags (element TEXT NOT NULL, id INTEGER NOT NULL,
+                k TEXT NOT NULL, v TEXT NOT NULL);""",
+    # Clustered by tile: the elements of a range of tiles are stored together
+    'tiles': """CREATE TABLE tiles (element TEXT NOT NULL, tile INTEGER NOT NULL,
+             id INTEGER NOT NULL, zoom INTEGER NOT NULL, PRIMARY KEY (element, tile, id))
+             WITHOUT ROWID;""",
+}
+
+# The clustered layout (create_db(..., layout='clustered')): the tags of an element, and the
+# nodes of a way or the members of a relation in their order, are stored together in the
+# primary key of a WITHOUT ROWID table instead of wherever they were appended. Exact
+# duplicate rows are dropped (the key has to be unique).
+LAYOUTS = ['rowid', 'clustered']
+CLUSTERED_KEYS = {
+    'nodes_tags': ['id', 'key', 'type', 'value'],
+    'ways_tags': ['id', 'key', 'type', 'value'],
+    'ways_nodes': ['id', 'position'],
+    'relations_tags': ['id', 'key', 'type', 'value'],
+    'relations_members': ['id', 'position'],
+}
+CLUSTERED_SCHEMAS = {
+    'nodes_tags': """CREATE TABLE nodes_tags (id INTEGER NOT NULL, key TEXT NOT NULL,
+                  value TEXT NOT NULL, type TEXT NOT NULL, PRIMARY KEY (id, key, type, value),
+                  FOREIGN KEY (id) REFERENCES nodes(id)) WITHOUT ROWID;""",
+    'ways_tags': """CREATE TABLE ways_tags (id INTEGER NOT NULL, key TEXT NOT NULL,
+                 value TEXT NOT NULL, type TEXT NOT NULL, PRIMARY KEY (id, key, type, value),
+                 FOREIGN KEY (id) REFERENCES ways(id)) WITHOUT ROWID;""",
+    'ways_nodes': """CREATE TABLE ways_nodes (id INTEGER NOT NULL, node_id INTEGER NOT NULL,
+                  position INTEGER NOT NULL, PRIMARY KEY (id, position),
+                  FOREIGN KEY (id) REFERENCES ways(id),
+                  FOREIGN KEY (node_id) REFERENCES nodes(id)) WITHOUT ROWID;""",
+    'relations_tags': """CREATE TABLE relations_tags (id INTEGER NOT NULL, key TEXT NOT NULL,
+                      value TEXT NOT NULL, type TEXT NOT NULL,
+                      PRIMARY KEY (id, key, type, value),
+                      FOREIGN KEY (id) REFERENCES relations(id)) WITHOUT ROWID;""",
+    'relations_members': """CREATE TABLE relations_members (id INTEGER NOT NULL,
+                         member_type TEXT NOT NULL, member_id INTEGER NOT NULL, role TEXT,
+                         position INTEGER NOT NULL, PRIMARY KEY (id, position),
+                         FOREIGN KEY (id) REFERENCES relations(id)) WITHOUT ROWID;""",
+}
+
+# Tag blobs (create_db(..., tag_blobs=True)): every node and way row also holds all its tags
+# as one JSON object (the column tags, from tag_blobs.csv, see clean_data.tag_blob), and the
+# most queried of them are generated columns, so that a query reads them from the element
+# row instead of joining the tag table once per key.
+# Generated columns of nodes and ways: the value of every key of clean_data.BLOB_KEYS that
+# the element has once (of any type), and 'repeated', the JSON list of those it has more
+# than once (NULL for almost every element), whose tags have to be read from the tag tables.
+BLOB_COLUMNS = BLOB_KEYS + ['repeated']
+# STORED: extracted once at load time, so that reading them does not parse the JSON
+BLOB_COLUMN = """{0} TEXT GENERATED ALWAYS AS (json_extract(tags, '$."#keys"."{0}"')) STORED"""
+REPEATED_COLUMN = """repeated TEXT GENERATED ALWAYS AS (json_extract(tags, '$."#repeated"'))
+             STORED"""
+BLOB_INDEXES = [
+    ('nodes_amenity_street', 'nodes', 'amenity, street, repeated'),
+    ('nodes_amenity_u_street', 'nodes', 'amenity, u_street, repeated'),
+    ('nodes_name', 'nodes', 'name'),
+    ('nodes_u_street', 'nodes', 'u_street'),
+    ('nodes_postcode', 'nodes', 'postcode'),
+    ('nodes_population', 'nodes', 'population * 1'),
+    ('nodes_county', 'nodes', 'county, county1, repeated'),
+    ('nodes_repeated', 'nodes', 'repeated'),
+    ('ways_amenity', 'ways', 'amenity'),
+    ('ways_name', 'ways', 'name'),
+    ('ways_u_street', 'ways', 'u_street'),
+    ('ways_postcode', 'ways', 'postcode'),
+    ('ways_postal_code', 'ways', 'postal_code, repeated'),
+    ('ways_county', 'ways', 'county, county1, repeated'),
+    ('ways_repeated', 'ways', 'repeated'),
+]
+
+# Column order of every table. It is the order of the .csv files, except for the year and
+# month of nodes and ways, which are derived from the timestamp at load time (see csv_row).
+COLUMNS = {
+    'nodes': ['id', 'lat', 'lon', 'user', 'uid', 'version', 'changeset', 'timestamp', 'year',
+              'month'],
+    'nodes_tags': ['id', 'key', 'value', 'type'],
+    'ways': ['id', 'user', 'uid', 'version', 'changeset', 'timestamp', 'year', 'month'],
+    'ways_tags': ['id', 'key', 'value', 'type'],
+    'ways_nodes': ['id', 'node_id', 'position'],
+    'relations': ['id', 'user', 'uid', 'version', 'changeset', 'timestamp', 'year', 'month'],
+    'relations_tags': ['id', 'key', 'value', 'type'],
+    'relations_members': ['id', 'member_type', 'member_id', 'role', 'position'],
+    'raw_tags': ['element', 'id', 'k', 'v'],
+    'tiles': ['element', 'tile', 'id', 'zoom'],
+}
+
+# Indexes on the columns that the queries in query_db.py join and filter on.
+INDEXES = [
+    ('nodes_tags_id', 'nodes_tags', 'id'),
+    ('nodes_tags_key_value', 'nodes_tags', 'key, value'),
+    ('ways_tags_id', 'ways_tags', 'id'),
+    ('ways_tags_key_value', 'ways_tags', 'key, value'),
+    ('ways_nodes_id', 'ways_nodes', 'id, position'),
+    ('ways_nodes_node_id', 'ways_nodes', 'node_id'),
+    ('nodes_year_month', 'nodes', 'year, month'),
+    ('nodes_user_timestamp', 'nodes', 'user, timestamp'),
+    ('ways_year_month', 'ways', 'year, month'),
+    ('ways_user_timestamp', 'ways', 'user, timestamp'),
+    ('relations_tags_id', 'relations_tags', 'id'),
+    ('relations_tags_key_value', 'relations_tags', 'key, value'),
+    ('relations_members_id', 'relations_members', 'id, position'),
+    ('relations_members_member', 'relations_members', 'member_type, member_id'),
+    ('raw_tags_k', 'raw_tags', 'k'),
+    ('raw_tags_element_id', 'raw_tags', 'element, id'),
+]
+
+# Timestamps are stored as seconds since 1970 (UTC). These views show them as in the .osm file.
+ISO_VIEWS = [
+    ('nodes_iso', 'nodes', 'id, lat, lon, user, uid, version, changeset'),
+    ('ways_iso', 'ways', 'id, user, uid, version, changeset'),
+    ('relations_iso', 'relations', 'id, user, uid, version, changeset'),
+]
+ISO_FORMAT = "strftime('%Y-%m-%dT%H:%M:%SZ', timestamp, 'unixepoch') AS timestamp"
+
+# Full-text index over the names and addresses of nodes and ways (see search_db.py).
+# Every element with at least one of these tags gets one row.
+# (column, key, type) of every indexed tag
+SEARCH_COLUMNS = [
+    ('name', 'name', 'regular'),
+    ('street', 'street', 'addr'),
+    ('u_street', 'u_street', 'addr'),
+    ('city', 'city', 'addr'),
+    ('amenity', 'amenity', 'regular'),
+]
+SEARCH_SCHEMA = """CREATE VIRTUAL TABLE search USING fts5(id UNINDEXED, element UNINDEXED,
+                {0}, prefix='2 3', tokenize='unicode61 remove_diacritics 2');"""
+
+# Denormalized addresses of nodes and ways (ways are placed on the centroid of their nodes).
+# housenumber falls back to the homenumber that clean_data.py splits from the street names.
+ADDRESS_SCHEMA = """CREATE TABLE addresses (id INTEGER NOT NULL, element TEXT NOT NULL,
+                 housenumber TEXT, street TEXT, u_street TEXT, suite TEXT, postcode TEXT,
+                 city TEXT, lat REAL, lon REAL, PRIMARY KEY (element, id));"""
+ADDRESS_KEYS = ['housenumber', 'homenumber', 'street', 'u_street', 'suite', 'postcode', 'city']
+ADDRESS_INDEXES = [
+    ('addresses_u_street', 'addresses', 'u_street, housenumber'),
+    ('addresses_postcode', 'addresses', 'postcode'),
+    ('addresses_city', 'addresses', 'city'),
+]
+
+
+def parse_timestamp(timestamp):
+    """(seconds since 1970, year, month) of an OSM timestamp like 2010-07-22T16:16:51Z"""
+    year, month = int(timestamp[0:4]), int(timestamp[5:7])
+    seconds = calendar.timegm((year, month, int(timestamp[8:10]), int(timestamp[11:13]),
+                               int(timestamp[14:16]), int(timestamp[17:19])))
+    return seconds, year, month
+
+
+def csv_row(table, i):
+    """Tuple in COLUMNS order for the csv.DictReader row i of table"""
+    if table in ('nodes', 'ways', 'relations'):
+        row = [i[c].decode("utf-8") for c in COLUMNS[table][:-3]]
+        return tuple(row) + parse_timestamp(i['timestamp'])
+    return tuple(i[c].decode("utf-8") for c in COLUMNS[table])
+
+
+def table_schema(table, layout='rowid', tag_blobs=False):
+    if layout == 'clustered' and table in CLUSTERED_SCHEMAS:
+        return CLUSTERED_SCHEMAS[table]
+    schema = TABLE_SCHEMAS[table]
+    if tag_blobs and table in ('nodes', 'ways'):
+        columns = ', '.join([BLOB_COLUMN.format(k) for k in BLOB_KEYS] + [REPEATED_COLUMN])
+        return '{0}, tags TEXT, {1});'.format(schema[:schema.rindex(')')], columns)
+    return schema
+
+
+def read_tag_blobs(csv_dir):
+    """{'node': {id: JSON object}, 'way': {...}} of the tag_blobs.csv of csv_dir"""
+    blobs = {'node': {}, 'way': {}}
+    with open_csv(os.path.join(csv_dir, 'tag_blobs.csv')) as fin:
+        for i in csv.DictReader(fin):
+            blobs[i['element']][i['id'].decode('utf-8')] = i['tags'].decode('utf-8')
+    return blobs
+
+
+def has_tag_blobs(con):
+    return 'tags' in [r[1] for r in con.execute('PRAGMA table_info(nodes);')]
+
+
+def clustered(table, rows, layout):
+    """rows (tuples in COLUMNS order) sorted by the primary key of table in the clustered
+    layout, so that they are appended to its B-tree in order"""
+    if layout != 'clustered' or table not in CLUSTERED_KEYS:
+        return rows
+    columns = COLUMNS[table]
+    key = [(columns.index(c), c in ('id', 'position')) for c in CLUSTERED_KEYS[table]]
+    return sorted(rows, key=lambda r: tuple(int(r[i]) if number else r[i]
+                                            for i, number in key))
+
+
+def row_order(con, table):
+    """Columns that give the rows of an element in table in their order: rowid, or the
+    primary key of a clustered table"""
+    sql = con.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?;",
+                      (table,)).fetchone()
+    if sql is not None and 'WITHOUT ROWID' in sql[0].upper() and table in CLUSTERED_KEYS:
+        return ', '.join(CLUSTERED_KEYS[table])
+    return 'rowid'
+
+
+def create_db(sql_file=sql_file, csv_dir='', layout='rowid', tag_blobs=False):
+    """Creates the database sql_file from the .csv files found in csv_dir (or their .gz/.zst
+    variants, see compressed_csv.py). layout is 'rowid' or 'clustered' (see LAYOUTS). With
+    tag_blobs the tags of nodes and ways are also stored in their rows, from tag_blobs.csv
+    (see BLOB_COLUMNS)."""
+    if layout not in LAYOUTS:
+        raise ValueError('Unknown layout {0}'.format(layout))
+    blobs = read_tag_blobs(csv_dir) if tag_blobs else None
+    # (column, placeholder) of the blob in the inserts of nodes and ways
+    blob = (', tags', ',?') if tag_blobs else ('', '')
+    # Exact duplicate rows are skipped in the clustered tables
+    insert = 'INSERT OR IGNORE' if layout == 'clustered' else 'INSERT'
+    con = sqlite3.connect(sql_file)
+    cur = con.cursor()
+    ############################## Table nodes ############################################
+    cur.execute('''DROP TABLE IF EXISTS nodes; ''')
+    con.commit()
+    cur.execute(table_schema('nodes', tag_blobs=tag_blobs))
+    con.commit()
+    with open_csv(os.path.join(csv_dir, 'nodes.csv')) as fin:
+        # csv.DictReader uses first line in file for column headings by default
+        dr = csv.DictReader(fin) # comma is default delimiter
+        to_db = [csv_row('nodes', i) for i in dr]
+        if tag_blobs:
+            to_db = [row + (blobs['node'].get(row[0]),) for row in to_db]
+
+        cur.executemany("""INSERT INTO nodes (id, lat, lon, user, uid, version, changeset,
+                        timestamp, year, month{0}) VALUES (?,?,?,?,?,?,?,?,?,?{1});""".format(
+                        *blob), to_db)
+    con.commit()
+    ############################ Table nodes_tags #########################################
+    cur.execute('''DROP TABLE IF EXISTS nodes_tags; ''')
+    con.commit()
+    cur.execute(table_schema('nodes_tags', layout))
+    con.commit()
+    with open_csv(os.path.join(csv_dir, 'nodes_tags.csv')) as fin:
+        dr = csv.DictReader(fin) # comma is default delimiter
+        to_db = [(i['id'].decode("utf-8"),i['key'].decode("utf-8"),i['value'].decode("utf-8"),
+                  i['type'].decode("utf-8")) for i in dr]
+        cur.executemany(insert + """ INTO nodes_tags (id, key, value, type)
+                        VALUES (?,?,?,?);""", clustered('nodes_tags', to_db, layout))
+    con.commit()
+    ########################## Table ways #################################################
+    cur.execute('''DROP TABLE IF EXISTS ways; ''')
+    con.commit()
+    cur.execute(table_schema('ways', tag_blobs=tag_blobs))
+    con.commit()
+    with open_csv(os.path.join(csv_dir, 'ways.csv')) as fin:
+        dr = csv.DictReader(fin) # comma is default delimiter
+        to_db = [csv_row('ways', i) for i in dr]
+        if tag_blobs:
+            to_db = [row + (blobs['way'].get(row[0]),) for row in to_db]
+        cur.executemany("""INSERT INTO ways (id, user, uid, version, changeset,
+                        timestamp, year, month{0}) VALUES (?,?,?,?,?,?,?,?{1});""".format(
+                        *blob), to_db)
+    con.commit()
+    ######################### Table ways_tags #############################################
+    cur.execute('''DROP TABLE IF EXISTS ways_tags; ''')
+    con.commit()
+    cur.execute(table_schema('ways_tags', layout))
+    con.commit()
+    with open_csv(os.path.join(csv_dir, 'ways_tags.csv')) as fin:
+        dr = csv.DictReader(fin) # comma is default delimiter
+        to_db = [(i['id'].decode("utf-8"),i['key'].decode("utf-8"),i['value'].decode("utf-8"),
+                 i['type'].decode("utf-8")) for i in dr]
+        cur.executemany(insert + """ INTO ways_tags (id, key, value, type)
+                        VALUES (?,?,?,?);""", clustered('ways_tags', to_db, layout))
+    con.commit()
+    ########################### Table ways_nodes ##########################################
+    cur.execute('''DROP TABLE IF EXISTS ways_nodes; ''')
+    con.commit()
+    cur.execute(table_schema('ways_nodes', layout))
+    con.commit()
+    with open_csv(os.path.join(csv_dir, 'ways_nodes.csv')) as fin:
+        dr = csv.DictReader(fin) # comma is default delimiter
+        to_db = [(i['id'].decode("utf-8"),i['node_id'].decode("utf-8"),
+                  i['position'].decode("utf-8")) for i in dr]
+        cur.executemany(insert + """ INTO ways_nodes (id, node_id, position)
+                        VALUES (?,?,?);""", clustered('ways_nodes', to_db, layout))
+    con.commit()
+    ########################### Tables of relations #######################################
+    # They stay empty for .csv files written before clean_data.py kept the relations.
+    for table in ['relations', 'relations_tags', 'relations_members']:
+        cur.execute('DROP TABLE IF EXISTS {0};'.format(table))
+        cur.execute(table_schema(table, layout))
+        con.commit()
+        if csv_exists(os.path.join(csv_dir, table + '.csv')):
+            with open_csv(os.path.join(csv_dir, table + '.csv')) as fin:
+                dr = csv.DictReader(fin) # comma is default delimiter
+                to_db = [csv_row(table, i) for i in dr]
+                cur.executemany('{0} INTO {1} ({2}) VALUES ({3});'.format(
+                    insert, table, ', '.join(COLUMNS[table]),
+                    ','.join('?' * len(COLUMNS[table]))), clustered(table, to_db, layout))
+        con.commit()
+    ########################### Table raw_tags ############################################
+    # Uncleaned tags, used by reclean.py. It stays empty for .csv files written before
+    # clean_data.py kept them.
+    cur.execute('''DROP TABLE IF EXISTS raw_tags; ''')
+    con.commit()
+    cur.execute(TABLE_SCHEMAS['raw_tags'])
+    con.commit()
+    if csv_exists(os.path.join(csv_dir, 'raw_tags.csv')):
+        with open_csv(os.path.join(csv_dir, 'raw_tags.csv')) as fin:
+            dr = csv.DictReader(fin) # comma is default delimiter
+            to_db = [csv_row('raw_tags', i) for i in dr]
+            cur.executemany("""INSERT INTO raw_tags (element, id, k, v)
+                            VALUES (?,?,?,?);""", to_db)
+    con.commit()
+    ########################### Table tiles ###############################################
+    # Only written by clean_data.py when it is given a tile_zoom (see quadtiles.py)
+    cur.execute('''DROP TABLE IF EXISTS tiles; ''')
+    con.commit()
+    cur.execute(TABLE_SCHEMAS['tiles'])
+    con.commit()
+    if csv_exists(os.path.join(csv_dir, 'tiles.csv')):
+        with open_csv(os.path.join(csv_dir, 'tiles.csv')) as fin:
+            dr = csv.DictReader(fin) # comma is default delimiter
+            to_db = sorted((e, int(t), int(n), int(z)) for e, t, n, z in
+                           (csv_row('tiles', i) for i in dr))
+            cur.executemany("""INSERT INTO tiles (element, tile, id, zoom)
+                            VALUES (?,?,?,?);""", to_db)
+    con.commit()
+    create_iso_views(con)
+    con.close()
+
+
+def create_iso_views(con):
+    for view, table, columns in ISO_VIEWS:
+        con.execute('DROP VIEW IF EXISTS {0};'.format(view))
+        con.execute('CREATE VIEW {0} AS SELECT {1}, {2} FROM {3};'.format(
+            view, columns, ISO_FORMAT, table))
+    con.commit()
+
+
+def create_indexes(sql_file=sql_file):
+    """Creates the INDEXES on an already loaded database, but those that only repeat the
+    start of the primary key of a clustered table, and the BLOB_INDEXES if it has tag
+    blobs"""
+    con = sqlite3.connect(sql_file)
+    cur = con.cursor()
+    for name, table, columns in INDEXES + (BLOB_INDEXES if has_tag_blobs(con) else []):
+        if row_order(con, table) != 'rowid' and \
+                CLUSTERED_KEYS[table][:columns.count(',') + 1] == columns.split(', '):
+            continue
+        cur.execute('CREATE INDEX IF NOT EXISTS {0} ON {1} ({2});'.format(name, table,
+                                                                          columns))
+    cur.execute('ANALYZE;')
+    con.commit()
+    con.close()
+
+
+def create_tile_table(sql_file=sql_file, zoom=14):
+    """Fills the table tiles of an already loaded database: the quadtile of every node and
+    of every way (by its first node) at zoom"""
+    import numpy as np
+    from quadtiles import tile_key
+
+    con = sqlite3.connect(sql_file)
+    cur = con.cursor()
+    cur.execute('DROP TABLE IF EXISTS tiles;')
+    cur.execute(TABLE_SCHEMAS['tiles'])
+    for element, query in [('node', 'SELECT id, lat, lon FROM nodes'),
+                           ('way', '''SELECT w.id, n.lat, n.lon FROM ways_nodes w
+                                   JOIN nodes n ON n.id = w.node_id WHERE w.position = 0''')]:
+        rows = cur.execute(query + ' ORDER BY 1;').fetchall()
+        if not rows:
+            continue
+        ids = np.array([r[0] for r in rows], dtype=np.int64)
+        tiles = tile_key(np.array([r[1] for r in rows]), np.array([r[2] for r in rows]), zoom)
+        order = np.lexsort((ids, tiles))
+        cur.executemany('INSERT INTO tiles (element, tile, id, zoom) VALUES (?,?,?,?);',
+                        ((element, int(tiles[i]), int(ids[i]), zoom) for i in order))
+    con.commit()
+    con.close()
+
+
+def create_search_index(sql_file=sql_file):
+    """Creates the FTS5 table search from the tags of nodes and ways"""
+    con = sqlite3.connect(sql_file)
+    cur = con.cursor()
+    cur.execute('DROP TABLE IF EXISTS search;')
+    cur.execute(SEARCH_SCHEMA.format(', '.join(c for c, k, t in SEARCH_COLUMNS)))
+    pivot = ', '.join("MAX(CASE WHEN key = '{0}' AND type = '{1}' THEN value END)".format(k, t)
+                      for c, k, t in SEARCH_COLUMNS)
+    keys = ', '.join("'{0}'".format(k) for c, k, t in SEARCH_COLUMNS)
+    for table, element in [('nodes_tags', 'node'), ('ways_tags', 'way')]:
+        cur.execute("""INSERT INTO search (id, element, {0})
+                    SELECT id, '{1}', {2} FROM {3} WHERE key IN ({4}) GROUP BY id;""".format(
+                    ', '.join(c for c, k, t in SEARCH_COLUMNS), element, pivot, table, keys))
+    cur.execute("INSERT INTO search (search) VALUES ('optimize');")
+    con.commit()
+    con.close()
+
+
+def create_address_table(sql_file=sql_file):
+    """Creates the addresses table pivoting the 'addr' tags of nodes and ways"""
+    con = sqlite3.connect(sql_file)
+    cur = con.cursor()
+    cur.execute('DROP TABLE IF EXISTS addresses;')
+    cur.execute(ADDRESS_SCHEMA)
+    pivot = ', '.join("MAX(CASE WHEN key = '{0}' THEN value END) AS {0}".format(k)
+                      for k in ADDRESS_KEYS)
+    keys = ', '.join("'{0}'".format(k) for k in ADDRESS_KEYS)
+    tags = """SELECT id, {0} FROM {1} WHERE type = 'addr' AND key IN ({2})
+           GROUP BY id"""
+    insert = """INSERT INTO addresses (id, element, housenumber, street, u_street, suite,
+             postcode, city, lat, lon)
+             SELECT t.id, '{0}', COALESCE(t.housenumber, t.homenumber), t.street, t.u_street,
+             t.suite, t.postcode, t.city, p.lat, p.lon FROM ({1}) t
+             LEFT JOIN {2} p ON p.id = t.id
+             WHERE t.street IS NOT NULL OR t.housenumber IS NOT NULL;"""
+    cur.execute(insert.format('node', tags.format(pivot, 'nodes_tags', keys), 'nodes'))
+    centroids = """(SELECT ways_nodes.id, AVG(nodes.lat) AS lat, AVG(nodes.lon) AS lon
+                FROM ways_nodes JOIN nodes ON nodes.id = ways_nodes.node_id
+                GROUP BY ways_nodes.id)"""
+    cur.execute(insert.format('way', tags.format(pivot, 'ways_tags', keys), centroids))
+    for name, table, columns in ADDRESS_INDEXES:
+        cur.execute('CREATE INDEX {0} ON {1} ({2});'.format(name, table, columns))
+    con.commit()
+    con.close()
+
+
+if __name__ == '__main__':
+    create_db(sql_file)
+    create_search_index(sql_file)
+    create_address_table(sql_file)
@@ -0,0 +1,141 @@
+"""
+Tells what changed between two builds of clean_data.py (after changing a cleaning rule or
+pulling a new extract) without diffing the .csv files themselves.
+
+Both builds have to be made with process_map(..., hashes=True), which writes to hashes.csv
+a short hash of the attributes, the shaped tags and the nodes or members of every element,
+and the names of the cleaning rules that changed its tags. The rows come in the order of the
+.osm file (nodes, then ways, then relations, each by id), so the two files are compared by
+merging them line by line: memory stays constant whatever the size of the extract and the
+lines that are the same in both builds (most of them) are not even parsed.
+
+    python diff_builds.py old_build/ new_build/ [--out changes.csv] [--show 20]
+
+Every added, removed and modified element goes to --out with the rules that fired on it in
+each build, and the number of changes by element and by rule is printed.
+"""
+import argparse
+import csv
+import os
+import time
+from collections import Counter
+
+import clean_data
+from compressed_csv import open_csv
+
+ORDER = {'node': 0, 'way': 1, 'relation': 2}  # order of the elements in an .osm file
+CHANGES = ['added', 'removed', 'modified']
+CHANGES_FIELDS = ['change', 'element', 'id', 'old_rules', 'new_rules']
+SHOW = 20
+
+
+def read_hashes(build):
+    """Lines of the hashes.csv of the directory build (or of the file build), without the
+    header. It may be compressed."""
+    path = build
+    if os.path.isdir(build):
+        path = os.path.join(build, clean_data.HASHES_PATH)
+    with open_csv(path) as f:
+        lines = iter(f)
+        header = next(lines, '').rstrip('\r\n').split(',')
+        if header != clean_data.HASHES_FIELDS:
+            raise ValueError('{0} is not a file of content hashes'.format(path))
+        for line in lines:
+            yield line
+
+
+def parse(line):
+    """(sort key, element, id, hash, rules) of a line of hashes.csv"""
+    element, element_id, content, rules = line.rstrip('\r\n').split(',')
+    return (ORDER[element], int(element_id)), element, element_id, content, rules
+
+
+def diff(old, new):
+    """Yields (change, element, id, old rules, new rules) of the elements added, removed or
+    modified from the lines old to the lines new, both in the order of an .osm file.
+    ValueError if a line is out of order."""
+    old, new = iter(old), iter(new)
+    a, b = next(old, None), next(new, None)
+    last = {'old': (-1, -1), 'new': (-1, -1)}
+
+    def check(side, key):
+        if key <= last[side]:
+            raise ValueError('The {0} hashes are not in the order of an .osm file at '
+                             '{1}'.format(side, key))
+        last[side] = key
+
+    pa = pb = None
+    while a is not None or b is not None:
+        if a == b:
+            a, b = next(old, None), next(new, None)
+            pa = pb = None
+            continue
+        if a is not None and pa is None:
+            pa = parse(a)
+            check('old', pa[0])
+        if b is not None and pb is None:
+            pb = parse(b)
+            check('new', pb[0])
+        if b is None or (a is not None and pa[0] < pb[0]):
+            yield 'removed', pa[1], pa[2], pa[4], ''
+            a, pa = next(old, None), None
+        elif a is None or pb[0] < pa[0]:
+            yield 'added', pb[1], pb[2], '', pb[4]
+            b, pb = next(new, None), None
+        else:
+            if pa[3] != pb[3]:
+                yield 'modified', pa[1], pa[2], pa[4], pb[4]
+            a, b = next(old, None), next(new, None)
+            pa = pb = None
+
+
+def compare(old_build, new_build, out=None, show=SHOW):
+    """Diffs the hashes of two builds, writing every change to the .csv file out. Returns
+    the counts of changes by (change, element) and by (change, rule), the first show changes
+    and the seconds taken."""
+    start = time.time()
+    by_element = Counter()
+    by_rule = Counter()
+    first = []
+    f = open(out, 'wb') if out else open(os.devnull, 'wb')
+    with f:
+        writer = csv.writer(f)
+        writer.writerow(CHANGES_FIELDS)
+        for change in diff(read_hashes(old_build), read_hashes(new_build)):
+            kind, element, element_id, old_rules, new_rules = change
+            writer.writerow(change)
+            by_element[(kind, element)] += 1
+            for rule in set(old_rules.split(';') + new_rules.split(';')) - set(['']):
+                by_rule[(kind, rule)] += 1
+            if len(first) < show:
+                first.append(change)
+    return by_element, by_rule, first, time.time() - start
+
+
+def print_report(by_element, by_rule, first, seconds):
+    print '{0:<10s} {1:>10s} {2:>10s} {3:>10s}'.format('change', 'nodes', 'ways', 'relations')
+    for kind in CHANGES:
+        print '{0:<10s} {1:>10d} {2:>10d} {3:>10d}'.format(
+            kind, *[by_element[(kind, e)] for e in sorted(ORDER, key=ORDER.get)])
+    print ' '
+    print 'Rules that fired on the changed elements (in either build):'
+    for rule in sorted(set(r for k, r in by_rule)):
+        print '    {0:<16s} {1}'.format(rule, ', '.join(
+            '{0} {1}'.format(by_rule[(kind, rule)], kind) for kind in CHANGES
+            if by_rule[(kind, rule)]))
+    print ' '
+    for kind, element, element_id, old_rules, new_rules in first:
+        print '{0:<8s} {1} {2:<12s} rules: {3} -> {4}'.format(
+            kind, element, element_id, old_rules or '-', new_rules or '-')
+    print 'Compared in {0:.2f}s'.format(seconds)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Elements added, removed and modified '
+                                                 'between two builds of clean_data.py')
+    parser.add_argument('old', help='directory (or hashes.csv) of the old build')
+    parser.add_argument('new', help='directory (or hashes.csv) of the new build')
+    parser.add_argument('--out', help='write every change to this .csv file')
+    parser.add_argument('--show', type=int, default=SHOW, help='changes to print')
+    args = parser.parse_args()
+    print_report(*compare(args.old, args.new, args.out, args.show))
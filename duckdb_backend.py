@@ -0,0 +1,300 @@
+"""
+Optional DuckDB backend for the queries of query_db.py.
+
+Most of those queries are big aggregations (GROUP BY user over nodes UNION ALL ways, counts
+of amenities, changes per year) that a columnar engine runs over whole columns at a time and
+on every core, where SQLite steps through its rows one by one. load copies the five tables
+of the map (and myview) into a DuckDB file from:
+
+- a directory with the .csv files of clean_data.py, plain or compressed (see
+  compressed_csv.py), or with <table>.parquet files of the same columns,
+- or an existing SQLite database.
+
+The queries then run unchanged, except for those in DIALECT, through DuckDBPool, which has the
+interface of query_runner.SQLitePool:
+
+    python query_runner.py --duckdb TampaFlorida.duckdb --out reports
+
+Running the script builds the DuckDB file and runs every query on both databases, checking
+that they give the same results and comparing their latency:
+
+    python duckdb_backend.py [regions/tampa/] [--db TampaFlorida.db] [--out a.duckdb]
+
+The SQL is the one of DuckDB 0.2.0, the last release with wheels for Python 2.7: no CREATE OR
+REPLACE TABLE, no TRY_CAST and no typed read_csv, so the .csv files are loaded with COPY
+into a table of the right types.
+"""
+import argparse
+import os
+import Queue
+import re
+import shutil
+import sqlite3
+import tempfile
+import time
+
+import pandas as pd
+
+import make_a_view
+from compressed_csv import find_csv, open_csv
+from query_db import QUERIES, query10
+from query_runner import SQLitePool, WORKERS
+
+# query_runner (and pyarrow) has to be imported first: duckdb 0.2.0 crashes pyarrow when it is
+# loaded before it
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+database = "TampaFlorida.db"
+DUCKDB_FILE = "TampaFlorida.duckdb"
+
+# Columns of the .csv files and their types. Timestamps are read as text and converted like
+# create_db.parse_timestamp does (DuckDB 0.2 only casts 'YYYY-MM-DD HH:MM:SS' to a TIMESTAMP).
+CSV_COLUMNS = {
+    'nodes': [('id', 'BIGINT'), ('lat', 'DOUBLE'), ('lon', 'DOUBLE'), ('user', 'VARCHAR'),
+              ('uid', 'BIGINT'), ('version', 'VARCHAR'), ('changeset', 'BIGINT'),
+              ('timestamp', 'VARCHAR')],
+    'nodes_tags': [('id', 'BIGINT'), ('key', 'VARCHAR'), ('value', 'VARCHAR'),
+                   ('type', 'VARCHAR')],
+    'ways': [('id', 'BIGINT'), ('user', 'VARCHAR'), ('uid', 'BIGINT'), ('version', 'VARCHAR'),
+             ('changeset', 'BIGINT'), ('timestamp', 'VARCHAR')],
+    'ways_tags': [('id', 'BIGINT'), ('key', 'VARCHAR'), ('value', 'VARCHAR'),
+                  ('type', 'VARCHAR')],
+    'ways_nodes': [('id', 'BIGINT'), ('node_id', 'BIGINT'), ('position', 'INTEGER')],
+}
+TABLES = ['nodes', 'nodes_tags', 'ways', 'ways_tags', 'ways_nodes']
+
+# DuckDB 0.2 parses some decimals one unit in the last place away from float(): the DOUBLE
+# columns of a .csv file are read as text, and their digits divided by a power of ten, which
+# is correctly rounded (exact up to 15 digits, OSM coordinates have 7 decimals).
+EXACT_DOUBLE = """(CAST(CAST(replace("{0}", '.', '') AS BIGINT) AS DOUBLE) /
+pow(10, length(regexp_replace("{0}", '^[^.]*\\.?', ''))))"""
+
+# The same columns as the tables of create_db.py, with the timestamps in seconds since 1970
+TIMESTAMP = "CAST(replace(replace(timestamp, 'T', ' '), 'Z', '') AS TIMESTAMP)"
+TIMESTAMP_COLUMNS = """CAST(epoch(ts) AS BIGINT) AS timestamp,
+CAST(year(ts) AS INTEGER) AS year, CAST(month(ts) AS INTEGER) AS month"""
+
+MYVIEW = """CREATE VIEW myview AS SELECT e.user, e.year as Year, COUNT(*) as num
+FROM (SELECT "user", year FROM nodes UNION ALL SELECT "user", year FROM ways ) e
+GROUP BY e.user, e.year ORDER BY num DESC, e.year DESC"""
+
+# SQLite turns text into a number with value * 1 (0 if it is not one); DuckDB needs a cast,
+# and 0.2 has no TRY_CAST, so only the values that look like a number are cast.
+NUMBER_RE = r'^[-+]?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][-+]?[0-9]+)?$'
+DUCKDB_QUERY10 = query10.replace(
+    'ORDER BY i.value *1\nDESC',
+    "ORDER BY CASE WHEN regexp_matches(i.value, '{0}') THEN CAST(i.value AS DOUBLE)\n"
+    "ELSE 0 END DESC".format(NUMBER_RE))
+
+# user alone is CURRENT_USER in DuckDB, the column has to be quoted
+USER_RE = re.compile(r'(?<![."\w])user\b')
+
+
+def to_duckdb(sql):
+    """sql of query_db.py in the DuckDB dialect"""
+    return USER_RE.sub('"user"', DUCKDB_QUERY10 if sql == query10 else sql)
+
+
+# SQL of query_db.py -> the same query in the DuckDB dialect
+DIALECT = dict((sql, to_duckdb(sql)) for sql in QUERIES.values() if to_duckdb(sql) != sql)
+
+
+def column_sql(column, kind, csv):
+    """Expression of a column of csv_table (csv) or of a .parquet file as in create_db.py"""
+    if kind == 'VARCHAR':
+        # Empty fields are empty strings, as create_db.py loads them, not NULLs
+        return 'COALESCE("{0}", \'\') AS "{0}"'.format(column)
+    if kind == 'DOUBLE' and csv:
+        return '{0} AS "{1}"'.format(EXACT_DOUBLE.format(column), column)
+    return '"{0}"'.format(column)
+
+
+def quoted(path):
+    return "'{0}'".format(path.replace("'", "''"))
+
+
+def copy_csv(con, source, table):
+    """Loads the .csv file of table in the directory source into the table csv_table, with
+    the types of CSV_COLUMNS (DOUBLE as text, see EXACT_DOUBLE). COPY reads plain and gzip
+    files; the others are decompressed to a temporary file first."""
+    path, codec = find_csv(os.path.join(source, table + '.csv'))
+    con.execute('DROP TABLE IF EXISTS csv_table;')
+    con.execute('CREATE TABLE csv_table ({0});'.format(
+        ', '.join('"{0}" {1}'.format(c, 'VARCHAR' if t == 'DOUBLE' else t)
+                  for c, t in CSV_COLUMNS[table])))
+    if codec in (None, 'gzip'):
+        con.execute('COPY csv_table FROM {0} (HEADER);'.format(quoted(path)))
+        return
+    fd, plain = tempfile.mkstemp(suffix='.csv')
+    try:
+        with os.fdopen(fd, 'wb') as fout, open_csv(os.path.join(source, table + '.csv')) \
+                as fin:
+            shutil.copyfileobj(fin, fout)
+        con.execute('COPY csv_table FROM {0} (HEADER);'.format(quoted(plain)))
+    finally:
+        os.remove(plain)
+
+
+def table_source(con, source, table):
+    """FROM clause that reads table from the directory source (a .csv file is loaded into
+    csv_table first)"""
+    parquet = os.path.join(source, table + '.parquet')
+    if os.path.exists(parquet):
+        return 'read_parquet({0})'.format(quoted(parquet))
+    if find_csv(os.path.join(source, table + '.csv'))[0] is None:
+        raise IOError('No {0}.csv nor {0}.parquet in {1}'.format(table, source))
+    copy_csv(con, source, table)
+    return 'csv_table'
+
+
+def load(duck_file=DUCKDB_FILE, source=database):
+    """Creates (or replaces) the tables of query_db.py and myview in duck_file from source, a
+    directory of .csv/.parquet files or a SQLite database. Returns the seconds it took."""
+    if duckdb is None:
+        raise ImportError('duckdb is needed for the DuckDB backend')
+    start = time.time()
+    con = duckdb.connect(duck_file)
+    con.execute('DROP VIEW IF EXISTS myview;')
+    for table in TABLES:
+        con.execute('DROP TABLE IF EXISTS {0};'.format(table))
+    if os.path.isdir(source):
+        for table in TABLES:
+            from_sql = table_source(con, source, table)
+            columns = [column_sql(c, t, from_sql == 'csv_table')
+                       for c, t in CSV_COLUMNS[table] if c != 'timestamp']
+            if table in ('nodes', 'ways'):
+                select = """SELECT {0}, {1} FROM (SELECT *, {2} AS ts FROM {3}) t""".format(
+                    ', '.join(columns), TIMESTAMP_COLUMNS, TIMESTAMP, from_sql)
+            else:
+                select = 'SELECT {0} FROM {1}'.format(', '.join(columns), from_sql)
+            con.execute('CREATE TABLE {0} AS {1};'.format(table, select))
+        con.execute('DROP TABLE IF EXISTS csv_table;')
+    else:
+        sqlite_con = sqlite3.connect(source)
+        for table in TABLES:
+            df = pd.read_sql_query('SELECT * FROM {0};'.format(table), sqlite_con)
+            con.register('sqlite_table', df)
+            con.execute('CREATE TABLE {0} AS SELECT * FROM sqlite_table;'.format(table))
+            con.unregister('sqlite_table')
+        sqlite_con.close()
+    con.execute(MYVIEW)
+    con.close()
+    return time.time() - start
+
+
+def column_names(sql, names):
+    """names of the columns of the result of sql in the case sql gives them (DuckDB lowercases
+    them): the one of their alias, else of their first mention"""
+    out = []
+    for name in names:
+        found = (re.search(r'\bas\s+({0})\b'.format(re.escape(name)), sql, re.I) or
+                 re.search(r'\b({0})\b'.format(re.escape(name)), sql, re.I))
+        out.append(found.group(1) if found else name)
+    return out
+
+
+class DuckDBRows(object):
+    """The fetchmany of a sqlite3 cursor over a DuckDB 0.2 cursor, which does not have it
+    (and whose fetchone raises TypeError past the last row): the rows are fetched at once"""
+
+    def __init__(self, cursor):
+        self.rows = cursor.fetchall()
+        self.start = 0
+
+    def fetchmany(self, size):
+        rows = self.rows[self.start:self.start + size]
+        self.start += len(rows)
+        return rows
+
+
+class DuckDBPool(SQLitePool):
+    """query_runner.SQLitePool over a DuckDB file: one read-only connection and a cursor of
+    it per worker. DuckDB parallelises every query by itself, so a couple of workers are
+    enough."""
+
+    def __init__(self, duck_file=DUCKDB_FILE, size=WORKERS):
+        if duckdb is None:
+            raise ImportError('duckdb is needed for the DuckDB backend')
+        self.con = duckdb.connect(duck_file, read_only=True)
+        self.connections = Queue.Queue()
+        for _ in range(size):
+            self.connections.put(self.con.cursor())
+        self.size = size
+
+    def execute(self, con, sql):
+        con.execute(DIALECT.get(sql, sql))
+        return DuckDBRows(con), column_names(sql, [d[0] for d in con.description or []])
+
+    def close(self):
+        for _ in range(self.size):
+            self.connections.get().close()
+        self.con.close()
+
+
+def normalise(rows):
+    return [tuple(v if isinstance(v, (int, long)) else unicode(v) for v in row)
+            for row in rows]
+
+
+def same_result(a, b):
+    """'yes' if both results have the same rows, 'ties' if they only differ in which rows
+    tied on the last column were kept by a LIMIT (both engines are free to pick any), 'NO'"""
+    a, b = normalise(a), normalise(b)
+    if sorted(a) == sorted(b):
+        return 'yes'
+    if len(a) == len(b) and sorted(r[-1] for r in a) == sorted(r[-1] for r in b):
+        return 'ties'
+    return 'NO'
+
+
+def timed(con, sql, repeat):
+    start = time.time()
+    for _ in range(repeat):
+        rows = con.execute(sql).fetchall()
+    return (time.time() - start) * 1000.0 / repeat, rows
+
+
+def compare(database=database, duck_file=DUCKDB_FILE, repeat=3):
+    """Runs every query of query_db.py on both databases. Returns a list of (name, SQLite ms,
+    DuckDB ms, same_result)"""
+    make_a_view.make_view(database)
+    sqlite_con = sqlite3.connect(database)
+    duck_con = duckdb.connect(duck_file, read_only=True)
+    results = []
+    for name in sorted(QUERIES):
+        sqlite_ms, sqlite_rows = timed(sqlite_con, QUERIES[name], repeat)
+        duck_ms, duck_rows = timed(duck_con, DIALECT.get(QUERIES[name], QUERIES[name]),
+                                   repeat)
+        results.append((name, sqlite_ms, duck_ms, same_result(sqlite_rows, duck_rows)))
+    sqlite_con.close()
+    duck_con.close()
+    return results
+
+
+def print_comparison(results):
+    print '{0:<10s} {1:>12s} {2:>12s} {3:>8s} {4:>6s}'.format('query', 'SQLite (ms)',
+                                                            'DuckDB (ms)', 'speedup', 'same')
+    for name, sqlite_ms, duck_ms, same in results:
+        print '{0:<10s} {1:>12.2f} {2:>12.2f} {3:>7.1f}x {4:>6s}'.format(
+            name, sqlite_ms, duck_ms, sqlite_ms / max(duck_ms, 1e-6), same)
+    print 'Total      {0:>12.2f} {1:>12.2f}'.format(sum(r[1] for r in results),
+                                                   sum(r[2] for r in results))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load the map into DuckDB and compare it '
+                                                 'with SQLite on the queries of query_db.py')
+    parser.add_argument('source', nargs='?',
+                        help='directory of .csv/.parquet files (default: the SQLite database)')
+    parser.add_argument('--db', default=database, help='SQLite database to compare with')
+    parser.add_argument('--out', default=DUCKDB_FILE, help='DuckDB file')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    if duckdb is None:
+        parser.error('duckdb is needed for the DuckDB backend')
+    seconds = load(args.out, args.source or args.db)
+    print 'Loaded {0} into {1} in {2:.2f}s'.format(args.source or args.db, args.out, seconds)
+    print_comparison(compare(args.db, args.out, args.repeat))
@@ -0,0 +1,174 @@
+"""
+Forward geocoding of address strings against the addresses table (see
+create_db.create_address_table).
+
+Address strings are cleaned with the same functions clean_data.py applies to the map, so
+'1412 W Kennedy Blvd, Tampa Bay, FL 33606-1234' is looked up as housenumber '1412',
+u_street 'Kennedy Boulevard', city 'Tampa' and postcode '33606'. A batch is matched with a
+single indexed join: the addresses are written to a temporary table and joined on
+(u_street, housenumber). The candidates sharing the postcode or the city rank first. An
+address whose number is not found falls back to the centre of its street.
+
+    >>> geocode_batch(['1412 W Kennedy Blvd, Tampa, FL 33606'])
+    [{'query': '1412 W Kennedy Blvd, Tampa, FL 33606', 'precision': 'address',
+      'lat': 27.9442, 'lon': -82.4722, 'id': 1234, 'element': u'node', ...}]
+
+Running the script geocodes addresses rebuilt from the addresses table and reports the
+throughput and the match rate.
+"""
+import re
+import sqlite3
+import time
+
+from clean_data import (fix_city_names, fix_street_name, fix_zipcodes, split_homenumber,
+                        split_suite, homenumber_re, street_type_re, zip_tampa)
+
+database = "TampaFlorida.db"
+
+zip_re = re.compile(r'\b\d{5}(-\d{4})?\b')
+number_re = re.compile(r'^(\d+)\s+(.+)$')
+STATES = ['FL', 'FLORIDA', 'FL.']
+COUNTRIES = ['US', 'USA', 'UNITED STATES']
+ADDRESS_PARTS = ['housenumber', 'street', 'u_street', 'suite', 'city', 'postcode']
+
+# Distinct street and city strings repeat a lot inside a batch
+street_cache = {}
+city_cache = {}
+
+
+def normalize_street(street):
+    if street not in street_cache:
+        street_cache[street] = (street, street)
+        if re.search(street_type_re, street):
+            try:
+                street_cache[street] = fix_street_name(street)
+            except IndexError:
+                # A street that is only a direction ('North', '100 W', 'So.'):
+                # clean_data.strip_cardinals strips every word of it, it is left as it is
+                pass
+    return street_cache[street]
+
+
+def normalize_city(city):
+    if city not in city_cache:
+        city_cache[city] = fix_city_names(city)
+    return city_cache[city]
+
+
+def parse_address(text):
+    """Splits an address string into housenumber, street, u_street, suite, city and postcode
+    cleaned the same way as the tags of the map"""
+    d = dict.fromkeys(ADDRESS_PARTS)
+    parts = [p.strip() for p in text.split(',')]
+    street = parts.pop(0)
+
+    for i, part in enumerate(parts):
+        m = re.search(zip_re, part)
+        if m:
+            zipcode = m.group()
+            d['postcode'] = zipcode[:5] if re.search(zip_tampa, zipcode[:5]) else \
+                fix_zipcodes(zipcode)
+            if d['postcode'] == 'FIXME':
+                d['postcode'] = None
+            parts[i] = (part[:m.start()] + part[m.end():]).strip()
+    for part in parts:
+        if part.lower().startswith('suite') or part.startswith('#'):
+            d['suite'] = split_suite(part)['suite']
+        elif part and part.upper() not in STATES and part.upper() not in COUNTRIES:
+            d['city'] = normalize_city(part)
+            break
+
+    if ' suite' in street.lower() or '#' in street:
+        addr_dict = split_suite(street)
+        d['suite'] = addr_dict['suite']
+        street = addr_dict['name']
+    if re.search(homenumber_re, street):
+        h_dict = split_homenumber(street)
+        if h_dict:
+            d['housenumber'] = h_dict['homenumber']
+            street = h_dict['name']
+    m = re.search(number_re, street)
+    if d['housenumber'] is None and m:
+        d['housenumber'], street = m.group(1), m.group(2)
+    if street:
+        d['street'], d['u_street'] = normalize_street(street)
+    return d
+
+
+ADDRESS_MATCH = """SELECT q.qid, a.id, a.element, a.lat, a.lon, a.housenumber, a.street,
+a.suite, a.postcode, a.city,
+(a.postcode IS q.postcode) * 2 + (a.city IS q.city) AS score
+FROM geocode_queries q JOIN addresses a
+ON a.u_street = q.u_street AND a.housenumber = q.housenumber
+ORDER BY q.qid, score DESC;"""
+
+STREET_MATCH = """SELECT q.qid, NULL, NULL, AVG(a.lat), AVG(a.lon), NULL, MAX(a.street), NULL,
+q.postcode, q.city, 0
+FROM geocode_queries q JOIN addresses a ON a.u_street = q.u_street
+WHERE q.matched = 0 AND (q.city IS NULL OR a.city = q.city)
+GROUP BY q.qid;"""
+
+RESULT_FIELDS = ['id', 'element', 'lat', 'lon', 'housenumber', 'street', 'suite', 'postcode',
+                 'city']
+
+
+def geocode_batch(addresses, database=database, con=None):
+    """Returns one dict per address string, in the same order, with the matched element, its
+    coordinates and the precision of the match ('address', 'street' or None)"""
+    own = con is None
+    if own:
+        con = sqlite3.connect(database)
+    parsed = []
+    for a in addresses:
+        try:
+            parsed.append(parse_address(a))
+        except (IndexError, ValueError, AttributeError):
+            # Free text the cleaning functions can not handle: left unmatched, not the batch
+            parsed.append(dict.fromkeys(ADDRESS_PARTS))
+    results = [{'query': a, 'precision': None} for a in addresses]
+    try:
+        con.execute("""CREATE TEMP TABLE IF NOT EXISTS geocode_queries (qid INTEGER PRIMARY
+                    KEY, housenumber TEXT, u_street TEXT, postcode TEXT, city TEXT,
+                    matched INTEGER);""")
+        con.execute('DELETE FROM geocode_queries;')
+        con.executemany('INSERT INTO geocode_queries VALUES (?, ?, ?, ?, ?, 0);',
+                        [(i, p['housenumber'], p['u_street'], p['postcode'], p['city'])
+                         for i, p in enumerate(parsed)])
+        for sql, precision in [(ADDRESS_MATCH, 'address'), (STREET_MATCH, 'street')]:
+            matched = []
+            for row in con.execute(sql).fetchall():
+                qid = row[0]
+                if results[qid]['precision'] is None:
+                    results[qid].update(zip(RESULT_FIELDS, row[1:-1]))
+                    results[qid]['precision'] = precision
+                    matched.append((qid,))
+            con.executemany('UPDATE geocode_queries SET matched = 1 WHERE qid = ?;', matched)
+        con.commit()
+    finally:
+        if own:
+            con.close()
+    return results
+
+
+def benchmark(database=database, n=10000):
+    """Geocodes n address strings rebuilt from the addresses table. Returns (addresses per
+    second, fraction matched to the same element)"""
+    con = sqlite3.connect(database)
+    rows = con.execute("""SELECT id, element, housenumber, street, city, postcode
+                       FROM addresses WHERE housenumber IS NOT NULL AND street IS NOT NULL
+                       LIMIT ?;""", (n,)).fetchall()
+    addresses = [u'{0} {1}, {2}, FL {3}'.format(h, s, c or '', p or '')
+                 for i, e, h, s, c, p in rows]
+    start = time.time()
+    results = geocode_batch(addresses, con=con)
+    seconds = time.time() - start
+    con.close()
+    hits = sum(1 for row, r in zip(rows, results)
+               if r['precision'] == 'address' and (r['id'], r['element']) == row[:2])
+    return len(addresses) / max(seconds, 1e-9), hits / float(max(len(rows), 1))
+
+
+if __name__ == '__main__':
+    rate, matched = benchmark()
+    print 'Geocoded {0:.0f} addresses/s, {1:.1%} matched to their element'.format(rate,
+                                                                                   matched)
@@ -0,0 +1,456 @@
+"""
+Full-history ingestion: every version of every node and way of an OSM full-history file
+(like the history extracts of planet.osm), so that the map can be queried as it was at any
+time and the changes of a street or an area can be followed.
+
+Every version gets a row in nodes_history or ways_history, keyed by (id, version), with the
+time range in which it was the current version: from its own timestamp to the timestamp of
+the next version (FOREVER for the last one). Deleted versions (visible="false") are kept too,
+so an element is absent while it was deleted. Tags are cleaned by clean_data.shape_tag like
+those of the current tables.
+
+Most edits move a node or add a node to a way and leave the tags alone, so a tag set is
+stored once in tagset_tags and every version points to it; the node lists of the ways are
+stored once in nodeset_nodes the same way.
+
+    >>> import history
+    >>> history.ingest('tampa-history.osm', 'TampaHistory.db')
+    >>> con = sqlite3.connect('TampaHistory.db')
+    >>> history.element_as_of(con, 'way', 25827392, history.timestamp('2012-01-01'))
+    >>> history.tag_history(con, 'way', 25827392, 'name')
+    >>> history.snapshot('TampaHistory.db', history.timestamp('2012-01-01'), 'Tampa2012.db')
+
+snapshot writes an ordinary database (the tables of create_db.py) of the map as of a time,
+so every query of query_db.py runs on it unchanged. query11 only counts the versions that
+survive in the current extract; HISTORY_QUERY11 counts every version of the history:
+
+    >>> con.execute(history.HISTORY_QUERY11).fetchall()
+
+Running the script benchmarks ingestion and the as-of queries on a history generated from
+the current extract (see make_history):
+
+    python history.py [tampa_florida.osm] [versions]
+"""
+import calendar
+import hashlib
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from xml.sax.saxutils import quoteattr
+
+import clean_data
+import create_db
+from query_db import query11
+
+OSM_PATH = "tampa_florida.osm"
+database = "TampaHistory.db"
+FOREVER = 2 ** 62  # valid_to of the current version of an element
+BATCH_SIZE = 10000
+
+HISTORY_SCHEMAS = [
+    """CREATE TABLE nodes_history (id INTEGER NOT NULL, version INTEGER NOT NULL,
+    visible INTEGER NOT NULL, lat REAL, lon REAL, user TEXT, uid INTEGER, changeset INTEGER,
+    valid_from INTEGER NOT NULL, valid_to INTEGER NOT NULL, tagset INTEGER NOT NULL,
+    PRIMARY KEY (id, version)) WITHOUT ROWID;""",
+    """CREATE TABLE ways_history (id INTEGER NOT NULL, version INTEGER NOT NULL,
+    visible INTEGER NOT NULL, user TEXT, uid INTEGER, changeset INTEGER,
+    valid_from INTEGER NOT NULL, valid_to INTEGER NOT NULL, tagset INTEGER NOT NULL,
+    nodeset INTEGER NOT NULL, PRIMARY KEY (id, version)) WITHOUT ROWID;""",
+    """CREATE TABLE tagset_tags (tagset INTEGER NOT NULL, key TEXT NOT NULL, value TEXT,
+    type TEXT);""",
+    """CREATE TABLE nodeset_nodes (nodeset INTEGER NOT NULL, node_id INTEGER NOT NULL,
+    position INTEGER NOT NULL, PRIMARY KEY (nodeset, position)) WITHOUT ROWID;""",
+]
+
+# As-of queries select the versions with valid_from <= t < valid_to
+HISTORY_INDEXES = [
+    ('nodes_history_from', 'nodes_history', 'valid_from, valid_to, visible'),
+    ('nodes_history_to', 'nodes_history', 'valid_to, valid_from, visible'),
+    ('nodes_history_lat_lon', 'nodes_history', 'lat, lon'),
+    ('nodes_history_tagset', 'nodes_history', 'tagset'),
+    ('ways_history_from', 'ways_history', 'valid_from, valid_to, visible'),
+    ('ways_history_to', 'ways_history', 'valid_to, valid_from, visible'),
+    ('ways_history_tagset', 'ways_history', 'tagset'),
+    ('tagset_tags_tagset', 'tagset_tags', 'tagset'),
+    ('tagset_tags_key_value', 'tagset_tags', 'key, value'),
+]
+
+ALIVE = 'valid_from <= :t AND valid_to > :t AND visible = 1'
+
+# Changes per year counting every version, not only the surviving ones (query11 of
+# query_db.py on the history tables)
+HISTORY_QUERY11 = """SELECT CAST(strftime('%Y', t.valid_from, 'unixepoch') AS INTEGER) as Year,
+COUNT(*) as changes
+FROM (SELECT valid_from FROM nodes_history UNION ALL SELECT valid_from FROM ways_history) t
+GROUP BY Year ORDER BY Year DESC;"""
+
+
+def timestamp(text):
+    """Seconds since 1970 of an OSM timestamp (2012-01-01T00:00:00Z) or a date (2012-01-01)"""
+    if len(text) == 10:
+        text += 'T00:00:00Z'
+    return create_db.parse_timestamp(text)[0]
+
+
+class SetStore(object):
+    """Numbers distinct tag sets (or node lists) by their content. Only a digest of every
+    set is kept in memory, and the rows of a set are written the first time it is seen."""
+
+    def __init__(self):
+        self.digests = {}
+        self.rows = []
+        self.referenced_rows = 0
+
+    def add(self, items):
+        """Number of the set of items (a tuple of tuples); 0 for the empty set"""
+        self.referenced_rows += len(items)
+        if not items:
+            return 0
+        digest = hashlib.md5(repr(items)).digest()
+        number = self.digests.get(digest)
+        if number is None:
+            number = self.digests[digest] = len(self.digests) + 1
+            self.rows.extend((number,) + item for item in items)
+        return number
+
+
+def version_rows(osm_file):
+    """Yields ('node' or 'way', row without valid_to, tags, node refs) for every version of
+    osm_file"""
+    for element in clean_data.get_element(osm_file, tags=('node', 'way')):
+        a = element.attrib
+        tags = tuple((t['key'], t['value'], t['type'])
+                     for tag in element.iter('tag')
+                     for t in clean_data.shape_tag(tag.attrib['k'], tag.attrib['v'], a['id']))
+        visible = 0 if a.get('visible') == 'false' else 1
+        common = (int(a['id']), int(a['version']), visible)
+        user = (a.get('user'), int(a['uid']) if 'uid' in a else None,
+                int(a['changeset']) if 'changeset' in a else None,
+                create_db.parse_timestamp(a['timestamp'])[0])
+        if element.tag == 'node':
+            # As text, converted by the REAL column like create_db.py does with the .csv files
+            yield 'node', common + (a.get('lat'), a.get('lon')) + user, tags, ()
+        else:
+            refs = tuple((int(nd.attrib['ref']), i) for i, nd in enumerate(element.iter('nd')))
+            yield 'way', common + user, tags, refs
+
+
+def ingest(osm_file, database=database):
+    """Loads every version of the nodes and ways of osm_file (sorted by type, id and version,
+    as history files are) into the history tables of database. Returns statistics."""
+    start = time.time()
+    con = sqlite3.connect(database)
+    for table in ['nodes_history', 'ways_history', 'tagset_tags', 'nodeset_nodes']:
+        con.execute('DROP TABLE IF EXISTS {0};'.format(table))
+    for sql in HISTORY_SCHEMAS:
+        con.execute(sql)
+    tagsets, nodesets = SetStore(), SetStore()
+    batches = {'node': [], 'way': []}
+    inserts = {'node': 'INSERT INTO nodes_history VALUES (?,?,?,?,?,?,?,?,?,?,?);',
+               'way': 'INSERT INTO ways_history VALUES (?,?,?,?,?,?,?,?,?,?);'}
+    versions = {'node': 0, 'way': 0}
+
+    def flush(pending, valid_to):
+        tag, row, tags, refs = pending
+        row = row + (valid_to, tagsets.add(tags))
+        if tag == 'way':
+            row += (nodesets.add(refs),)
+        batches[tag].append(row)
+        versions[tag] += 1
+        if len(batches[tag]) >= BATCH_SIZE:
+            con.executemany(inserts[tag], batches[tag])
+            del batches[tag][:]
+        for store, table in [(tagsets, 'tagset_tags'), (nodesets, 'nodeset_nodes')]:
+            if len(store.rows) >= BATCH_SIZE:
+                con.executemany('INSERT INTO {0} VALUES ({1});'.format(
+                    table, ','.join('?' * len(store.rows[0]))), store.rows)
+                del store.rows[:]
+
+    pending = None
+    for current in version_rows(osm_file):
+        if pending is not None:
+            same = pending[0] == current[0] and pending[1][0] == current[1][0]
+            if same and current[1][1] <= pending[1][1]:
+                raise ValueError('{0} {1}: version {2} after version {3}, the file is not '
+                                 'sorted'.format(current[0], current[1][0], current[1][1],
+                                                 pending[1][1]))
+            # A version is valid until the next one (timestamp is the last column of row)
+            flush(pending, current[1][-1] if same else FOREVER)
+        pending = current
+    if pending is not None:
+        flush(pending, FOREVER)
+    for tag in batches:
+        con.executemany(inserts[tag], batches[tag])
+    for store, table in [(tagsets, 'tagset_tags'), (nodesets, 'nodeset_nodes')]:
+        if store.rows:
+            con.executemany('INSERT INTO {0} VALUES ({1});'.format(
+                table, ','.join('?' * len(store.rows[0]))), store.rows)
+    con.commit()
+    create_history_indexes(con)
+    stats = {'node_versions': versions['node'], 'way_versions': versions['way'],
+             'tagsets': len(tagsets.digests), 'tag_rows_copied': tagsets.referenced_rows,
+             'nodesets': len(nodesets.digests),
+             'nodeset_rows_copied': nodesets.referenced_rows}
+    for name, table in [('tag_rows', 'tagset_tags'), ('nodeset_rows', 'nodeset_nodes')]:
+        stats[name] = con.execute('SELECT COUNT(*) FROM {0};'.format(table)).fetchone()[0]
+    con.close()
+    stats['seconds'] = time.time() - start
+    return stats
+
+
+def create_history_indexes(con):
+    for name, table, columns in HISTORY_INDEXES:
+        con.execute('CREATE INDEX IF NOT EXISTS {0} ON {1} ({2});'.format(name, table,
+                                                                         columns))
+    con.execute('ANALYZE;')
+    con.commit()
+
+
+def drop_history_indexes(con):
+    for name, table, columns in HISTORY_INDEXES:
+        con.execute('DROP INDEX IF EXISTS {0};'.format(name))
+    con.execute('ANALYZE;')
+    con.commit()
+
+
+################################### As-of queries ############################################
+
+def element_as_of(con, element, element_id, t):
+    """The version of a node or way that was current at time t (seconds since 1970), as a
+    dict with its tags (and node ids for a way). None if it did not exist or was deleted."""
+    table = 'nodes_history' if element == 'node' else 'ways_history'
+    cur = con.execute('SELECT * FROM {0} WHERE id = :id AND valid_from <= :t AND '
+                      'valid_to > :t;'.format(table), {'id': element_id, 't': t})
+    row = cur.fetchone()
+    if row is None:
+        return None
+    result = dict(zip([d[0] for d in cur.description], row))
+    if not result['visible']:
+        return None
+    result['tags'] = con.execute('SELECT key, value, type FROM tagset_tags WHERE tagset = ? '
+                                 'ORDER BY rowid;', (result['tagset'],)).fetchall()
+    if element == 'way':
+        result['nodes'] = [n for n, in con.execute(
+            'SELECT node_id FROM nodeset_nodes WHERE nodeset = ? ORDER BY position;',
+            (result['nodeset'],))]
+    return result
+
+
+def nodes_as_of(con, t, bbox=None):
+    """(id, version, lat, lon) of the nodes that existed at time t, inside bbox (south, west,
+    north, east) if given"""
+    sql = 'SELECT id, version, lat, lon FROM nodes_history WHERE ' + ALIVE
+    params = {'t': t}
+    if bbox is not None:
+        sql += ' AND lat BETWEEN :s AND :n AND lon BETWEEN :w AND :e'
+        params.update(zip('swne', bbox))
+    return con.execute(sql + ';', params).fetchall()
+
+
+def tag_history(con, element, element_id, key):
+    """[(valid_from, valid_to, value)] of the key of an element (None while it had no such
+    tag or did not exist), consecutive versions with the same value merged"""
+    table = 'nodes_history' if element == 'node' else 'ways_history'
+    rows = con.execute("""SELECT h.valid_from, h.valid_to, CASE WHEN h.visible THEN
+                       (SELECT value FROM tagset_tags t WHERE t.tagset = h.tagset AND
+                        t.key = :key ORDER BY rowid LIMIT 1) END
+                       FROM {0} h WHERE h.id = :id ORDER BY h.version;""".format(table),
+                       {'id': element_id, 'key': key}).fetchall()
+    merged = []
+    for valid_from, valid_to, value in rows:
+        if merged and merged[-1][2] == value:
+            merged[-1] = (merged[-1][0], valid_to, value)
+        else:
+            merged.append((valid_from, valid_to, value))
+    return merged
+
+
+# Every version of the history tables (aliased e) that was current at :t
+SNAPSHOT_QUERIES = [
+    ('nodes', """SELECT id, lat, lon, user, uid, CAST(version AS TEXT), changeset, valid_from,
+     CAST(strftime('%Y', valid_from, 'unixepoch') AS INTEGER),
+     CAST(strftime('%m', valid_from, 'unixepoch') AS INTEGER)
+     FROM h.nodes_history e WHERE {0} ORDER BY id;"""),
+    ('nodes_tags', """SELECT e.id, t.key, t.value, t.type FROM h.nodes_history e
+     JOIN h.tagset_tags t ON t.tagset = e.tagset WHERE {0} ORDER BY e.id, t.rowid;"""),
+    ('ways', """SELECT id, user, uid, CAST(version AS TEXT), changeset, valid_from,
+     CAST(strftime('%Y', valid_from, 'unixepoch') AS INTEGER),
+     CAST(strftime('%m', valid_from, 'unixepoch') AS INTEGER)
+     FROM h.ways_history e WHERE {0} ORDER BY id;"""),
+    ('ways_tags', """SELECT e.id, t.key, t.value, t.type FROM h.ways_history e
+     JOIN h.tagset_tags t ON t.tagset = e.tagset WHERE {0} ORDER BY e.id, t.rowid;"""),
+    ('ways_nodes', """SELECT e.id, n.node_id, n.position FROM h.ways_history e
+     JOIN h.nodeset_nodes n ON n.nodeset = e.nodeset WHERE {0} ORDER BY e.id, n.position;"""),
+]
+
+
+def snapshot(history_db, t, sql_file):
+    """Writes the map as it was at time t to sql_file, with the tables of create_db.py (the
+    relations, raw tags and tiles stay empty), so the queries of query_db.py run on it"""
+    if os.path.exists(sql_file):
+        os.remove(sql_file)
+    con = sqlite3.connect(sql_file)
+    for table in create_db.COLUMNS:
+        con.execute(create_db.TABLE_SCHEMAS[table])
+    con.execute('ATTACH DATABASE ? AS h;', (history_db,))
+    alive = 'e.valid_from <= :t AND e.valid_to > :t AND e.visible = 1'
+    for table, sql in SNAPSHOT_QUERIES:
+        con.execute('INSERT INTO {0} ({1}) {2}'.format(
+            table, ', '.join(create_db.COLUMNS[table]), sql.format(alive)), {'t': t})
+    con.commit()
+    con.execute('DETACH DATABASE h;')
+    create_db.create_iso_views(con)
+    con.close()
+
+
+################################### Benchmark ################################################
+
+def make_history(osm_file, history_file, versions=4, seed=0):
+    """Writes a synthetic full-history file from a current extract: every element gets
+    versions - 1 earlier versions, most of them with the same tags (a moved node, a way with
+    one node less), some with an older name, and some nodes a deletion in between. The last
+    version is the element of the extract, so the snapshot at the end is the extract."""
+    rnd = random.Random(seed)
+    end = calendar.timegm((2007, 1, 1, 0, 0, 0))
+    out = open(history_file, 'w')
+    out.write('<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6">\n')
+    for element in clean_data.get_element(osm_file, tags=('node', 'way')):
+        a = dict(element.attrib)
+        last = create_db.parse_timestamp(a['timestamp'])[0]
+        times = sorted(rnd.randint(end, last - 1) for _ in range(versions - 1)) \
+            if last > end + versions else []
+        tags = [(t.attrib['k'], t.attrib['v']) for t in element.iter('tag')]
+        refs = [nd.attrib['ref'] for nd in element.iter('nd')]
+        for v, t in enumerate(times):
+            old_tags, old_refs, visible = list(tags), list(refs), True
+            if rnd.random() < 0.3 and old_tags:
+                i = rnd.randrange(len(old_tags))
+                if old_tags[i][0] == 'name':
+                    old_tags[i] = ('name', 'Old ' + old_tags[i][1])
+                else:
+                    del old_tags[i]
+            if len(old_refs) > 2 and rnd.random() < 0.3:
+                del old_refs[rnd.randrange(len(old_refs))]
+            if element.tag == 'node' and 0 < v == len(times) - 1 and rnd.random() < 0.05:
+                visible = False
+            write_version(out, element.tag, a, v + 1, t, visible, old_tags, old_refs, rnd)
+        write_version(out, element.tag, a, len(times) + 1, None, True, tags, refs, None)
+    out.write('</osm>\n')
+    out.close()
+
+
+def write_version(out, tag, a, version, t, visible, tags, refs, rnd):
+    attrib = dict(a)
+    attrib['version'] = str(version)
+    if t is not None:
+        attrib['timestamp'] = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(t))
+    if not visible:
+        attrib['visible'] = 'false'
+        attrib.pop('lat', None)
+        attrib.pop('lon', None)
+        tags, refs = [], []
+    elif tag == 'node' and rnd is not None:
+        attrib['lat'] = '{0:.7f}'.format(float(a['lat']) + rnd.uniform(-1e-4, 1e-4))
+        attrib['lon'] = '{0:.7f}'.format(float(a['lon']) + rnd.uniform(-1e-4, 1e-4))
+    out.write('  <{0} {1}>\n'.format(tag, ' '.join(
+        '{0}={1}'.format(k, quoteattr(v.encode('utf-8') if isinstance(v, unicode) else v))
+        for k, v in sorted(attrib.items()))))
+    for ref in refs:
+        out.write('    <nd ref="{0}"/>\n'.format(ref))
+    for k, v in tags:
+        out.write('    <tag k={0} v={1}/>\n'.format(
+            quoteattr(k.encode('utf-8') if isinstance(k, unicode) else k),
+            quoteattr(v.encode('utf-8') if isinstance(v, unicode) else v)))
+    out.write('  </{0}>\n'.format(tag))
+
+
+def timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return (time.time() - start) * 1000.0, result
+
+
+def benchmark(osm_file=OSM_PATH, versions=4):
+    tmp = tempfile.mkdtemp()
+    history_file = os.path.join(tmp, 'history.osm')
+    history_db = os.path.join(tmp, 'history.db')
+    make_history(osm_file, history_file, versions)
+    print 'History file: {0:.1f} MB ({1:.1f}x the extract)'.format(
+        os.path.getsize(history_file) / 1024.0 ** 2,
+        os.path.getsize(history_file) / float(os.path.getsize(osm_file)))
+    stats = ingest(history_file, history_db)
+    print 'Ingested {0} node and {1} way versions in {2:.2f}s'.format(
+        stats['node_versions'], stats['way_versions'], stats['seconds'])
+    print 'Tag sets: {0} distinct, {1} tag rows stored instead of {2} ({3:.1f}x less)'.format(
+        stats['tagsets'], stats['tag_rows'], stats['tag_rows_copied'],
+        stats['tag_rows_copied'] / float(max(stats['tag_rows'], 1)))
+    print 'Node lists: {0} distinct, {1} rows stored instead of {2} ({3:.1f}x less)'.format(
+        stats['nodesets'], stats['nodeset_rows'], stats['nodeset_rows_copied'],
+        stats['nodeset_rows_copied'] / float(max(stats['nodeset_rows'], 1)))
+
+    # The snapshot after the last edit is the extract itself
+    current_db = os.path.join(tmp, 'current.db')
+    snapshot_db = os.path.join(tmp, 'snapshot.db')
+    create_db_dir = os.path.join(tmp, 'csv')
+    os.mkdir(create_db_dir)
+    clean_data.process_map(osm_file, False, create_db_dir)
+    create_db.create_db(current_db, create_db_dir)
+    snapshot(history_db, FOREVER - 1, snapshot_db)
+    same = True
+    for table in ['nodes', 'nodes_tags', 'ways', 'ways_tags', 'ways_nodes']:
+        columns = ', '.join(c for c in create_db.COLUMNS[table] if c != 'version')
+        rows = [sorted(sqlite3.connect(db).execute('SELECT {0} FROM {1};'.format(
+            columns, table)).fetchall()) for db in (current_db, snapshot_db)]
+        same = same and rows[0] == rows[1]
+    print 'Snapshot at the end equals the extract:', same
+
+    con = sqlite3.connect(history_db)
+    surviving = dict(sqlite3.connect(current_db).execute(query11).fetchall())
+    ms, every = timed(lambda: con.execute(HISTORY_QUERY11).fetchall())
+    print ' '
+    print 'Changes per year ({0:.2f} ms for HISTORY_QUERY11):'.format(ms)
+    print '{0:<6s} {1:>18s} {2:>18s}'.format('year', 'query11 (current)', 'every version')
+    every = dict(every)
+    for year in sorted(set(surviving) | set(every), reverse=True):
+        print '{0:<6d} {1:>18d} {2:>18d}'.format(year, surviving.get(year, 0),
+                                                 every.get(year, 0))
+
+    lo, hi = con.execute('SELECT MIN(valid_from), MAX(valid_from) FROM nodes_history;'
+                         ).fetchone()
+    rnd = random.Random(1)
+    ids = [i for i, in con.execute('SELECT id FROM ways_history WHERE version = 1;')]
+    way_ids = rnd.sample(ids, min(200, len(ids)))
+    times = [rnd.randint(lo, hi) for _ in way_ids]
+    lat, lon = con.execute('SELECT AVG(lat), AVG(lon) FROM nodes_history;').fetchone()
+    bbox = (lat - 0.01, lon - 0.01, lat + 0.01, lon + 0.01)
+    middle = lo + (hi - lo) // 2
+
+    def way_lookups():
+        for i, t in zip(way_ids, times):
+            element_as_of(con, 'way', i, t)
+
+    def count_alive():
+        return con.execute('SELECT COUNT(*) FROM nodes_history WHERE ' + ALIVE + ';',
+                           {'t': lo + (hi - lo) // 10}).fetchone()[0]
+    cases = [('{0} ways as of random times'.format(len(way_ids)), way_lookups),
+             ('nodes in a bbox as of the middle', lambda: nodes_as_of(con, middle, bbox)),
+             ('nodes alive early on (count)', count_alive),
+             ('name history of the ways', lambda: [tag_history(con, 'way', i, 'name')
+                                                   for i in way_ids])]
+    print ' '
+    print '{0:<40s} {1:>14s} {2:>14s}'.format('query', 'indexes (ms)', 'no index (ms)')
+    indexed = [timed(f)[0] for name, f in cases]
+    drop_history_indexes(con)
+    plain = [timed(f)[0] for name, f in cases]
+    create_history_indexes(con)
+    for (name, f), a, b in zip(cases, indexed, plain):
+        print '{0:<40s} {1:>14.2f} {2:>14.2f}'.format(name, a, b)
+    con.close()
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    benchmark(args[0] if args else OSM_PATH, int(args[1]) if len(args) > 1 else 4)
@@ -0,0 +1,125 @@
+"""
+Compares the two layouts of the tag and way-node tables (see create_db.LAYOUTS): rowid
+tables, where the rows of an element lie wherever they were appended and are found through
+the index on id, and clustered WITHOUT ROWID tables, where they are stored together in the
+order of their primary key.
+
+Both databases are loaded from the same .csv files (with the INDEXES of create_db.py) into a
+temporary directory. For each one the script reports the load time and file size, the latency
+of fetching the tags of a node and the tags and nodes of a way by id (random ids, with a
+small page cache so that most pages come from the file), and the time of the self-joins of
+query07 and query08:
+
+    python layout_benchmark.py [csv_dir] [--fetches 2000] [--cache-kb 2000]
+"""
+import argparse
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+
+import create_db
+from api_server import percentile
+from query_db import query07, query08
+
+FETCHES = 2000
+CACHE_KB = 2000  # page cache of the connection
+REPEAT = 3
+
+FETCH_SQL = [
+    ('node tags', 'nodes', 'SELECT key, value, type FROM nodes_tags WHERE id = ?;'),
+    ('way tags', 'ways', 'SELECT key, value, type FROM ways_tags WHERE id = ?;'),
+    ('way nodes', 'ways', 'SELECT node_id FROM ways_nodes WHERE id = ? ORDER BY position;'),
+]
+
+
+def build(csv_dir, path, layout):
+    """Seconds to load and index the database path in layout"""
+    start = time.time()
+    create_db.create_db(path, csv_dir=csv_dir, layout=layout)
+    create_db.create_indexes(path)
+    return time.time() - start
+
+
+def fetch_latencies(cons, sql, ids):
+    """Sorted latencies (ms) of sql for every id on each connection of cons. The connections
+    take turns on every id, so that they are measured under the same conditions."""
+    latencies = [[] for _ in cons]
+    for i in ids:
+        for con, times in zip(cons, latencies):
+            start = time.time()
+            con.execute(sql, (i,)).fetchall()
+            times.append((time.time() - start) * 1000.0)
+    return [sorted(times) for times in latencies]
+
+
+def timed(con, sql, repeat=REPEAT):
+    start = time.time()
+    for _ in range(repeat):
+        result = con.execute(sql).fetchall()
+    return (time.time() - start) * 1000.0 / repeat, result
+
+
+def benchmark(csv_dir='', fetches=FETCHES, cache_kb=CACHE_KB, seed=0):
+    tmp = tempfile.mkdtemp()
+    try:
+        results = dict((layout, {}) for layout in create_db.LAYOUTS)
+        cons = []
+        for layout in create_db.LAYOUTS:
+            path = os.path.join(tmp, layout + '.db')
+            results[layout]['load'] = build(csv_dir, path, layout)
+            results[layout]['size'] = os.path.getsize(path)
+            con = sqlite3.connect(path)
+            con.execute('PRAGMA cache_size = -{0};'.format(cache_kb))
+            results[layout]['rows'] = con.execute(
+                'SELECT (SELECT COUNT(*) FROM nodes_tags) + '
+                '(SELECT COUNT(*) FROM ways_tags);').fetchone()[0]
+            cons.append(con)
+
+        rnd = random.Random(seed)
+        for name, element, sql in FETCH_SQL:
+            ids = [i for i, in cons[0].execute('SELECT id FROM {0};'.format(element))]
+            ids = [rnd.choice(ids) for _ in range(fetches)] if ids else []
+            for layout, latencies in zip(create_db.LAYOUTS, fetch_latencies(cons, sql, ids)):
+                results[layout][name] = latencies
+        for name, sql in [('query07', query07), ('query08', query08)]:
+            for layout, con in zip(create_db.LAYOUTS, cons):
+                results[layout][name] = timed(con, sql)
+        for con in cons:
+            con.close()
+        return results
+    finally:
+        shutil.rmtree(tmp)
+
+
+def print_report(results):
+    rowid, clustered = results['rowid'], results['clustered']
+    print '{0:<22s} {1:>12s} {2:>12s} {3:>8s}'.format('', 'rowid', 'clustered', 'ratio')
+    print '{0:<22s} {1:>12.2f} {2:>12.2f} {3:>7.2f}x'.format(
+        'load + indexes (s)', rowid['load'], clustered['load'],
+        rowid['load'] / clustered['load'])
+    print '{0:<22s} {1:>12.1f} {2:>12.1f} {3:>7.2f}x'.format(
+        'size (MB)', rowid['size'] / 1024.0 ** 2, clustered['size'] / 1024.0 ** 2,
+        rowid['size'] / float(clustered['size']))
+    print '{0:<22s} {1:>12d} {2:>12d}'.format('tag rows', rowid['rows'], clustered['rows'])
+    for name, element, sql in FETCH_SQL:
+        for p in (50, 99):
+            a, b = percentile(rowid[name], p), percentile(clustered[name], p)
+            print '{0:<22s} {1:>12.3f} {2:>12.3f} {3:>7.2f}x'.format(
+                '{0} p{1} (ms)'.format(name, p), a, b, a / max(b, 1e-6))
+    for name in ('query07', 'query08'):
+        (a, ra), (b, rb) = rowid[name], clustered[name]
+        print '{0:<22s} {1:>12.2f} {2:>12.2f} {3:>7.2f}x{4}'.format(
+            name + ' (ms)', a, b, a / max(b, 1e-6), '' if ra == rb else ' (differs!)')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='rowid vs clustered tag and way-node tables')
+    parser.add_argument('csv_dir', nargs='?', default='')
+    parser.add_argument('--fetches', type=int, default=FETCHES, help='ids fetched per case')
+    parser.add_argument('--cache-kb', type=int, default=CACHE_KB,
+                        help='page cache of the connections, in KB')
+    args = parser.parse_args()
+    print_report(benchmark(args.csv_dir, args.fetches, args.cache_kb))
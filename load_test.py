@@ -0,0 +1,189 @@
+"""
+Load test of api_server.py: a number of concurrent clients, each a thread with its own
+keep-alive connection, send a mix of requests built from the database (elements by id, tag
+searches, boxes around nodes, addresses and reports) and the latency of every request is
+measured on the client. Reports the p50/p99 latency of every route, the requests per second
+and the statistics of the server cache.
+
+    python load_test.py --url http://127.0.0.1:8000 --clients 8 --requests 5000
+    python load_test.py --start          # starts a server on a free port first
+
+--distinct bounds the number of different requests, and so how often the cache is hit.
+"""
+import argparse
+import httplib
+import json
+import random
+import sqlite3
+import threading
+import time
+import urllib
+import urlparse
+
+from api_server import percentile
+from query_db import QUERIES
+
+database = "TampaFlorida.db"
+URL = 'http://127.0.0.1:8000'
+CLIENTS = 8
+REQUESTS = 2000
+DISTINCT = 1000
+BOX = 0.005  # degrees around a node
+
+# Share of every kind of request in the mix
+MIX = [('node', 0.3), ('way', 0.2), ('tags', 0.15), ('bbox', 0.15), ('address', 0.15),
+       ('query', 0.05)]
+
+
+def request_mix(database=database, n=DISTINCT, seed=0):
+    """n paths in the proportions of MIX, built from the elements of database"""
+    rnd = random.Random(seed)
+    con = sqlite3.connect(database)
+    nodes = con.execute('SELECT id, lat, lon FROM nodes ORDER BY random() LIMIT ?;',
+                        (n,)).fetchall()
+    ways = [i for i, in con.execute('SELECT id FROM ways ORDER BY random() LIMIT ?;', (n,))]
+    tags = con.execute('SELECT key, value FROM nodes_tags GROUP BY key, value '
+                       'ORDER BY COUNT(*) DESC LIMIT ?;', (n,)).fetchall()
+    try:
+        addresses = [u'{0} {1}'.format(h, s) for h, s in con.execute(
+            'SELECT housenumber, street FROM addresses WHERE housenumber IS NOT NULL '
+            'ORDER BY random() LIMIT ?;', (n,))]
+    except sqlite3.OperationalError:
+        addresses = []
+    con.close()
+
+    def path(kind):
+        if kind == 'node' and nodes:
+            return '/node/{0}'.format(rnd.choice(nodes)[0])
+        if kind == 'way' and ways:
+            return '/way/{0}'.format(rnd.choice(ways))
+        if kind == 'tags' and tags:
+            key, value = rnd.choice(tags)
+            return '/tags?' + urllib.urlencode([('key', key.encode('utf-8')),
+                                                ('value', value.encode('utf-8'))])
+        if kind == 'bbox' and nodes:
+            i, lat, lon = rnd.choice(nodes)
+            return '/bbox?bbox={0:.6f},{1:.6f},{2:.6f},{3:.6f}'.format(
+                lat - BOX, lon - BOX, lat + BOX, lon + BOX)
+        if kind == 'address' and addresses:
+            address = rnd.choice(addresses).encode('utf-8')
+            return '/address?' + urllib.urlencode([('q', address)])
+        if kind == 'query':
+            return '/query/' + rnd.choice(sorted(QUERIES))
+        return None
+
+    kinds = [k for k, share in MIX]
+    weights = [share for k, share in MIX]
+    paths = []
+    while len(paths) < n:
+        p = path(weighted_choice(rnd, kinds, weights))
+        if p is not None:
+            paths.append(p)
+    return paths
+
+
+def weighted_choice(rnd, items, weights):
+    x = rnd.random() * sum(weights)
+    for item, weight in zip(items, weights):
+        x -= weight
+        if x < 0:
+            return item
+    return items[-1]
+
+
+def route(path):
+    return urlparse.urlparse(path).path.split('/')[1]
+
+
+def client(host, port, paths, results):
+    """Sends every path in turn on one connection, appending (route, ms, status) to results"""
+    con = httplib.HTTPConnection(host, port)
+    for path in paths:
+        start = time.time()
+        try:
+            con.request('GET', path)
+            response = con.getresponse()
+            response.read()
+            status = response.status
+        except (httplib.HTTPException, IOError):
+            con.close()
+            con = httplib.HTTPConnection(host, port)
+            status = 0
+        results.append((route(path), (time.time() - start) * 1000.0, status))
+    con.close()
+
+
+def run(url=URL, paths=(), clients=CLIENTS, requests=REQUESTS, seed=1):
+    """Sends requests paths (drawn from paths) with clients concurrent clients. Returns the
+    (route, ms, status) of every request and the wall time."""
+    parsed = urlparse.urlparse(url)
+    rnd = random.Random(seed)
+    results = []
+    threads = []
+    for c in range(clients):
+        mine = [rnd.choice(paths) for _ in range(requests // clients +
+                                                  (c < requests % clients))]
+        threads.append(threading.Thread(target=client, args=(parsed.hostname,
+                                                             parsed.port or 80, mine,
+                                                             results)))
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results, time.time() - start
+
+
+def print_report(results, wall):
+    by_route = {}
+    for name, ms, status in results:
+        by_route.setdefault(name, []).append((ms, status))
+    print '{0:<10s} {1:>9s} {2:>7s} {3:>9s} {4:>9s}'.format('route', 'requests', 'errors',
+                                                          'p50 (ms)', 'p99 (ms)')
+    for name in sorted(by_route) + ['all']:
+        rows = by_route.get(name) or [(ms, s) for n, ms, s in results]
+        latencies = sorted(ms for ms, s in rows)
+        print '{0:<10s} {1:>9d} {2:>7d} {3:>9.2f} {4:>9.2f}'.format(
+            name, len(rows), sum(1 for ms, s in rows if s != 200),
+            percentile(latencies, 50), percentile(latencies, 99))
+    print '{0} requests in {1:.2f}s: {2:.0f} requests/s'.format(len(results), wall,
+                                                               len(results) / wall)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test of api_server.py')
+    parser.add_argument('--url', default=URL)
+    parser.add_argument('--db', default=database, help='database to build the requests from')
+    parser.add_argument('--clients', type=int, default=CLIENTS)
+    parser.add_argument('--requests', type=int, default=REQUESTS)
+    parser.add_argument('--distinct', type=int, default=DISTINCT,
+                        help='number of different requests')
+    parser.add_argument('--start', action='store_true',
+                        help='start a server on the database on a free port')
+    args = parser.parse_args()
+    server = None
+    if args.start:
+        import api_server
+        import make_a_view
+        make_a_view.make_view(args.db)  # the server does not write it, query12 reads it
+        server = api_server.serve(args.db, port=0)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        args.url = 'http://{0}:{1}'.format(*server.server_address)
+    paths = request_mix(args.db, args.distinct)
+    try:
+        results, wall = run(args.url, paths, args.clients, args.requests)
+        print_report(results, wall)
+        parsed = urlparse.urlparse(args.url)
+        con = httplib.HTTPConnection(parsed.hostname, parsed.port or 80)
+        con.request('GET', '/metrics')
+        cache = json.loads(con.getresponse().read())['cache']
+        con.close()
+        print 'Server cache: {0} hits, {1} misses, {2} entries'.format(
+            cache['hits'], cache['misses'], cache['entries'])
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+            server.api.close()
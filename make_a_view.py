@@ -8,11 +8,31 @@ import sqlite3
 
 database = "TampaFlorida.db"
 
-db = sqlite3.connect(database)
-mydb = db.cursor()
-mydb.execute("""CREATE VIEW myview AS SELECT e.user, strftime('%Y', e.timestamp) as Year,
-COUNT(*) as num
-FROM (SELECT user, timestamp FROM nodes UNION ALL SELECT user, timestamp FROM ways ) e
-GROUP BY e.user, strftime('%Y', e.timestamp) ORDER BY num DESC,
-strftime('%Y', e.timestamp) DESC""")
-mydb.close()
+MYVIEW = """CREATE VIEW myview AS SELECT e.user, e.year as Year,
+    COUNT(*) as num
+    FROM (SELECT user, year FROM nodes UNION ALL SELECT user, year FROM ways ) e
+    GROUP BY e.user, e.year ORDER BY num DESC, e.year DESC"""
+
+
+def is_current(con):
+    """Whether con has myview as make_view creates it"""
+    row = con.execute("""SELECT sql FROM sqlite_master WHERE type = 'view'
+                      AND name = 'myview';""").fetchone()
+    return row is not None and row[0] == MYVIEW
+
+
+def make_view(database=database):
+    db = sqlite3.connect(database)
+    # Nothing is written when myview is up to date, so that several readers can start on the
+    # same file. A view made before the year column was added to nodes and ways reads
+    # strftime('%Y', timestamp), which is NULL on the epoch timestamps: it is replaced.
+    if not is_current(db):
+        mydb = db.cursor()
+        mydb.execute("""DROP VIEW IF EXISTS myview""")
+        mydb.execute(MYVIEW)
+        mydb.close()
+    db.close()
+
+
+if __name__ == '__main__':
+    make_view()
@@ -0,0 +1,304 @@
+"""
+Merges several regional databases (or several sets of .csv files written by clean_data.py)
+into a single database.
+
+Adjacent extracts overlap, so the same node or way can appear in more than one source. The
+merge is a streaming k-way merge over the sources sorted by id: for every id only the
+element with the highest version is kept, together with its own tags, way nodes, raw tags
+(see reclean.py) and tiles (see quadtiles.py), so nothing gets duplicated and the primary
+keys of nodes and ways are never violated. Only one element per source is held in memory at
+a time, whatever the size of the sources.
+
+Usage:
+    python merge_db.py florida.db tampa.db orlando.db regions/miami/ [--index]
+
+A source that is a directory is read as a set of .csv files, plain or compressed (they have
+to be sorted by id, as they are when clean_data.py writes them from an .osm file).
+
+The merged database takes the layout and the tag blobs of the first source (see
+create_db.LAYOUTS and create_db.BLOB_COLUMNS; a directory is in the rowid layout and has tag
+blobs if it has a tag_blobs.csv). The tags column of the other sources is copied too; when a
+source has none, the tag blobs of its elements are rebuilt from the merged tag tables.
+"""
+import argparse
+import csv
+import heapq
+import itertools
+import os
+import sqlite3
+import time
+from operator import itemgetter
+
+import clean_data
+import create_db
+from compressed_csv import csv_exists, open_csv
+
+BATCH_SIZE = 10000
+
+# Element table -> its child tables and the order of the rows of each child
+ELEMENTS = [
+    ('nodes', [('nodes_tags', 'rowid'), ('raw_tags', 'rowid'), ('tiles', 'tile')]),
+    ('ways', [('ways_tags', 'rowid'), ('ways_nodes', 'position'), ('raw_tags', 'rowid'),
+              ('tiles', 'tile')]),
+    ('relations', [('relations_tags', 'rowid'), ('relations_members', 'position'),
+                   ('raw_tags', 'rowid')]),
+]
+# Child tables shared by every kind of element, whose column element tells which one
+SHARED_TABLES = ['raw_tags', 'tiles']
+INTEGER_FIELDS = ['id', 'node_id', 'position', 'member_id', 'tile', 'zoom']
+BLOB_TABLES = ['nodes', 'ways']  # tables with a tags column in a database with tag blobs
+
+
+def source_format(source):
+    """(layout, whether it has tag blobs) of a database or a directory of .csv files"""
+    if os.path.isdir(source):
+        return 'rowid', csv_exists(os.path.join(source, 'tag_blobs.csv'))
+    con = sqlite3.connect(source)
+    layout = 'rowid' if create_db.row_order(con, 'nodes_tags') == 'rowid' else 'clustered'
+    tag_blobs = create_db.has_tag_blobs(con)
+    con.close()
+    return layout, tag_blobs
+
+
+def columns(table, tag_blobs):
+    """Columns of table in the merged database"""
+    if tag_blobs and table in BLOB_TABLES:
+        return create_db.COLUMNS[table] + ['tags']
+    return create_db.COLUMNS[table]
+
+
+def db_rows(con, table, order, tag_blobs=False, element=None):
+    """Rows of table by id (only those of element for the SHARED_TABLES, none if the
+    database does not have the table). With tag_blobs the rows of nodes and ways end with
+    their tags (NULL if the database has none)."""
+    if con.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?;",
+                   (table,)).fetchone() is None:
+        return iter([])
+    selected = create_db.COLUMNS[table]
+    if tag_blobs and table in BLOB_TABLES:
+        selected = selected + ['tags' if create_db.has_tag_blobs(con) else 'NULL']
+    where, params = ('WHERE element = ?', (element,)) if table in SHARED_TABLES else ('', ())
+    return con.execute('SELECT {0} FROM {1} {2} ORDER BY id, {3};'.format(
+        ', '.join(selected), table, where, order), params)
+
+
+def csv_blobs(source, element):
+    """(id, tags) of the elements of a kind in the tag_blobs.csv of the directory source"""
+    path = os.path.join(source, 'tag_blobs.csv')
+    if not csv_exists(path):
+        return
+    with open_csv(path) as fin:
+        for i in csv.DictReader(fin):
+            if i['element'] == element:
+                yield int(i['id']), i['tags'].decode('utf-8')
+
+
+def with_blobs(rows, blobs):
+    """Appends to every row the tags of the same id in blobs (both sorted by id), or None"""
+    pending = next(blobs, None)
+    for row in rows:
+        while pending is not None and pending[0] < row[0]:
+            pending = next(blobs, None)
+        if pending is not None and pending[0] == row[0]:
+            yield row + (pending[1],)
+        else:
+            yield row + (None,)
+
+
+def csv_rows(path, table, element=None):
+    """Yields the rows of a .csv file as tuples in create_db.COLUMNS order (none if the file
+    does not exist, like the relations of .csv files written before they were kept), only
+    those of element for the SHARED_TABLES"""
+    columns = create_db.COLUMNS[table]
+    position = columns.index('id')
+    if not csv_exists(path):
+        return
+    with open_csv(path) as fin:
+        last_id = None
+        for i in csv.DictReader(fin):
+            if table in SHARED_TABLES and i['element'] != element:
+                continue
+            row = tuple(int(v) if c in INTEGER_FIELDS else v
+                        for c, v in zip(columns, create_db.csv_row(table, i)))
+            if last_id is not None and row[position] < last_id:
+                raise ValueError('{0} is not sorted by id (id {1} after {2})'.format(
+                    path, row[position], last_id))
+            last_id = row[position]
+            yield row
+
+
+def group_by_id(rows, table):
+    key = itemgetter(create_db.COLUMNS[table].index('id'))
+    for element_id, group in itertools.groupby(rows, key=key):
+        yield element_id, list(group)
+
+
+def elements(source, index, table, children, tag_blobs=False):
+    """Yields (id, -version, source index, row, child rows) for every element of a source,
+    in id order. Child rows without an element in the same source are dropped. With
+    tag_blobs the rows of nodes and ways end with their tags."""
+    if os.path.isdir(source):
+        rows = csv_rows(os.path.join(source, table + '.csv'), table)
+        if tag_blobs and table in BLOB_TABLES:
+            rows = with_blobs(rows, csv_blobs(source, table[:-1]))
+        child_groups = [group_by_id(csv_rows(os.path.join(source, child + '.csv'), child,
+                                             table[:-1]), child)
+                        for child, order in children]
+    else:
+        con = sqlite3.connect(source)
+        rows = db_rows(con, table, 'rowid', tag_blobs)
+        child_groups = [group_by_id(db_rows(con, child, create_db.row_order(con, child)
+                                            if order == 'rowid' else order,
+                                            element=table[:-1]), child)
+                        for child, order in children]
+
+    version = create_db.COLUMNS[table].index('version')
+    pending = [next(g, None) for g in child_groups]
+    for row in rows:
+        element_id = row[0]
+        child_rows = []
+        for k, groups in enumerate(child_groups):
+            while pending[k] is not None and pending[k][0] < element_id:
+                pending[k] = next(groups, None)
+            if pending[k] is not None and pending[k][0] == element_id:
+                child_rows.append(pending[k][1])
+                pending[k] = next(groups, None)
+            else:
+                child_rows.append([])
+        yield element_id, -int(row[version]), index, row, child_rows
+
+
+def unique(rows):
+    """Drops repeated rows keeping the order of the first occurrences"""
+    seen = set()
+    out = []
+    for row in rows:
+        if row not in seen:
+            seen.add(row)
+            out.append(row)
+    return out
+
+
+def insert_sql(table, tag_blobs=False):
+    names = columns(table, tag_blobs)
+    return 'INSERT INTO {0} ({1}) VALUES ({2});'.format(table, ', '.join(names),
+                                                         ','.join('?' * len(names)))
+
+
+def merge_table(sources, con, table, children, stats, tag_blobs=False):
+    """Merges an element table and its children from every source into con"""
+    streams = [elements(source, i, table, children, tag_blobs)
+               for i, source in enumerate(sources)]
+    tables = [table] + [child for child, order in children]
+    buffers = dict((t, []) for t in tables)
+
+    def flush():
+        for t in tables:
+            if buffers[t]:
+                con.executemany(insert_sql(t, tag_blobs), buffers[t])
+                stats[t]['written'] += len(buffers[t])
+                buffers[t] = []
+
+    # Every tuple starts with (id, -version, source index), so the first element of each
+    # id group is the one with the highest version (the first source wins a tie).
+    for element_id, group in itertools.groupby(heapq.merge(*streams), key=itemgetter(0)):
+        _, _, _, row, child_rows = next(group)
+        stats[table]['read'] += 1
+        buffers[table].append(row)
+        for (child, order), rows in zip(children, child_rows):
+            rows_out = unique(rows)
+            stats[child]['read'] += len(rows)
+            stats[child]['duplicates'] += len(rows) - len(rows_out)
+            buffers[child].extend(rows_out)
+        # Older or repeated copies of the element from the other sources
+        for _, _, _, _, dropped_rows in group:
+            stats[table]['read'] += 1
+            stats[table]['duplicates'] += 1
+            for (child, order), rows in zip(children, dropped_rows):
+                stats[child]['read'] += len(rows)
+                stats[child]['duplicates'] += len(rows)
+        if len(buffers[table]) >= BATCH_SIZE:
+            flush()
+    flush()
+
+
+def rebuild_tag_blobs(con):
+    """Fills the tags column of the nodes and ways that have none from their tag tables.
+    Returns the number of elements updated."""
+    updated = 0
+    for table in BLOB_TABLES:
+        tags_table = table + '_tags'
+        rows = con.execute("""SELECT id, key, value, type FROM {0}
+                           WHERE id IN (SELECT id FROM {1} WHERE tags IS NULL)
+                           ORDER BY id, {2};""".format(tags_table, table,
+                                                       create_db.row_order(con, tags_table)))
+        batch = []
+        for element_id, group in itertools.groupby(rows, key=itemgetter(0)):
+            batch.append((clean_data.tag_blob([{'key': key, 'value': value, 'type': tag_type}
+                                               for _, key, value, tag_type in group]),
+                          element_id))
+            if len(batch) >= BATCH_SIZE:
+                con.executemany('UPDATE {0} SET tags = ? WHERE id = ?;'.format(table), batch)
+                updated += len(batch)
+                batch = []
+        con.executemany('UPDATE {0} SET tags = ? WHERE id = ?;'.format(table), batch)
+        updated += len(batch)
+    return updated
+
+
+def merge(sources, out_file, index=False):
+    """Merges sources (database files or .csv directories) into out_file, in the layout and
+    with the tag blobs of the first one. Returns a dict with the number of rows read,
+    written and dropped as duplicates per table."""
+    formats = [source_format(source) for source in sources]
+    layout, tag_blobs = formats[0]
+    if os.path.exists(out_file):
+        os.remove(out_file)
+    con = sqlite3.connect(out_file)
+    con.execute('PRAGMA synchronous = OFF;')
+    con.execute('PRAGMA journal_mode = OFF;')
+    for table in create_db.COLUMNS:
+        con.execute(create_db.table_schema(table, layout, tag_blobs))
+
+    stats = dict((t, {'read': 0, 'written': 0, 'duplicates': 0}) for t in create_db.COLUMNS)
+    stats['layout'], stats['tag_blobs'] = layout, tag_blobs
+    start = time.time()
+    for table, children in ELEMENTS:
+        merge_table(sources, con, table, children, stats, tag_blobs)
+        con.commit()
+    stats['rebuilt'] = 0
+    if tag_blobs and not all(blobs for _, blobs in formats):
+        stats['rebuilt'] = rebuild_tag_blobs(con)
+        con.commit()
+    create_db.create_iso_views(con)
+    stats['seconds'] = time.time() - start
+    con.close()
+    if index:
+        create_db.create_indexes(out_file)
+    return stats
+
+
+def print_stats(stats):
+    seconds = stats['seconds']
+    total = 0
+    for table in ['nodes', 'nodes_tags', 'ways', 'ways_tags', 'ways_nodes', 'relations',
+                  'relations_tags', 'relations_members', 'raw_tags', 'tiles']:
+        s = stats[table]
+        total += s['read']
+        print '{0:.<20s}: {1:>10d} read {2:>10d} written {3:>8d} duplicates'.format(
+            table, s['read'], s['written'], s['duplicates'])
+    print 'Layout: {0}{1}'.format(stats['layout'],
+                                  ', with tag blobs' if stats['tag_blobs'] else '')
+    if stats['rebuilt']:
+        print 'Tag blobs rebuilt: {0}'.format(stats['rebuilt'])
+    print 'Merged {0} rows in {1:.1f}s ({2:.0f} rows/s)'.format(total, seconds,
+                                                                 total / max(seconds, 1e-9))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Merge overlapping regional databases')
+    parser.add_argument('out', help='database to create')
+    parser.add_argument('sources', nargs='+', help='.db files or directories of .csv files')
+    parser.add_argument('--index', action='store_true', help='create the indexes afterwards')
+    args = parser.parse_args()
+    print_stats(merge(args.sources, args.out, args.index))
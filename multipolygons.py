@@ -0,0 +1,247 @@
+"""
+Area geometries (parks, lakes, county boundaries...) of the multipolygon and boundary
+relations, assembled straight from the .osm file in three streaming passes:
+
+1. the relations: tags and member ways of the areas (nodes and ways are skipped, relations
+   come last in an .osm file),
+2. the ways: the node refs of the member ways only, packed in one int64 array,
+3. the nodes: the coordinates of the nodes of those ways only.
+
+Nothing else of the file is kept in memory. The member ways are then joined end to end into
+closed rings, every inner ring is assigned to the smallest outer ring that contains it and
+each area is written as a GeoJSON MultiPolygon to the table multipolygons (and optionally to
+a .geojson file). Relations with members missing from the extract are counted as incomplete.
+
+Usage:
+    python multipolygons.py tampa_florida.osm [--db TampaFlorida.db] [--geojson areas.geojson]
+"""
+import argparse
+import json
+import math
+import sqlite3
+import time
+import xml.etree.cElementTree as ET
+from array import array
+
+import numpy as np
+
+OSM_PATH = "tampa_florida.osm"
+database = "TampaFlorida.db"
+
+AREA_TYPES = ('multipolygon', 'boundary')
+EARTH_RADIUS = 6371000.0
+BATCH_SIZE = 100000
+
+MULTIPOLYGONS_SCHEMA = """CREATE TABLE multipolygons (id INTEGER PRIMARY KEY NOT NULL,
+                       type TEXT, name TEXT, area REAL, geojson TEXT NOT NULL);"""
+
+
+def iter_elements(osm_file, tag, stop=None):
+    """Yields the top level elements of type tag, clearing every element once parsed.
+    Stops at the first element of type stop (nodes come before ways and ways before
+    relations in an .osm file)."""
+    context = ET.iterparse(osm_file, events=('start', 'end'))
+    _, root = next(context)
+    for event, elem in context:
+        if event == 'end' and elem.tag in ('node', 'way', 'relation'):
+            if elem.tag == stop:
+                break
+            if elem.tag == tag:
+                yield elem
+            root.clear()
+
+
+def read_relations(osm_file):
+    """Pass 1: {relation id: {'tags': {...}, 'members': [(way id, role)]}} of the areas"""
+    relations = {}
+    for elem in iter_elements(osm_file, 'relation'):
+        tags = dict((t.attrib['k'], t.attrib['v']) for t in elem.iter('tag'))
+        if tags.get('type') not in AREA_TYPES:
+            continue
+        members = [(int(m.attrib['ref']), m.attrib.get('role') or 'outer')
+                   for m in elem.iter('member') if m.attrib['type'] == 'way']
+        relations[int(elem.attrib['id'])] = {'tags': tags, 'members': members}
+    return relations
+
+
+def read_ways(osm_file, way_ids):
+    """Pass 2: node refs of the ways in way_ids, as one packed array and the (start, end) of
+    every way in it"""
+    refs = array('l') if array('l').itemsize == 8 else array('q')
+    spans = {}
+    for elem in iter_elements(osm_file, 'way', stop='relation'):
+        way_id = int(elem.attrib['id'])
+        if way_id in way_ids:
+            start = len(refs)
+            refs.extend(int(nd.attrib['ref']) for nd in elem.iter('nd'))
+            spans[way_id] = (start, len(refs))
+    return np.frombuffer(refs, dtype=np.int64) if refs else np.zeros(0, np.int64), spans
+
+
+def read_nodes(osm_file, node_ids):
+    """Pass 3: (ids, lat, lon) of the nodes in the sorted array node_ids, sorted by id. The
+    nodes are filtered in batches with NumPy instead of one set lookup per node."""
+    kept_ids, kept_lat, kept_lon = [], [], []
+    batch_ids, batch_lat, batch_lon = [], [], []
+
+    def flush():
+        ids = np.array(batch_ids, dtype=np.int64)
+        keep = np.in1d(ids, node_ids, assume_unique=False)
+        kept_ids.append(ids[keep])
+        kept_lat.append(np.array(batch_lat)[keep])
+        kept_lon.append(np.array(batch_lon)[keep])
+        del batch_ids[:], batch_lat[:], batch_lon[:]
+
+    for elem in iter_elements(osm_file, 'node', stop='way'):
+        batch_ids.append(int(elem.attrib['id']))
+        batch_lat.append(float(elem.attrib['lat']))
+        batch_lon.append(float(elem.attrib['lon']))
+        if len(batch_ids) == BATCH_SIZE:
+            flush()
+    if batch_ids:
+        flush()
+    if not kept_ids:
+        return np.zeros(0, np.int64), np.zeros(0), np.zeros(0)
+    ids = np.concatenate(kept_ids)
+    order = np.argsort(ids)
+    return ids[order], np.concatenate(kept_lat)[order], np.concatenate(kept_lon)[order]
+
+
+def join_rings(ways):
+    """Joins lists of node refs end to end into closed rings. None if they do not close."""
+    rings = []
+    pending = []
+    for way in ways:
+        if len(way) < 2:
+            continue
+        (rings if way[0] == way[-1] else pending).append(list(way))
+    while pending:
+        ring = pending.pop()
+        while ring[0] != ring[-1]:
+            for i, way in enumerate(pending):
+                if way[0] == ring[-1]:
+                    ring.extend(way[1:])
+                    break
+                if way[-1] == ring[-1]:
+                    ring.extend(way[-2::-1])
+                    break
+            else:
+                return None
+            del pending[i]
+        rings.append(ring)
+    return [r for r in rings if len(r) >= 4]
+
+
+def signed_area(lat, lon):
+    """Area in square metres of a closed ring (equirectangular projection around its mean
+    latitude), positive if counterclockwise"""
+    k = math.cos(math.radians(lat.mean()))
+    x = np.radians(lon) * EARTH_RADIUS * k
+    y = np.radians(lat) * EARTH_RADIUS
+    return 0.5 * float(np.sum(x[:-1] * y[1:] - x[1:] * y[:-1]))
+
+
+def contains(lat, lon, point_lat, point_lon):
+    """Whether a closed ring contains a point (ray casting)"""
+    y1, y2 = lat[:-1], lat[1:]
+    x1, x2 = lon[:-1], lon[1:]
+    crosses = (y1 > point_lat) != (y2 > point_lat)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = x1 + (point_lat - y1) * (x2 - x1) / (y2 - y1)
+    return int(np.sum(crosses & (point_lon < x))) % 2 == 1
+
+
+def assemble(relation, refs, spans, node_ids, lat, lon):
+    """GeoJSON MultiPolygon and area of a relation, None if some member or node is missing
+    or its rings do not close"""
+    rings = {'outer': [], 'inner': []}
+    for way_id, role in relation['members']:
+        if way_id not in spans:
+            return None
+        start, end = spans[way_id]
+        rings['inner' if role == 'inner' else 'outer'].append(refs[start:end].tolist())
+    polygons = []
+    inners = []
+    for role in ('outer', 'inner'):
+        joined = join_rings(rings[role])
+        if joined is None:
+            return None
+        for ring in joined:
+            pos = np.searchsorted(node_ids, ring)
+            pos = np.minimum(pos, len(node_ids) - 1)
+            if not len(node_ids) or (node_ids[pos] != ring).any():
+                return None
+            r_lat, r_lon = lat[pos], lon[pos]
+            area = signed_area(r_lat, r_lon)
+            # GeoJSON: outer rings counterclockwise, holes clockwise
+            if (area < 0) == (role == 'outer'):
+                r_lat, r_lon = r_lat[::-1], r_lon[::-1]
+            if role == 'outer':
+                polygons.append({'lat': r_lat, 'lon': r_lon, 'area': abs(area), 'holes': []})
+            else:
+                inners.append({'lat': r_lat, 'lon': r_lon, 'area': abs(area)})
+    if not polygons:
+        return None
+    for inner in inners:
+        outside = [p for p in polygons if contains(p['lat'], p['lon'], inner['lat'][0],
+                                                   inner['lon'][0])]
+        if outside:
+            min(outside, key=lambda p: p['area'])['holes'].append(inner)
+    coordinates = [[[[x, y] for x, y in zip(ring['lon'].tolist(), ring['lat'].tolist())]
+                    for ring in [p] + p['holes']] for p in polygons]
+    area = sum(p['area'] - sum(h['area'] for h in p['holes']) for p in polygons)
+    return {'type': 'MultiPolygon', 'coordinates': coordinates}, area
+
+
+def build(osm_file=OSM_PATH):
+    """Assembles every area relation of osm_file. Returns ({relation id: (tags, geometry,
+    area)}, statistics)"""
+    stats = {}
+    start = time.time()
+    relations = read_relations(osm_file)
+    way_ids = set(w for r in relations.values() for w, role in r['members'])
+    refs, spans = read_ways(osm_file, way_ids)
+    node_ids, lat, lon = read_nodes(osm_file, np.unique(refs))
+    stats['memory'] = refs.nbytes + node_ids.nbytes + lat.nbytes + lon.nbytes
+
+    areas = {}
+    for relation_id, relation in relations.items():
+        result = assemble(relation, refs, spans, node_ids, lat, lon)
+        if result is not None:
+            areas[relation_id] = (relation['tags'], result[0], result[1])
+    stats.update({'relations': len(relations), 'assembled': len(areas),
+                  'incomplete': len(relations) - len(areas), 'ways': len(spans),
+                  'nodes': len(node_ids), 'seconds': time.time() - start})
+    return areas, stats
+
+
+def save(areas, database=database, geojson=None):
+    con = sqlite3.connect(database)
+    con.execute('DROP TABLE IF EXISTS multipolygons;')
+    con.execute(MULTIPOLYGONS_SCHEMA)
+    con.executemany('INSERT INTO multipolygons (id, type, name, area, geojson) '
+                    'VALUES (?,?,?,?,?);',
+                    ((i, tags.get('boundary') or tags.get('leisure') or tags.get('landuse') or
+                      tags.get('natural') or tags.get('type'), tags.get('name'), area,
+                      json.dumps(geometry)) for i, (tags, geometry, area) in areas.items()))
+    con.commit()
+    con.close()
+    if geojson:
+        features = [{'type': 'Feature', 'id': i, 'properties': tags, 'geometry': geometry}
+                    for i, (tags, geometry, area) in sorted(areas.items())]
+        with open(geojson, 'w') as f:
+            json.dump({'type': 'FeatureCollection', 'features': features}, f)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Assemble the areas of multipolygons')
+    parser.add_argument('osm', nargs='?', default=OSM_PATH)
+    parser.add_argument('--db', default=database)
+    parser.add_argument('--geojson', help='also write the areas to this .geojson file')
+    args = parser.parse_args()
+    areas, stats = build(args.osm)
+    save(areas, args.db, args.geojson)
+    print '{0} area relations: {1} assembled, {2} incomplete in {3:.2f}s'.format(
+        stats['relations'], stats['assembled'], stats['incomplete'], stats['seconds'])
+    print 'Kept {0} way(s) and {1} node(s) in memory ({2:.1f} kB)'.format(
+        stats['ways'], stats['nodes'], stats['memory'] / 1024.0)
@@ -0,0 +1,244 @@
+"""
+Quadtiles: the Web Mercator tiles (the x/y/zoom of slippy maps) numbered with a single key
+that interleaves the bits of x and y. The keys of all the tiles inside a tile of a lower zoom
+form one contiguous range, so an area of any size is a range of keys.
+
+clean_data.process_map(..., tile_zoom=14) writes the tile of every node (and of every way, by
+its first node) to tiles.csv; create_db.py loads it into the table tiles, clustered by tile
+(create_db.create_tile_table does the same for a database that is already built). aggregate
+then runs a job per tile (or per tile of a lower zoom) in a process pool and merges the
+results:
+
+    >>> from quadtiles import aggregate, tag_counts
+    >>> aggregate('TampaFlorida.db', tag_counts, level=10).most_common(3)
+    [(u'highway', 4120), (u'name', 3305), (u'street', 2210)]
+
+A job is a function job(con, lo, hi) of a connection and the range of tile keys [lo, hi) that
+returns something that merge (by default +) can combine. TILE_NODES and TILE_WAYS select the
+ids of the nodes and ways of the range.
+"""
+import math
+import multiprocessing
+import sqlite3
+import sys
+import time
+from collections import Counter
+
+import numpy as np
+
+database = "TampaFlorida.db"
+TILE_ZOOM = 14
+MAX_LAT = 85.0511287798
+
+TILE_NODES = "SELECT id FROM tiles WHERE element = 'node' AND tile >= ? AND tile < ?"
+TILE_WAYS = "SELECT id FROM tiles WHERE element = 'way' AND tile >= ? AND tile < ?"
+
+
+def tile_xy(lat, lon, zoom):
+    """Web Mercator tile (x, y) of points in degrees (NumPy arrays or numbers)"""
+    lat = np.clip(np.asarray(lat, dtype=np.float64), -MAX_LAT, MAX_LAT)
+    lon = np.asarray(lon, dtype=np.float64)
+    n = 2 ** zoom
+    x = np.floor((lon + 180.0) / 360.0 * n).astype(np.int64)
+    lat = np.radians(lat)
+    y = np.floor((1.0 - np.log(np.tan(lat) + 1.0 / np.cos(lat)) / math.pi) / 2.0 * n)
+    return np.clip(x, 0, n - 1), np.clip(y.astype(np.int64), 0, n - 1)
+
+
+def tile_key(lat, lon, zoom=TILE_ZOOM):
+    """Quadtile key of points in degrees: the bits of x and y interleaved"""
+    x, y = tile_xy(lat, lon, zoom)
+    return xy_key(x, y, zoom)
+
+
+def point_key(lat, lon, zoom=TILE_ZOOM):
+    """tile_key of a single point, in plain Python (faster than NumPy for one point)"""
+    n = 2 ** zoom
+    lat = math.radians(max(-MAX_LAT, min(MAX_LAT, lat)))
+    x = min(n - 1, max(0, int(math.floor((lon + 180.0) / 360.0 * n))))
+    y = (1.0 - math.log(math.tan(lat) + 1.0 / math.cos(lat)) / math.pi) / 2.0 * n
+    y = min(n - 1, max(0, int(math.floor(y))))
+    key = 0
+    for bit in range(zoom):
+        key |= ((x >> bit) & 1) << (2 * bit) | ((y >> bit) & 1) << (2 * bit + 1)
+    return key
+
+
+def xy_key(x, y, zoom):
+    x = np.asarray(x, dtype=np.int64)
+    y = np.asarray(y, dtype=np.int64)
+    key = np.zeros(x.shape, dtype=np.int64)
+    for bit in range(zoom):
+        key |= ((x >> bit) & 1) << (2 * bit)
+        key |= ((y >> bit) & 1) << (2 * bit + 1)
+    return key
+
+
+class NodeTiles(object):
+    """The tile key of every node id, in two int64 arrays sorted by id (a dict of them takes
+    about ten times the memory). Nodes are added in chunks and sorted when a tile is looked
+    up; the last tile added for an id wins."""
+
+    CHUNK_SIZE = 100000
+
+    def __init__(self):
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.tiles = np.zeros(0, dtype=np.int64)
+        self.chunks = []
+        self.pending_ids = []
+        self.pending_tiles = []
+
+    def add(self, node_id, tile):
+        self.pending_ids.append(node_id)
+        self.pending_tiles.append(tile)
+        if len(self.pending_ids) >= self.CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.pending_ids:
+            self.chunks.append((np.array(self.pending_ids, dtype=np.int64),
+                                np.array(self.pending_tiles, dtype=np.int64)))
+            self.pending_ids = []
+            self.pending_tiles = []
+
+    def merge(self):
+        self.flush()
+        ids = np.concatenate([self.ids] + [i for i, t in self.chunks])
+        tiles = np.concatenate([self.tiles] + [t for i, t in self.chunks])
+        self.chunks = []
+        if len(ids) > 1 and (ids[1:] < ids[:-1]).any():
+            # Stable, so the duplicates of an id stay in the order they were added
+            order = np.argsort(ids, kind='mergesort')
+            ids, tiles = ids[order], tiles[order]
+        self.ids, self.tiles = ids, tiles
+
+    def first(self, node_ids):
+        """Tile of the first of node_ids that has one, or None"""
+        if self.pending_ids or self.chunks:
+            self.merge()
+        if not len(node_ids) or not len(self.ids):
+            return None
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        positions = np.searchsorted(self.ids, node_ids, side='right') - 1
+        found = (positions >= 0) & (self.ids[np.maximum(positions, 0)] == node_ids)
+        if not found.any():
+            return None
+        return int(self.tiles[positions[found.argmax()]])
+
+
+def key_xy(key, zoom):
+    """(x, y) of the tile with a quadtile key"""
+    x = y = 0
+    for bit in range(zoom):
+        x |= ((key >> (2 * bit)) & 1) << bit
+        y |= ((key >> (2 * bit + 1)) & 1) << bit
+    return x, y
+
+
+def tile_bounds(key, zoom):
+    """(south, west, north, east) of a tile in degrees"""
+    x, y = key_xy(key, zoom)
+    n = 2.0 ** zoom
+
+    def lat(y):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+    return lat(y + 1), x / n * 360.0 - 180.0, lat(y), (x + 1) / n * 360.0 - 180.0
+
+
+def key_range(key, zoom, to_zoom):
+    """Range [lo, hi) of the keys at to_zoom of the tiles inside tile key of zoom"""
+    shift = 2 * (to_zoom - zoom)
+    return key << shift, (key + 1) << shift
+
+
+def table_zoom(con):
+    row = con.execute('SELECT zoom FROM tiles LIMIT 1;').fetchone()
+    if row is None:
+        raise ValueError('The table tiles is empty (see create_db.create_tile_table)')
+    return row[0]
+
+
+def tile_ranges(database=database, level=None, element=None):
+    """Ranges [lo, hi) of tile keys with at least one element, one per tile of zoom level
+    (the zoom of the table tiles if level is None)"""
+    con = sqlite3.connect(database)
+    zoom = table_zoom(con)
+    level = zoom if level is None else min(level, zoom)
+    shift = 2 * (zoom - level)
+    sql = 'SELECT DISTINCT tile >> {0} FROM tiles'.format(shift)
+    if element is not None:
+        sql += " WHERE element = '{0}'".format(element)
+    parents = [t for t, in con.execute(sql + ' ORDER BY 1;')]
+    con.close()
+    return [key_range(t, level, zoom) for t in parents]
+
+
+def run_job(args):
+    database, job, lo, hi = args
+    con = sqlite3.connect(database)
+    try:
+        return job(con, lo, hi)
+    finally:
+        con.close()
+
+
+def aggregate(database, job, merge=None, level=None, element=None, workers=None):
+    """Runs job over every tile of zoom level in a process pool and merges the results.
+    job has to be a module level function (or a functools.partial of one) so the workers
+    can import it."""
+    ranges = tile_ranges(database, level, element)
+    jobs = [(database, job, lo, hi) for lo, hi in ranges]
+    merge = merge or (lambda a, b: a + b)
+    workers = workers or multiprocessing.cpu_count()
+    if workers == 1 or len(jobs) < 2:
+        results = (run_job(j) for j in jobs)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(min(workers, len(jobs)))
+        results = pool.imap_unordered(run_job, jobs)
+    merged = None
+    try:
+        for result in results:
+            merged = result if merged is None else merge(merged, result)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return merged
+
+
+################################### Jobs #####################################################
+
+def tag_counts(con, lo, hi):
+    """Number of tags of the nodes and ways of the tiles, by key"""
+    counts = Counter()
+    for table, ids in [('nodes_tags', TILE_NODES), ('ways_tags', TILE_WAYS)]:
+        counts.update(dict(con.execute(
+            'SELECT key, COUNT(*) FROM {0} WHERE id IN ({1}) GROUP BY key;'.format(table, ids),
+            (lo, hi)).fetchall()))
+    return counts
+
+
+def user_counts(con, lo, hi):
+    """Number of nodes last edited by every user in the tiles"""
+    return Counter(dict(con.execute(
+        'SELECT user, COUNT(*) FROM nodes WHERE id IN ({0}) GROUP BY user;'.format(TILE_NODES),
+        (lo, hi)).fetchall()))
+
+
+def benchmark(database=database, level=None, workers=None):
+    con = sqlite3.connect(database)
+    start = time.time()
+    full = Counter(dict(con.execute('SELECT key, COUNT(*) FROM (SELECT key FROM nodes_tags '
+                                    'UNION ALL SELECT key FROM ways_tags) GROUP BY key;')))
+    scan = time.time() - start
+    con.close()
+    start = time.time()
+    tiled = aggregate(database, tag_counts, level=level, workers=workers)
+    print 'Tag counts: full scan {0:.3f}s, {1} tile jobs {2:.3f}s, same result: {3}'.format(
+        scan, len(tile_ranges(database, level)), time.time() - start, tiled == full)
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    benchmark(args[0] if args else database, int(args[1]) if len(args) > 1 else None)
@@ -54,8 +54,9 @@ ON nodes_tags.id = i.id WHERE nodes_tags.key = 'name'ORDER BY i.value *1
 DESC LIMIT 10"""
 
 # Changes performed on the map of the area, per year
-query11 = """SELECT strftime('%Y', t.timestamp) as Year, COUNT(*) as changes
-FROM (SELECT nodes.timestamp FROM nodes UNION ALL SELECT ways.timestamp FROM ways) t
+# (year is derived from the timestamp at load time, see create_db.py)
+query11 = """SELECT t.year as Year, COUNT(*) as changes
+FROM (SELECT nodes.year FROM nodes UNION ALL SELECT ways.year FROM ways) t
 GROUP BY Year ORDER BY Year DESC;"""
 
 # IMPORTANT NOTICE: The following query requires a VIEW (myview) to be created.
@@ -67,11 +68,90 @@ INNER JOIN (SELECT Year, MAX(num) AS maxnum FROM myview GROUP BY Year) q
 ON myview.Year = q.Year AND myview.num = q.maxnum ORDER BY myview.Year DESC;"""
 
 
- ############## Change query at will ####################
-db = sqlite3.connect(database)
-df = pd.read_sql_query(query01, db)
-db.close()
-print df
+QUERIES = {'query01': query01, 'query02': query02, 'query03': query03, 'query04': query04,
+           'query05': query05, 'query06': query06, 'query07': query07, 'query08': query08,
+           'query09': query09, 'query10': query10, 'query11': query11, 'query12': query12}
+
+# The queries on tags rewritten for a database with tag blobs (create_db(..., tag_blobs=True)):
+# every tag is read from the row of its element instead of a self-join of the tag table.
+# Every rewrite reads the elements whose keys are not repeated from the generated columns
+# and the few others (repeated >= '') from the tag tables, as the original query does. Each
+# part is grouped (or cut to its top ten) on its own, in the order of its index, before
+# the two are added up. (The restaurants of query07 and query08 are found with EXISTS: the
+# join on SELECT DISTINCT(id), value gives one row per restaurant too, but it would be
+# built over every restaurant.)
+# (>= '' instead of IS NOT NULL, which the planner does not search the indexes for)
+blob_query01 = """SELECT zip_code, SUM(n) as occurrences FROM (
+SELECT postal_code as zip_code, COUNT(*) as n FROM ways
+WHERE postal_code >= '' AND repeated IS NULL GROUP BY postal_code
+UNION ALL SELECT value, COUNT(*) FROM ways_tags WHERE key = 'postal_code'
+AND id IN (SELECT id FROM ways WHERE repeated >= '') GROUP BY value)
+GROUP BY zip_code;"""
+
+blob_query06 = """SELECT value, SUM(n) as num FROM (
+SELECT amenity as value, COUNT(*) as n FROM nodes
+WHERE amenity >= '' AND repeated IS NULL GROUP BY amenity
+UNION ALL SELECT value, COUNT(*) FROM nodes_tags WHERE key = 'amenity'
+AND id IN (SELECT id FROM nodes WHERE repeated >= '') GROUP BY value)
+GROUP BY value ORDER BY num DESC LIMIT 10;"""
+
+blob_query07 = """SELECT street, SUM(n) as restaurants FROM (
+SELECT street, COUNT(*) as n FROM nodes
+WHERE amenity = 'restaurant' AND street >= '' AND repeated IS NULL GROUP BY street
+UNION ALL SELECT t.value, COUNT(*) FROM nodes CROSS JOIN nodes_tags t ON t.id = nodes.id
+WHERE nodes.repeated >= '' AND t.key = 'street' AND EXISTS (SELECT 1 FROM nodes_tags a
+WHERE a.id = nodes.id AND a.key = 'amenity' AND a.value = 'restaurant') GROUP BY t.value)
+GROUP BY street ORDER BY restaurants DESC LIMIT 10;"""
+
+blob_query08 = """SELECT street, SUM(n) as restaurants FROM (
+SELECT u_street as street, COUNT(*) as n FROM nodes
+WHERE amenity = 'restaurant' AND u_street >= '' AND repeated IS NULL GROUP BY u_street
+UNION ALL SELECT t.value, COUNT(*) FROM nodes CROSS JOIN nodes_tags t ON t.id = nodes.id
+WHERE nodes.repeated >= '' AND t.key = 'u_street' AND EXISTS (SELECT 1 FROM nodes_tags a
+WHERE a.id = nodes.id AND a.key = 'amenity' AND a.value = 'restaurant') GROUP BY t.value)
+GROUP BY street ORDER BY restaurants DESC LIMIT 10;"""
+
+blob_query09 = """SELECT county, SUM(n) as count FROM (
+SELECT county, COUNT(*) as n FROM nodes
+WHERE county >= '' AND repeated IS NULL GROUP BY county
+UNION ALL SELECT county1, COUNT(*) FROM nodes
+WHERE county1 >= '' AND repeated IS NULL GROUP BY county1
+UNION ALL SELECT county, COUNT(*) FROM ways
+WHERE county >= '' AND repeated IS NULL GROUP BY county
+UNION ALL SELECT county1, COUNT(*) FROM ways
+WHERE county1 >= '' AND repeated IS NULL GROUP BY county1
+UNION ALL SELECT value, COUNT(*) FROM nodes_tags WHERE key IN ('county', 'county1')
+AND id IN (SELECT id FROM nodes WHERE repeated >= '') GROUP BY value
+UNION ALL SELECT value, COUNT(*) FROM ways_tags WHERE key IN ('county', 'county1')
+AND id IN (SELECT id FROM ways WHERE repeated >= '') GROUP BY value)
+GROUP BY county ORDER BY count DESC;"""
+
+blob_query10 = """SELECT place, population FROM (
+SELECT * FROM (SELECT name as place, population FROM nodes
+WHERE population IS NOT NULL AND name IS NOT NULL AND repeated IS NULL
+ORDER BY population * 1 DESC LIMIT 10)
+UNION ALL SELECT * FROM (SELECT nodes_tags.value, i.value FROM nodes_tags JOIN
+(SELECT DISTINCT(id), value FROM nodes_tags WHERE key='population'
+AND id IN (SELECT id FROM nodes WHERE repeated >= '')) i
+ON nodes_tags.id = i.id WHERE nodes_tags.key = 'name' ORDER BY i.value * 1 DESC LIMIT 10))
+ORDER BY population * 1 DESC LIMIT 10"""
+
+BLOB_QUERIES = {'query01': blob_query01, 'query06': blob_query06, 'query07': blob_query07,
+                'query08': blob_query08, 'query09': blob_query09, 'query10': blob_query10}
+
+
+def run_query(query, database=database):
+    """Returns the result of query over database as a pandas DataFrame"""
+    db = sqlite3.connect(database)
+    df = pd.read_sql_query(query, db)
+    db.close()
+    return df
+
+
+if __name__ == '__main__':
+    ############## Change query at will ####################
+    df = run_query(query01)
+    print df
 
 
 
@@ -0,0 +1,200 @@
+"""
+Runs any subset of the queries of query_db.py (or ad-hoc SQL) at the same time and streams
+their results to .csv or .parquet files, so that refreshing every report takes about as long
+as the slowest query instead of the sum of all of them.
+
+The queries share a pool of read-only connections (PRAGMA query_only) to a database in WAL
+mode, so readers never block each other. Results are fetched and written CHUNK_SIZE rows at a
+time and never built in memory as a whole.
+
+Usage:
+    python query_runner.py                         # every query of query_db.py
+    python query_runner.py query05 query11 --format parquet --out reports
+    python query_runner.py --sql "SELECT COUNT(*) FROM nodes_tags" --workers 2
+    python query_runner.py --duckdb TampaFlorida.duckdb    # see duckdb_backend.py
+"""
+import argparse
+import csv
+import os
+import Queue
+import sqlite3
+import time
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+
+import make_a_view
+from query_db import QUERIES
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+database = "TampaFlorida.db"
+OUT_DIR = 'reports'
+CHUNK_SIZE = 10000
+WORKERS = 4
+
+
+class SQLitePool(object):
+    """A fixed number of read-only connections shared by the worker threads"""
+
+    def __init__(self, database=database, size=WORKERS, wal=True):
+        # WAL is stored in the database file, so it only has to be switched on once (wal=False
+        # leaves the file as it is, for a reader that must not write to it).
+        if wal:
+            con = sqlite3.connect(database)
+            if con.execute('PRAGMA journal_mode;').fetchone()[0] != 'wal':
+                con.execute('PRAGMA journal_mode = WAL;')
+            con.close()
+        self.connections = Queue.Queue()
+        for _ in range(size):
+            con = sqlite3.connect(database, check_same_thread=False)
+            con.execute('PRAGMA query_only = ON;')
+            self.connections.put(con)
+        self.size = size
+
+    @contextmanager
+    def connection(self):
+        con = self.connections.get()
+        try:
+            yield con
+        finally:
+            self.connections.put(con)
+
+    def execute(self, con, sql):
+        """Cursor over the result of sql and the names of its columns"""
+        cur = con.execute(sql)
+        return cur, [d[0] for d in cur.description or []]
+
+    def close(self):
+        for _ in range(self.size):
+            self.connections.get().close()
+
+
+class CsvChunkWriter(object):
+    extension = '.csv'
+
+    def __init__(self, path, columns):
+        self.f = open(path, 'wb')
+        self.writer = csv.writer(self.f)
+        self.writer.writerow(columns)
+
+    def write(self, rows):
+        self.writer.writerows([[v.encode('utf-8') if isinstance(v, unicode) else v
+                                for v in row] for row in rows])
+
+    def close(self):
+        self.f.close()
+
+
+class ParquetChunkWriter(object):
+    extension = '.parquet'
+
+    def __init__(self, path, columns):
+        if pa is None:
+            raise ImportError('pyarrow is needed to write .parquet files')
+        self.path = path
+        self.columns = columns
+        self.writer = None
+
+    def write(self, rows):
+        values = zip(*rows) if rows else [[] for _ in self.columns]
+        if self.writer is None:
+            # Columns that are empty in the first chunk are written as strings.
+            arrays = [pa.array(list(v)) for v in values]
+            arrays = [a.cast(pa.string()) if a.type == pa.null() else a for a in arrays]
+            table = pa.Table.from_arrays(arrays, self.columns)
+            self.schema = table.schema
+            self.writer = pq.ParquetWriter(self.path, self.schema)
+        else:
+            table = pa.Table.from_arrays([pa.array(list(v), type=field.type)
+                                          for v, field in zip(values, self.schema)],
+                                         self.columns)
+        self.writer.write_table(table)
+
+    def close(self):
+        if self.writer is None:
+            self.write([])
+        self.writer.close()
+
+
+WRITERS = {'csv': CsvChunkWriter, 'parquet': ParquetChunkWriter}
+
+
+def run_one(pool, name, sql, out_dir, fmt, chunk_size=CHUNK_SIZE):
+    """Runs sql and writes its result to out_dir/name. Returns the timings of the query"""
+    start = time.time()
+    rows = 0
+    first_row = None
+    with pool.connection() as con:
+        cur, columns = pool.execute(con, sql)
+        writer = WRITERS[fmt](os.path.join(out_dir, name + WRITERS[fmt].extension), columns)
+        try:
+            while True:
+                chunk = cur.fetchmany(chunk_size)
+                if first_row is None:
+                    first_row = time.time() - start
+                if not chunk:
+                    break
+                writer.write(chunk)
+                rows += len(chunk)
+        finally:
+            writer.close()
+    return {'name': name, 'rows': rows, 'first_row': first_row, 'seconds': time.time() - start}
+
+
+def run_queries(queries, pool, out_dir=OUT_DIR, fmt='csv', chunk_size=CHUNK_SIZE):
+    """Runs the (name, sql) pairs of queries concurrently, one per pool connection"""
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    workers = ThreadPool(pool.size)
+    try:
+        results = workers.map(lambda q: run_one(pool, q[0], q[1], out_dir, fmt, chunk_size),
+                              queries, chunksize=1)
+    finally:
+        workers.close()
+        workers.join()
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run queries of query_db.py concurrently')
+    parser.add_argument('names', nargs='*', help='queries to run (default: all of them)')
+    parser.add_argument('--sql', action='append', default=[], help='ad-hoc SQL to run')
+    parser.add_argument('--db', default=database)
+    parser.add_argument('--out', default=OUT_DIR)
+    parser.add_argument('--format', choices=sorted(WRITERS), default='csv')
+    parser.add_argument('--workers', type=int, default=WORKERS)
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--duckdb', help='run on this DuckDB file instead of the database '
+                                         '(see duckdb_backend.py)')
+    args = parser.parse_args()
+
+    names = args.names or ([] if args.sql else sorted(QUERIES))
+    unknown = [n for n in names if n not in QUERIES]
+    if unknown:
+        parser.error('unknown queries: ' + ', '.join(unknown))
+    if args.format == 'parquet' and pa is None:
+        parser.error('pyarrow is needed to write .parquet files')
+    queries = [(n, QUERIES[n]) for n in names]
+    queries += [('adhoc{0:02d}'.format(i + 1), sql) for i, sql in enumerate(args.sql)]
+    size = max(1, min(args.workers, len(queries)))
+    if args.duckdb:
+        from duckdb_backend import DuckDBPool
+        pool = DuckDBPool(args.duckdb, size)
+    else:
+        if 'query12' in names:
+            make_a_view.make_view(args.db)
+        pool = SQLitePool(args.db, size)
+    start = time.time()
+    results = run_queries(queries, pool, args.out, args.format, args.chunk_size)
+    wall = time.time() - start
+    pool.close()
+
+    for r in results:
+        print '{0:.<20s}: {1:>8d} rows {2:>8.3f}s (first row {3:.3f}s)'.format(
+            r['name'], r['rows'], r['seconds'], r['first_row'])
+    print 'Wall time {0:.3f}s, sum of the queries {1:.3f}s'.format(
+        wall, sum(r['seconds'] for r in results))
@@ -0,0 +1,134 @@
+"""
+Applies the current cleaning rules of clean_data.py to the raw tags kept in the database
+(table raw_tags), so a change to a rule (a new entry in the street mapping, a new city fix...)
+does not need the .osm file to be parsed and the database to be loaded again.
+
+Only the elements with one of the given keys are cleaned again. Every distinct raw (key,
+value) is cleaned once, whatever the number of elements that share it, and the tags of the
+affected elements are replaced in nodes_tags, ways_tags and relations_tags, and in the tag
+blobs of nodes and ways if the database has them (see create_db.BLOB_COLUMNS). The addresses
+and search tables are rebuilt afterwards if the database has them.
+
+Usage:
+    python reclean.py addr:city addr:street [--db TampaFlorida.db] [--rules clean_rules.json]
+    python reclean.py --all
+"""
+import argparse
+import sqlite3
+import time
+
+import clean_data
+import create_db
+
+database = "TampaFlorida.db"
+
+ELEMENTS = [('node', 'nodes_tags'), ('way', 'ways_tags'), ('relation', 'relations_tags')]
+
+
+def raw_keys(con, keys=None):
+    """The raw keys of the table raw_tags that clean_data.py cleans as one of keys (all of
+    them if keys is None)"""
+    found = [k for k, in con.execute('SELECT DISTINCT k FROM raw_tags;')]
+    if keys is None:
+        return found
+    keys = set(k.lower() for k in keys)
+    return [k for k in found if k.lower() in keys]
+
+
+def update_tag_blobs(con):
+    """Rebuilds the tag blobs of the nodes and ways in reclean_ids from their tag tables (the
+    generated columns follow)"""
+    for element, table in ELEMENTS[:2]:
+        blobs = {}
+        for element_id, key, value, tag_type in con.execute(
+                """SELECT id, key, value, type FROM {0}
+                WHERE id IN (SELECT id FROM reclean_ids WHERE element = ?)
+                ORDER BY {1};""".format(table, create_db.row_order(con, table)), (element,)):
+            blobs.setdefault(element_id, []).append({'key': key, 'value': value,
+                                                     'type': tag_type})
+        ids = [i for i, in con.execute('SELECT id FROM reclean_ids WHERE element = ?;',
+                                       (element,))]
+        con.executemany('UPDATE {0}s SET tags = ? WHERE id = ?;'.format(element),
+                        [(clean_data.tag_blob(blobs[i]) if i in blobs else None, i)
+                         for i in ids])
+
+
+def reclean(database=database, keys=None, rules=None):
+    """Cleans again the tags of the elements with any of keys (every element if keys is None)
+    and returns a dict with the number of elements, distinct values and rows involved"""
+    if rules is not None:
+        clean_data.load_rules(rules)
+    con = sqlite3.connect(database)
+    start = time.time()
+    stats = {'elements': 0, 'values': 0, 'cleaned': 0, 'deleted': 0, 'inserted': 0}
+    affected = raw_keys(con, keys)
+    if not affected:
+        con.close()
+        stats['seconds'] = time.time() - start
+        return stats
+
+    con.execute('DROP TABLE IF EXISTS temp.reclean_ids;')
+    con.execute('CREATE TEMP TABLE reclean_ids (element TEXT, id INTEGER, '
+                'PRIMARY KEY (element, id));')
+    con.execute('INSERT OR IGNORE INTO reclean_ids SELECT element, id FROM raw_tags '
+                'WHERE k IN ({0});'.format(','.join('?' * len(affected))), affected)
+    stats['elements'] = con.execute('SELECT COUNT(*) FROM reclean_ids;').fetchone()[0]
+
+    # (k, v) -> cleaned (key, value, type) rows. Elements with a patch of their own are
+    # cleaned one by one.
+    cleaned = {}
+    for element, table in ELEMENTS:
+        rows = []
+        for element_id, k, v in con.execute(
+                """SELECT r.id, r.k, r.v FROM raw_tags r
+                JOIN reclean_ids USING (element, id) WHERE r.element = ?
+                ORDER BY r.id, r.rowid;""", (element,)):
+            stats['cleaned'] += 1
+            if str(element_id) in clean_data.STREET_PATCHES:
+                tags = [(t['key'], t['value'], t['type'])
+                        for t in clean_data.shape_tag(k, v, str(element_id))]
+            else:
+                tags = cleaned.get((k, v))
+                if tags is None:
+                    tags = [(t['key'], t['value'], t['type'])
+                            for t in clean_data.shape_tag(k, v, None)]
+                    cleaned[(k, v)] = tags
+            rows.extend((element_id,) + t for t in tags)
+
+        cur = con.execute('DELETE FROM {0} WHERE id IN (SELECT id FROM reclean_ids '
+                          'WHERE element = ?);'.format(table), (element,))
+        stats['deleted'] += cur.rowcount
+        # OR IGNORE: the clustered layout keeps a single copy of a repeated tag
+        con.executemany('INSERT OR IGNORE INTO {0} (id, key, value, type) '
+                        'VALUES (?,?,?,?);'.format(table), rows)
+        stats['inserted'] += len(rows)
+    stats['values'] = len(cleaned)
+    if create_db.has_tag_blobs(con):
+        update_tag_blobs(con)
+    con.commit()
+
+    tables = [t for t, in con.execute("SELECT name FROM sqlite_master WHERE type = 'table' "
+                                      "AND name IN ('addresses', 'search');")]
+    con.close()
+    if 'addresses' in tables:
+        create_db.create_address_table(database)
+    if 'search' in tables:
+        create_db.create_search_index(database)
+    stats['seconds'] = time.time() - start
+    return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Clean the tags of a database again')
+    parser.add_argument('keys', nargs='*', help='raw keys to clean again, like addr:city')
+    parser.add_argument('--all', action='store_true', help='clean every tag again')
+    parser.add_argument('--db', default=database)
+    parser.add_argument('--rules', help='JSON file with cleaning rules (see clean_data.py)')
+    args = parser.parse_args()
+    if not args.keys and not args.all:
+        parser.error('give the keys to clean again or --all')
+
+    stats = reclean(args.db, None if args.all else args.keys, args.rules)
+    print '{0} elements, {1} raw tags ({2} distinct values) cleaned again in {3:.2f}s'.format(
+        stats['elements'], stats['cleaned'], stats['values'], stats['seconds'])
+    print '{0} tag rows replaced by {1}'.format(stats['deleted'], stats['inserted'])
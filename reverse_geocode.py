@@ -0,0 +1,232 @@
+"""
+Reverse geocoding: the nearest addressed nodes or amenities to a GPS fix.
+
+The nodes carrying 'addr' tags or an amenity are loaded once from the database into a
+uniform grid: coordinates are projected to metres (equirectangular around the mean latitude,
+accurate enough at metro scale), bucketed into square cells of CELL_SIZE metres and sorted by
+cell, so the points of a cell are a contiguous slice of the arrays. A k-nearest query visits
+the cells in rings around the fix until no unvisited cell can hold a closer point.
+
+The index is saved as a NumPy .npz file, so a service starts by loading the arrays instead
+of querying the database:
+
+    >>> geocoder = ReverseGeocoder.build('TampaFlorida.db')
+    >>> geocoder.save('reverse_geocode.npz')
+    >>> geocoder = ReverseGeocoder.load('reverse_geocode.npz')
+    >>> geocoder.nearest(27.9442, -82.4722, k=1)
+    [{'id': 1234, 'distance': 12.5, 'housenumber': u'1412', 'u_street': u'Kennedy Boulevard',
+      'postcode': u'33606', 'name': u'', 'amenity': u'cafe', 'lat': ..., 'lon': ...}]
+
+Running the script builds the index and benchmarks it against a full scan of the table.
+"""
+import math
+import sqlite3
+import time
+
+import numpy as np
+
+database = "TampaFlorida.db"
+INDEX_FILE = "reverse_geocode.npz"
+
+CELL_SIZE = 250.0  # metres
+EARTH_RADIUS = 6371000.0
+LABELS = ['housenumber', 'u_street', 'postcode', 'name', 'amenity']
+
+POINTS_QUERY = """SELECT nodes.id, nodes.lat, nodes.lon,
+MAX(CASE WHEN tags.key = 'housenumber' AND tags.type = 'addr' THEN tags.value END),
+MAX(CASE WHEN tags.key = 'u_street' AND tags.type = 'addr' THEN tags.value END),
+MAX(CASE WHEN tags.key = 'postcode' AND tags.type = 'addr' THEN tags.value END),
+MAX(CASE WHEN tags.key = 'name' AND tags.type = 'regular' THEN tags.value END),
+MAX(CASE WHEN tags.key = 'amenity' AND tags.type = 'regular' THEN tags.value END)
+FROM nodes JOIN nodes_tags tags ON tags.id = nodes.id
+GROUP BY nodes.id
+HAVING MAX(tags.type = 'addr') OR MAX(tags.key = 'amenity');"""
+
+
+class ReverseGeocoder(object):
+    """Grid index over the addressed nodes and amenities"""
+
+    def __init__(self, arrays):
+        for name, value in arrays.items():
+            setattr(self, name, value)
+        self.lat0 = float(self.meta[0])
+        self.cell_size = float(self.meta[1])
+        self.cos_lat0 = math.cos(math.radians(self.lat0))
+        if len(self.ids):
+            self.bounds = (int(self.cells_x.min()), int(self.cells_x.max()),
+                           int(self.cells_y.min()), int(self.cells_y.max()))
+
+    @classmethod
+    def build(cls, database=database, cell_size=CELL_SIZE):
+        con = sqlite3.connect(database)
+        rows = con.execute(POINTS_QUERY).fetchall()
+        con.close()
+        ids = np.array([r[0] for r in rows], dtype=np.int64)
+        lat = np.array([r[1] for r in rows], dtype=np.float64)
+        lon = np.array([r[2] for r in rows], dtype=np.float64)
+        lat0 = float(lat.mean()) if len(rows) else 0.0
+        x, y = project(lat, lon, lat0)
+        cells_x = np.floor(x / cell_size).astype(np.int64)
+        cells_y = np.floor(y / cell_size).astype(np.int64)
+        keys = cell_key(cells_x, cells_y)
+        order = np.argsort(keys, kind='mergesort')
+        keys = keys[order]
+        cell_keys, starts = np.unique(keys, return_index=True)
+        arrays = {
+            'ids': ids[order], 'lat': lat[order], 'lon': lon[order],
+            'x': x[order], 'y': y[order],
+            'cells_x': cells_x[order], 'cells_y': cells_y[order],
+            'cell_keys': cell_keys,
+            'cell_starts': np.append(starts, len(keys)).astype(np.int64),
+            'meta': np.array([lat0, cell_size]),
+        }
+        for i, label in enumerate(LABELS):
+            arrays[label] = np.array([rows[j][3 + i] or u'' for j in order], dtype=np.unicode_)
+        return cls(arrays)
+
+    def save(self, path=INDEX_FILE):
+        names = ['ids', 'lat', 'lon', 'x', 'y', 'cells_x', 'cells_y', 'cell_keys',
+                 'cell_starts', 'meta'] + LABELS
+        np.savez(path, **dict((name, getattr(self, name)) for name in names))
+
+    @classmethod
+    def load(cls, path=INDEX_FILE):
+        data = np.load(path)
+        return cls(dict((name, data[name]) for name in data.files))
+
+    def cell_points(self, keys):
+        """Indexes of the points in the cells with the given keys"""
+        pos = np.searchsorted(self.cell_keys, keys)
+        pos = np.minimum(pos, len(self.cell_keys) - 1)
+        pos = pos[self.cell_keys[pos] == keys]
+        if not len(pos):
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate([np.arange(self.cell_starts[p], self.cell_starts[p + 1])
+                               for p in pos])
+
+    def nearest_indexes(self, lat, lon, k=1):
+        """Indexes and distances (metres) of the k nearest points to (lat, lon)"""
+        if not len(self.ids):
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        x, y = project(np.array([lat]), np.array([lon]), self.lat0, self.cos_lat0)
+        x, y = x[0], y[0]
+        cx = int(math.floor(x / self.cell_size))
+        cy = int(math.floor(y / self.cell_size))
+        found = np.empty(0, dtype=np.int64)
+        dist = np.empty(0)
+        min_x, max_x, min_y, max_y = self.bounds
+        last_ring = max(abs(cx - min_x), abs(cx - max_x), abs(cy - min_y), abs(cy - max_y))
+        # A fix outside the grid starts at the first ring that reaches it: the rings before
+        # are empty
+        ring = max(min_x - cx, cx - max_x, min_y - cy, cy - max_y, 0)
+        while True:
+            keys = np.unique(ring_keys(cx, cy, ring, self.bounds))
+            idx = self.cell_points(keys)
+            if len(idx):
+                d = np.hypot(self.x[idx] - x, self.y[idx] - y)
+                found = np.concatenate([found, idx])
+                dist = np.concatenate([dist, d])
+                if len(found) > k:
+                    best = np.argpartition(dist, k - 1)[:k]
+                    found, dist = found[best], dist[best]
+            # Every point of ring + 1 and beyond is at least ring * cell_size away.
+            if len(found) >= k and dist.max() <= ring * self.cell_size:
+                break
+            if ring >= last_ring:
+                break
+            ring += 1
+        order = np.argsort(dist)
+        return found[order], dist[order]
+
+    def nearest(self, lat, lon, k=1):
+        idx, dist = self.nearest_indexes(lat, lon, k)
+        results = []
+        for i, d in zip(idx, dist):
+            result = {'id': int(self.ids[i]), 'distance': float(d),
+                      'lat': float(self.lat[i]), 'lon': float(self.lon[i])}
+            for label in LABELS:
+                result[label] = getattr(self, label)[i]
+            results.append(result)
+        return results
+
+    def nearest_batch(self, points, k=1):
+        """k nearest results for every (lat, lon) in points"""
+        return [self.nearest(lat, lon, k) for lat, lon in points]
+
+
+def project(lat, lon, lat0, cos_lat0=None):
+    """Equirectangular projection of degrees to metres around latitude lat0"""
+    if cos_lat0 is None:
+        cos_lat0 = math.cos(math.radians(lat0))
+    x = np.radians(lon) * EARTH_RADIUS * cos_lat0
+    y = np.radians(lat) * EARTH_RADIUS
+    return x, y
+
+
+def cell_key(cells_x, cells_y):
+    """A single sortable int64 key for the cell (cells_x, cells_y)"""
+    return (np.asarray(cells_y, dtype=np.int64) << 32) + \
+        (np.asarray(cells_x, dtype=np.int64) & 0xffffffff)
+
+
+def ring_keys(cx, cy, ring, bounds):
+    """Keys of the cells at Chebyshev distance ring from (cx, cy) inside bounds (min_x, max_x,
+    min_y, max_y): the sides of a ring around a far fix are mostly outside the grid"""
+    if ring == 0:
+        return cell_key([cx], [cy])
+    min_x, max_x, min_y, max_y = bounds
+    xs, ys = [], []
+    x0, x1 = max(cx - ring, min_x), min(cx + ring, max_x)
+    for y in (cy - ring, cy + ring):
+        if min_y <= y <= max_y and x0 <= x1:
+            xs.append(np.arange(x0, x1 + 1))
+            ys.append(np.full(x1 - x0 + 1, y))
+    y0, y1 = max(cy - ring + 1, min_y), min(cy + ring - 1, max_y)
+    for x in (cx - ring, cx + ring):
+        if min_x <= x <= max_x and y0 <= y1:
+            xs.append(np.full(y1 - y0 + 1, x))
+            ys.append(np.arange(y0, y1 + 1))
+    if not xs:
+        return np.empty(0, dtype=np.int64)
+    return cell_key(np.concatenate(xs), np.concatenate(ys))
+
+
+def full_scan(con, lat, lon, k=1):
+    """The nearest points the way it has to be done without an index: a scan of the table"""
+    return con.execute("""SELECT nodes.id FROM nodes WHERE nodes.id IN
+                       (SELECT id FROM nodes_tags WHERE type = 'addr' OR key = 'amenity')
+                       ORDER BY (lat - ?) * (lat - ?) + (lon - ?) * (lon - ?) * ?
+                       LIMIT ?;""", (lat, lat, lon, lon, math.cos(math.radians(lat)) ** 2,
+                                    k)).fetchall()
+
+
+def benchmark(database=database, n=2000, k=5):
+    start = time.time()
+    geocoder = ReverseGeocoder.build(database)
+    build = time.time() - start
+    geocoder.save(INDEX_FILE)
+    start = time.time()
+    geocoder = ReverseGeocoder.load(INDEX_FILE)
+    load = time.time() - start
+
+    rnd = np.random.RandomState(0)
+    lats = rnd.uniform(geocoder.lat.min(), geocoder.lat.max(), n)
+    lons = rnd.uniform(geocoder.lon.min(), geocoder.lon.max(), n)
+    start = time.time()
+    geocoder.nearest_batch(zip(lats, lons), k)
+    grid = n / (time.time() - start)
+
+    con = sqlite3.connect(database)
+    m = min(n, 50)
+    start = time.time()
+    for lat, lon in zip(lats[:m], lons[:m]):
+        full_scan(con, lat, lon, k)
+    scan = m / (time.time() - start)
+    con.close()
+    print 'Indexed {0} points: built in {1:.2f}s, loaded in {2:.3f}s'.format(
+        len(geocoder.ids), build, load)
+    print 'k={0}: grid {1:.0f} queries/s, full scan {2:.0f} queries/s'.format(k, grid, scan)
+
+
+if __name__ == '__main__':
+    benchmark()
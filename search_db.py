@@ -0,0 +1,113 @@
+"""
+Full-text search of places by name, street, city or amenity.
+
+Uses the FTS5 table (search) built by create_db.create_search_index. Every word of the query
+has to match, the last one as a prefix ('Kenn' finds 'Kennedy'), and the results are ranked
+with bm25, names weighing more than streets and cities.
+
+    >>> search('starbucks kennedy')
+    [{'id': 2107411723, 'element': u'node', 'name': u'Starbucks',
+      'street': u'West Kennedy Boulevard', 'u_street': u'Kennedy Boulevard', ...}, ...]
+
+Running the script compares the search latency with the LIKE '%...%' queries it replaces.
+"""
+import re
+import sqlite3
+import time
+
+from create_db import SEARCH_COLUMNS
+
+database = "TampaFlorida.db"
+
+# bm25 weight of each column of the search table (id and element are not indexed)
+WEIGHTS = {'name': 10.0, 'street': 4.0, 'u_street': 4.0, 'city': 2.0, 'amenity': 6.0}
+COLUMNS = [c for c, k, t in SEARCH_COLUMNS]
+
+word_re = re.compile(r'\w+', re.UNICODE)
+
+
+def fts_query(text, prefix=True):
+    """Turns free text into an FTS5 query: every word quoted, the last one as a prefix"""
+    words = word_re.findall(text)
+    if not words:
+        return None
+    terms = ['"{0}"'.format(w) for w in words]
+    if prefix:
+        terms[-1] += '*'
+    return ' '.join(terms)
+
+
+def search(text, database=database, limit=10, element=None, columns=None, prefix=True,
+           con=None):
+    """Returns up to limit elements matching text, best first. element restricts the results
+    to 'node' or 'way'; columns restricts the match to some of the search COLUMNS."""
+    query = fts_query(text, prefix)
+    if query is None:
+        return []
+    if columns:
+        query = '{{{0}}}: ({1})'.format(' '.join(columns), query)
+    weights = ', '.join(['0', '0'] + [str(WEIGHTS[c]) for c in COLUMNS])
+    sql = """SELECT id, element, {0}, bm25(search, {1}) AS rank FROM search
+          WHERE search MATCH ?""".format(', '.join(COLUMNS), weights)
+    params = [query]
+    if element is not None:
+        sql += ' AND element = ?'
+        params.append(element)
+    sql += ' ORDER BY rank LIMIT ?;'
+    params.append(limit)
+
+    own = con is None
+    if own:
+        con = sqlite3.connect(database)
+    try:
+        rows = con.execute(sql, params).fetchall()
+    finally:
+        if own:
+            con.close()
+    names = ['id', 'element'] + COLUMNS + ['rank']
+    return [dict(zip(names, row)) for row in rows]
+
+
+def like_search(text, con, limit=10):
+    """The LIKE '%...%' scan over the tag tables that search() replaces"""
+    keys = ', '.join("'{0}'".format(k) for c, k, t in SEARCH_COLUMNS)
+    sql = """SELECT tags.id, tags.element, tags.key, tags.value FROM
+          (SELECT id, 'node' AS element, key, value FROM nodes_tags UNION ALL
+           SELECT id, 'way' AS element, key, value FROM ways_tags) tags
+          JOIN (SELECT DISTINCT id, element FROM
+                (SELECT id, 'node' AS element FROM nodes_tags
+                 WHERE key IN ({0}) AND value LIKE ? UNION ALL
+                 SELECT id, 'way' AS element FROM ways_tags
+                 WHERE key IN ({0}) AND value LIKE ?) LIMIT ?) m
+          ON tags.id = m.id AND tags.element = m.element
+          WHERE tags.key IN ({0});""".format(keys)
+    pattern = '%{0}%'.format(text)
+    return con.execute(sql, (pattern, pattern, limit)).fetchall()
+
+
+def benchmark(terms, database=database, repeat=20):
+    """Mean latency in ms of search() and like_search() for every term"""
+    con = sqlite3.connect(database)
+    results = []
+    for term in terms:
+        timings = []
+        for func in (search, like_search):
+            start = time.time()
+            for _ in range(repeat):
+                if func is search:
+                    search(term, con=con)
+                else:
+                    like_search(term, con)
+            timings.append((time.time() - start) * 1000.0 / repeat)
+        results.append((term, timings[0], timings[1]))
+    con.close()
+    return results
+
+
+if __name__ == '__main__':
+    terms = ['Kennedy', 'Dale Mabry', 'restaurant', 'Saint Petersburg', 'Starbucks']
+    print '{0:<20s} {1:>10s} {2:>10s} {3:>8s}'.format('term', 'fts (ms)', 'like (ms)',
+                                                      'speedup')
+    for term, fts_ms, like_ms in benchmark(terms):
+        print '{0:<20s} {1:>10.2f} {2:>10.2f} {3:>7.1f}x'.format(term, fts_ms, like_ms,
+                                                                 like_ms / max(fts_ms, 1e-6))
@@ -0,0 +1,125 @@
+"""
+Mergeable probabilistic sketches for the audits of very large extracts.
+
+- HyperLogLog counts distinct items (users, keys, values) in a fixed amount of memory with a
+  relative standard error of about 1.04 / sqrt(2 ** precision).
+- CountMinSketch counts how often each item appears, overestimating by at most
+  epsilon * total with probability 1 - delta, and keeps the top items seen so far.
+
+Two sketches built with the same parameters merge into the sketch of the union of their
+streams, so every shard of a file (or every regional database) can be audited on its own and
+the results combined afterwards.
+"""
+import hashlib
+import heapq
+import math
+import struct
+
+
+def hash64(item):
+    """Stable 64 bit hash of a str or unicode item (the same in every process)"""
+    if isinstance(item, unicode):
+        item = item.encode('utf-8')
+    elif not isinstance(item, str):
+        item = str(item)
+    return struct.unpack('<Q', hashlib.md5(item).digest()[:8])[0]
+
+
+class HyperLogLog(object):
+    """Distinct counter. precision (4 to 18) sets the number of registers, 2 ** precision"""
+
+    def __init__(self, precision=14):
+        if not 4 <= precision <= 18:
+            raise ValueError('precision must be between 4 and 18')
+        self.p = precision
+        self.m = 1 << precision
+        self.registers = bytearray(self.m)
+
+    @classmethod
+    def from_error(cls, error):
+        """The smallest sketch with a relative standard error below error"""
+        return cls(min(18, max(4, int(math.ceil(2 * math.log(1.04 / error, 2))))))
+
+    def add(self, item):
+        h = hash64(item)
+        index = h >> (64 - self.p)
+        rest = h & ((1 << (64 - self.p)) - 1)
+        rank = 64 - self.p - rest.bit_length() + 1  # position of the leftmost 1 bit
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def count(self):
+        m = float(self.m)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count('\x00')
+        if estimate <= 2.5 * m and zeros:
+            return m * math.log(m / zeros)  # linear counting for small cardinalities
+        return estimate
+
+    def error(self):
+        return 1.04 / math.sqrt(self.m)
+
+    def merge(self, other):
+        if other.p != self.p:
+            raise ValueError('Can not merge HyperLogLogs of different precision')
+        self.registers = bytearray(max(a, b) for a, b in zip(self.registers, other.registers))
+        return self
+
+
+class CountMinSketch(object):
+    """Frequency counter that also keeps the top_n items with the largest counts"""
+
+    def __init__(self, epsilon=0.001, delta=0.01, top_n=20):
+        self.epsilon = epsilon
+        self.delta = delta
+        self.width = int(math.ceil(math.e / epsilon))
+        self.depth = int(math.ceil(math.log(1 / delta)))
+        self.table = [[0] * self.width for _ in range(self.depth)]
+        self.total = 0
+        self.top_n = top_n
+        self.top = {}  # candidate heavy hitters -> estimated count
+
+    def _cells(self, item):
+        h = hash64(item)
+        h1, h2 = h & 0xffffffff, h >> 32
+        return [(i, (h1 + i * h2) % self.width) for i in range(self.depth)]
+
+    def add(self, item, count=1):
+        self.total += count
+        cells = self._cells(item)
+        for i, j in cells:
+            self.table[i][j] += count
+        self._offer(item, min(self.table[i][j] for i, j in cells))
+
+    def _offer(self, item, estimate):
+        if item in self.top or len(self.top) < self.top_n:
+            self.top[item] = estimate
+        else:
+            smallest = min(self.top, key=self.top.get)
+            if estimate > self.top[smallest]:
+                del self.top[smallest]
+                self.top[item] = estimate
+
+    def estimate(self, item):
+        return min(self.table[i][j] for i, j in self._cells(item))
+
+    def error(self):
+        """Upper bound of the overestimate of any count (with probability 1 - delta)"""
+        return self.epsilon * self.total
+
+    def most_common(self, n=None):
+        return heapq.nlargest(n or self.top_n, self.top.items(), key=lambda kv: kv[1])
+
+    def merge(self, other):
+        if (other.width, other.depth) != (self.width, self.depth):
+            raise ValueError('Can not merge CountMinSketches of different size')
+        for row, other_row in zip(self.table, other.table):
+            for j, count in enumerate(other_row):
+                row[j] += count
+        self.total += other.total
+        candidates = set(self.top) | set(other.top)
+        self.top = {}
+        for item in candidates:
+            self._offer(item, self.estimate(item))
+        return self
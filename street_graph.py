@@ -0,0 +1,277 @@
+"""
+Routable street graph of the ways tagged highway=*.
+
+The ways are split at their intersections (nodes shared by more than one way, or used twice
+by the same way) and at their ends. Those nodes are the vertices of the graph and every piece
+of way between two of them is an edge, whose length in metres is the sum of the great-circle
+distances between its consecutive nodes. A way tagged oneway=yes only gets edges in its own
+direction (oneway=-1 in the opposite one), every other way gets both.
+
+The adjacency is stored in compressed sparse row (CSR) form, one NumPy .npy file per array
+in GRAPH_DIR: the edges leaving vertex v are indices[indptr[v]:indptr[v + 1]], with their
+lengths and ways at the same positions. The files are memory-mapped when the graph is loaded,
+so opening a graph is instant and costs no memory until its pages are read:
+
+    >>> graph = StreetGraph.build('TampaFlorida.db')
+    >>> graph.save('street_graph')
+    >>> graph = StreetGraph.load('street_graph')
+    >>> graph.shortest_path(graph.nearest_vertex(27.9442, -82.4722),
+    ...                     graph.nearest_vertex(27.9506, -82.4572))
+    (1532.7, [356552551, ..., 356552637])
+    >>> labels, sizes = graph.components()
+
+Running the script builds the graph and benchmarks it.
+"""
+import heapq
+import math
+import os
+import sqlite3
+import sys
+import time
+from collections import deque
+
+import numpy as np
+
+database = "TampaFlorida.db"
+GRAPH_DIR = "street_graph"
+
+EARTH_RADIUS = 6371000.0
+# highway=* values that are not part of the road network
+NOT_ROUTABLE = ('proposed', 'construction', 'abandoned', 'disused', 'platform', 'bus_stop',
+                'razed')
+ONEWAY = ('yes', 'true', '1')
+ARRAYS = ['node_ids', 'lat', 'lon', 'indptr', 'indices', 'lengths', 'ways']
+
+WAY_NODES_QUERY = """SELECT wn.id, wn.node_id, n.lat, n.lon FROM ways_nodes wn
+JOIN nodes n ON n.id = wn.node_id
+WHERE wn.id IN (SELECT id FROM ways_tags WHERE key = 'highway' AND type = 'regular'
+                AND value NOT IN ({0}))
+ORDER BY wn.id, wn.position;"""
+
+ONEWAY_QUERY = """SELECT id, value FROM ways_tags WHERE key = 'oneway' AND type = 'regular';"""
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """Great-circle distance in metres between arrays of points in degrees"""
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + \
+        np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+class StreetGraph(object):
+    """CSR adjacency of the street network. Vertices are numbered 0..n-1 in the order of
+    their OSM node ids (node_ids)."""
+
+    def __init__(self, arrays):
+        for name in ARRAYS:
+            setattr(self, name, arrays[name])
+        self._lists = None
+
+    @classmethod
+    def build(cls, database=database):
+        con = sqlite3.connect(database)
+        rows = con.execute(WAY_NODES_QUERY.format(
+            ', '.join("'{0}'".format(v) for v in NOT_ROUTABLE))).fetchall()
+        oneway = dict(con.execute(ONEWAY_QUERY).fetchall())
+        con.close()
+
+        way = np.array([r[0] for r in rows], dtype=np.int64)
+        node = np.array([r[1] for r in rows], dtype=np.int64)
+        lat = np.array([r[2] for r in rows], dtype=np.float64)
+        lon = np.array([r[3] for r in rows], dtype=np.float64)
+        n = len(rows)
+
+        same_way = way[1:] == way[:-1]
+        first = np.ones(n, dtype=bool)
+        first[1:] = ~same_way
+        last = np.ones(n, dtype=bool)
+        last[:-1] = ~same_way
+        # Distance from the start of the data, only ever subtracted within a way
+        steps = np.zeros(n)
+        steps[1:] = np.where(same_way, haversine(lat[:-1], lon[:-1], lat[1:], lon[1:]), 0.0)
+        distance = np.cumsum(steps)
+
+        node_ids, index, inverse, counts = np.unique(node, return_index=True,
+                                                     return_inverse=True, return_counts=True)
+        vertex = first | last | (counts[inverse] > 1)
+        at = np.nonzero(vertex)[0]
+        # An edge between every two consecutive vertices of the same way
+        pairs = way[at[1:]] == way[at[:-1]]
+        src, dst = inverse[at[:-1]][pairs], inverse[at[1:]][pairs]
+        lengths = (distance[at[1:]] - distance[at[:-1]])[pairs]
+        edge_way = way[at[1:]][pairs]
+        keep = src != dst
+        src, dst, lengths, edge_way = src[keep], dst[keep], lengths[keep], edge_way[keep]
+
+        forward = np.array([oneway.get(w) != '-1' for w in edge_way], dtype=bool)
+        backward = np.array([oneway.get(w) not in ONEWAY for w in edge_way], dtype=bool)
+        src, dst, lengths, edge_way = (np.concatenate([src[forward], dst[backward]]),
+                                       np.concatenate([dst[forward], src[backward]]),
+                                       np.concatenate([lengths[forward], lengths[backward]]),
+                                       np.concatenate([edge_way[forward],
+                                                       edge_way[backward]]))
+
+        # Only the vertices are kept; the other nodes are renumbered away.
+        vertices = np.unique(inverse[at])
+        number = np.full(len(node_ids), -1, dtype=np.int64)
+        number[vertices] = np.arange(len(vertices))
+        src, dst = number[src], number[dst]
+        order = np.argsort(src, kind='mergesort')
+        indptr = np.zeros(len(vertices) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(np.bincount(src, minlength=len(vertices)))
+        return cls({'node_ids': node_ids[vertices],
+                    'lat': lat[index[vertices]], 'lon': lon[index[vertices]],
+                    'indptr': indptr,
+                    'indices': dst[order].astype(np.int32),
+                    'lengths': lengths[order].astype(np.float32),
+                    'ways': edge_way[order]})
+
+    def save(self, path=GRAPH_DIR):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for name in ARRAYS:
+            np.save(os.path.join(path, name + '.npy'), getattr(self, name))
+
+    @classmethod
+    def load(cls, path=GRAPH_DIR, mmap_mode='r'):
+        return cls(dict((name, np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode))
+                        for name in ARRAYS))
+
+    def vertex(self, node_id):
+        """Vertex number of an OSM node id (KeyError if the node is not a vertex)"""
+        v = int(np.searchsorted(self.node_ids, node_id))
+        if v == len(self.node_ids) or self.node_ids[v] != node_id:
+            raise KeyError(node_id)
+        return v
+
+    def nearest_vertex(self, lat, lon):
+        """OSM node id of the vertex closest to (lat, lon)"""
+        return int(self.node_ids[np.argmin(haversine(self.lat, self.lon, lat, lon))])
+
+    def adjacency(self):
+        """The arrays as Python lists, which are much faster to index one item at a time.
+        Built on the first query and kept."""
+        if self._lists is None:
+            self._lists = (self.indptr.tolist(), self.indices.tolist(), self.lengths.tolist(),
+                           np.radians(self.lat).tolist(), np.radians(self.lon).tolist())
+        return self._lists
+
+    def shortest_path(self, source, target):
+        """(length in metres, OSM node ids of the vertices on the way) of the shortest path
+        between two nodes, (inf, []) if there is none.
+
+        A* search: the great-circle distance to the target never exceeds the length of a
+        path (edges are sums of great-circle distances), so the first time the target is
+        taken from the heap its distance is the shortest one."""
+        s, t = self.vertex(source), self.vertex(target)
+        indptr, indices, lengths, lat, lon = self.adjacency()
+        t_lat, t_lon, cos_t = lat[t], lon[t], math.cos(lat[t])
+
+        def remaining(v):
+            # Slightly under the great-circle distance, so float32 lengths never make it
+            # overestimate
+            a = math.sin((t_lat - lat[v]) / 2) ** 2 + \
+                math.cos(lat[v]) * cos_t * math.sin((t_lon - lon[v]) / 2) ** 2
+            return 0.999 * 2 * EARTH_RADIUS * math.asin(math.sqrt(min(1.0, a)))
+
+        dist = {s: 0.0}
+        previous = {}
+        heap = [(remaining(s), s)]
+        done = set()
+        while heap:
+            _, v = heapq.heappop(heap)
+            if v in done:
+                continue
+            if v == t:
+                break
+            done.add(v)
+            d = dist[v]
+            for i in range(indptr[v], indptr[v + 1]):
+                w = indices[i]
+                nd = d + lengths[i]
+                if nd < dist.get(w, float('inf')):
+                    dist[w] = nd
+                    previous[w] = v
+                    heapq.heappush(heap, (nd + remaining(w), w))
+        if t not in dist:
+            return float('inf'), []
+        path = [t]
+        while path[-1] != s:
+            path.append(previous[path[-1]])
+        return dist[t], [int(self.node_ids[v]) for v in reversed(path)]
+
+    def components(self):
+        """Weakly connected components: (component of every vertex, size of every component),
+        the components numbered from the largest to the smallest"""
+        n = len(self.node_ids)
+        src = np.repeat(np.arange(n), np.diff(self.indptr))
+        dst = np.asarray(self.indices, dtype=np.int64)
+        # Both directions of every edge, in CSR form
+        both_src = np.concatenate([src, dst])
+        both_dst = np.concatenate([dst, src])
+        order = np.argsort(both_src, kind='mergesort')
+        neighbours = both_dst[order].tolist()
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(np.bincount(both_src, minlength=n))
+        indptr = indptr.tolist()
+
+        labels = [-1] * n
+        sizes = []
+        for root in range(n):
+            if labels[root] != -1:
+                continue
+            label = len(sizes)
+            labels[root] = label
+            queue = deque([root])
+            size = 0
+            while queue:
+                v = queue.popleft()
+                size += 1
+                for w in neighbours[indptr[v]:indptr[v + 1]]:
+                    if labels[w] == -1:
+                        labels[w] = label
+                        queue.append(w)
+            sizes.append(size)
+
+        sizes = np.array(sizes, dtype=np.int64)
+        rank = np.empty(len(sizes), dtype=np.int64)
+        rank[np.argsort(-sizes, kind='mergesort')] = np.arange(len(sizes))
+        return rank[np.array(labels, dtype=np.int64)], np.sort(sizes)[::-1]
+
+
+def benchmark(database=database, n=200):
+    start = time.time()
+    graph = StreetGraph.build(database)
+    build = time.time() - start
+    graph.save(GRAPH_DIR)
+    start = time.time()
+    graph = StreetGraph.load(GRAPH_DIR)
+    load = time.time() - start
+    print 'Graph of {0} vertices and {1} edges: built in {2:.2f}s, loaded in {3:.4f}s'.format(
+        len(graph.node_ids), len(graph.indices), build, load)
+
+    start = time.time()
+    labels, sizes = graph.components()
+    print 'Components: {0} in {1:.3f}s, the largest has {2} vertices'.format(
+        len(sizes), time.time() - start, sizes[0] if len(sizes) else 0)
+
+    # Routes between random vertices of the largest component
+    largest = np.nonzero(labels == 0)[0]
+    if not len(largest):
+        return
+    rnd = np.random.RandomState(0)
+    pairs = rnd.choice(largest, (n, 2))
+    times = []
+    for s, t in pairs:
+        start = time.time()
+        graph.shortest_path(graph.node_ids[s], graph.node_ids[t])
+        times.append((time.time() - start) * 1000.0)
+    times = np.array(times)
+    print 'Shortest paths: {0} queries, mean {1:.2f} ms, median {2:.2f} ms, ' \
+          'p95 {3:.2f} ms'.format(n, times.mean(), np.median(times),
+                                  np.percentile(times, 95))
+
+
+if __name__ == '__main__':
+    benchmark(sys.argv[1] if len(sys.argv) > 1 else database)
@@ -0,0 +1,158 @@
+"""
+Filter profiles for clean_data.py: which elements and tags a build keeps, for consumers that
+only need part of the map (addresses, amenities and names) and not the whole of the TIGER
+and GNIS imports.
+
+A profile is a dict, named in PROFILES or read from a JSON file:
+
+    {"elements": ["node", "way"],           kinds of element written (default: all)
+     "include_keys": ["name", "amenity"],   tags kept, by key (fnmatch patterns on the
+     "include_types": ["addr"],             lowercase key) or by type (the part before the
+                                            colon, see clean_data.classify_key); every tag
+                                            when neither is given
+     "exclude_keys": ["note*"],             tags dropped even if included
+     "exclude_types": ["tiger", "gnis"],
+     "way_nodes": false,                    write the node lists of ways (default: true)
+     "tagged_only": true}                   drop the elements left without tags
+
+    clean_data.process_map('tampa_florida.osm', False, 'out', profile='places')
+
+The profile is applied while parsing: elements of other kinds are not shaped, a dropped tag
+is not cleaned, and neither is written to any .csv file (raw_tags.csv included). Tags made by
+a cleaning rule (addr:city from a whole address in addr:street, ...) follow the tag they come
+from.
+
+Running the script builds an .osm file with every profile of PROFILES and reports the size of
+the .csv files and of the database and the time to build them, against the full build:
+
+    python tag_profiles.py [file.osm] [--profiles places,addresses] [--out profiles]
+"""
+import argparse
+import fnmatch
+import json
+import os
+import shutil
+import time
+
+OSM_PATH = 'tampa_florida.osm'
+OUT_DIR = 'profiles'
+ELEMENTS = ('node', 'way', 'relation')
+
+PROFILES = {'full': {},
+            'no_imports': {'exclude_types': ['tiger', 'gnis']},
+            'places': {'include_keys': ['name', 'name:*', 'amenity', 'shop', 'tourism',
+                                        'leisure', 'cuisine', 'phone', 'website',
+                                        'opening_hours'],
+                       'include_types': ['addr'],
+                       'way_nodes': False,
+                       'tagged_only': True},
+            'addresses': {'elements': ['node', 'way'],
+                          'include_types': ['addr'],
+                          'way_nodes': False,
+                          'tagged_only': True}}
+
+
+class Profile(object):
+    """A profile ready to be applied. keep(s, tag_type) is decided once per distinct key."""
+
+    def __init__(self, config, name=None):
+        unknown = set(config) - set(['elements', 'include_keys', 'include_types',
+                                     'exclude_keys', 'exclude_types', 'way_nodes',
+                                     'tagged_only'])
+        if unknown:
+            raise ValueError('Unknown options in profile {0}: {1}'.format(
+                name, ', '.join(sorted(unknown))))
+        self.name = name
+        self.elements = tuple(e for e in ELEMENTS if e in config.get('elements', ELEMENTS))
+        self.include_keys = config.get('include_keys', [])
+        self.include_types = set(config.get('include_types', []))
+        self.exclude_keys = config.get('exclude_keys', [])
+        self.exclude_types = set(config.get('exclude_types', []))
+        self.way_nodes = config.get('way_nodes', True)
+        self.tagged_only = config.get('tagged_only', False)
+        self._cache = {}
+
+    def keep(self, s, tag_type):
+        """Whether the tag with lowercase key s and type tag_type is kept"""
+        try:
+            return self._cache[s]
+        except KeyError:
+            pass
+        if self.include_keys or self.include_types:
+            kept = tag_type in self.include_types or \
+                any(fnmatch.fnmatchcase(s, p) for p in self.include_keys)
+        else:
+            kept = True
+        if kept and (tag_type in self.exclude_types or
+                     any(fnmatch.fnmatchcase(s, p) for p in self.exclude_keys)):
+            kept = False
+        self._cache[s] = kept
+        return kept
+
+
+def load_profile(profile):
+    """The Profile of a name in PROFILES, of a JSON file or of a dict. None stays None (no
+    filtering)."""
+    if profile is None or isinstance(profile, Profile):
+        return profile
+    if isinstance(profile, dict):
+        return Profile(profile)
+    if profile in PROFILES:
+        return Profile(PROFILES[profile], profile)
+    with open(profile) as f:
+        return Profile(json.load(f), profile)
+
+
+def dir_size(path):
+    return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+
+
+def benchmark(osm_file=OSM_PATH, names=None, out_dir=OUT_DIR):
+    """{profile: (seconds to clean, size of the .csv files, seconds to load, size of the
+    database)} of a build of osm_file with every profile of names ('full' is always run)"""
+    import clean_data
+    import create_db
+
+    results = {}
+    for name in ['full'] + [n for n in names or sorted(PROFILES) if n != 'full']:
+        csv_dir = os.path.join(out_dir, os.path.basename(name))
+        if os.path.exists(csv_dir):
+            shutil.rmtree(csv_dir)
+        os.makedirs(csv_dir)
+        start = time.time()
+        clean_data.process_map(osm_file, False, csv_dir, profile=None if name == 'full'
+                               else name)
+        clean = time.time() - start
+        csv_size = dir_size(csv_dir)
+        db = csv_dir + '.db'
+        if os.path.exists(db):
+            os.remove(db)
+        start = time.time()
+        create_db.create_db(db, csv_dir=csv_dir)
+        results[name] = (clean, csv_size, time.time() - start, os.path.getsize(db))
+    return results
+
+
+def print_report(results):
+    full = results['full']
+    row = '{0:<12s} {1:>10.2f} {2:>10.1f} {3:>10.2f} {4:>10.1f} {5:>7.0%} {6:>7.0%}'
+    print '{0:<12s} {1:>10s} {2:>10s} {3:>10s} {4:>10s} {5:>8s} {6:>8s}'.format(
+        'profile', 'clean (s)', 'csv (MB)', 'load (s)', 'db (MB)', 'time', 'size')
+    for name in ['full'] + sorted(n for n in results if n != 'full'):
+        clean, csv_size, load, db_size = results[name]
+        print row.format(os.path.basename(name), clean, csv_size / 1024.0 ** 2, load,
+                         db_size / 1024.0 ** 2, 1 - (clean + load) / (full[0] + full[2]),
+                         1 - (csv_size + db_size) / float(full[1] + full[3]))
+    print '(time and size: saved against the full build, cleaning and loading together)'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Output size and runtime saved by the tag '
+                                                 'filter profiles')
+    parser.add_argument('osm', nargs='?', default=OSM_PATH)
+    parser.add_argument('--profiles', help='comma-separated names or JSON files (default: '
+                                           'every profile of PROFILES)')
+    parser.add_argument('--out', default=OUT_DIR, help='directory of the builds')
+    args = parser.parse_args()
+    print_report(benchmark(args.osm, args.profiles.split(',') if args.profiles else None,
+                           args.out))
@@ -0,0 +1,101 @@
+"""
+Compares the time-based queries on the current layout (integer timestamps with year and
+month columns, see create_db.py) with the original layout, where timestamps were ISO strings
+and every query called strftime on every row.
+
+The original layout is rebuilt from the database into a temporary file, so both run on the
+same data:
+
+    python timestamp_benchmark.py [TampaFlorida.db] [user] [year]
+"""
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+import make_a_view
+from query_db import query11, query12
+
+database = "TampaFlorida.db"
+
+LEGACY_QUERY11 = """SELECT strftime('%Y', t.timestamp) as Year, COUNT(*) as changes
+FROM (SELECT nodes.timestamp FROM nodes UNION ALL SELECT ways.timestamp FROM ways) t
+GROUP BY Year ORDER BY Year DESC;"""
+
+LEGACY_VIEW = """CREATE VIEW myview AS SELECT e.user, strftime('%Y', e.timestamp) as Year,
+COUNT(*) as num
+FROM (SELECT user, timestamp FROM nodes UNION ALL SELECT user, timestamp FROM ways ) e
+GROUP BY e.user, strftime('%Y', e.timestamp) ORDER BY num DESC,
+strftime('%Y', e.timestamp) DESC"""
+
+# Edits of a user in a year
+LEGACY_USER_YEAR = """SELECT COUNT(*) FROM (SELECT user, timestamp FROM nodes UNION ALL
+SELECT user, timestamp FROM ways) e WHERE e.user = ? AND strftime('%Y', e.timestamp) = ?;"""
+
+USER_YEAR = """SELECT (SELECT COUNT(*) FROM nodes WHERE user = ?1 AND timestamp >= ?2 AND
+timestamp < ?3) + (SELECT COUNT(*) FROM ways WHERE user = ?1 AND timestamp >= ?2 AND
+timestamp < ?3);"""
+
+
+def build_legacy(database, legacy):
+    """Copies nodes and ways with ISO string timestamps into the database legacy"""
+    con = sqlite3.connect(legacy)
+    con.execute("ATTACH DATABASE ? AS current;", (database,))
+    con.execute("""CREATE TABLE nodes AS SELECT id, lat, lon, user, uid, version, changeset,
+                strftime('%Y-%m-%dT%H:%M:%SZ', timestamp, 'unixepoch') AS timestamp
+                FROM current.nodes;""")
+    con.execute("""CREATE TABLE ways AS SELECT id, user, uid, version, changeset,
+                strftime('%Y-%m-%dT%H:%M:%SZ', timestamp, 'unixepoch') AS timestamp
+                FROM current.ways;""")
+    con.execute(LEGACY_VIEW)
+    con.commit()
+    con.close()
+
+
+def timed(con, sql, params=(), repeat=5):
+    start = time.time()
+    for _ in range(repeat):
+        result = con.execute(sql, params).fetchall()
+    return (time.time() - start) * 1000.0 / repeat, result
+
+
+def benchmark(database=database, user=None, year=2016):
+    make_a_view.make_view(database)
+    legacy = os.path.join(tempfile.mkdtemp(), 'legacy.db')
+    build_legacy(database, legacy)
+    new_con = sqlite3.connect(database)
+    old_con = sqlite3.connect(legacy)
+    if user is None:
+        user = new_con.execute("""SELECT user FROM nodes GROUP BY user
+                               ORDER BY COUNT(*) DESC LIMIT 1;""").fetchone()[0]
+    start = new_con.execute("SELECT CAST(strftime('%s', ?) AS INTEGER);",
+                            ('{0}-01-01'.format(year),)).fetchone()[0]
+    end = new_con.execute("SELECT CAST(strftime('%s', ?) AS INTEGER);",
+                          ('{0}-01-01'.format(year + 1),)).fetchone()[0]
+
+    cases = [('query11', (LEGACY_QUERY11, ()), (query11, ())),
+             ('query12', (query12, ()), (query12, ())),
+             ('edits of {0} in {1}'.format(user, year), (LEGACY_USER_YEAR, (user, str(year))),
+              (USER_YEAR, (user, start, end)))]
+    print '{0:<35s} {1:>12s} {2:>12s} {3:>8s}'.format('query', 'strings (ms)', 'epoch (ms)',
+                                                      'speedup')
+    for name, (old_sql, old_params), (new_sql, new_params) in cases:
+        old_ms, old_result = timed(old_con, old_sql, old_params)
+        new_ms, new_result = timed(new_con, new_sql, new_params)
+        same = [tuple(str(v) for v in r) for r in old_result] == \
+            [tuple(str(v) for v in r) for r in new_result]
+        print '{0:<35s} {1:>12.2f} {2:>12.2f} {3:>7.1f}x{4}'.format(
+            name, old_ms, new_ms, old_ms / max(new_ms, 1e-6), '' if same else ' (differs!)')
+    plan = new_con.execute('EXPLAIN QUERY PLAN ' + USER_YEAR, (user, start, end)).fetchall()
+    print ' '
+    print 'Plan of the user/year query: ', '; '.join(row[-1] for row in plan)
+    new_con.close()
+    old_con.close()
+    os.remove(legacy)
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    benchmark(args[0] if args else database, args[1] if len(args) > 1 else None,
+              int(args[2]) if len(args) > 2 else 2016)
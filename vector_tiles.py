@@ -0,0 +1,673 @@
+"""
+Pre-generated Mapbox Vector Tiles (MVT 2.1) of the cleaned map, stored in an MBTiles file that
+any tile server or map viewer can read, so that a viewport is a handful of tile reads instead
+of queries over nodes, ways_nodes and the tag tables.
+
+The features are the elements with one of the tags of LAYERS (roads, water, landuse,
+buildings, points of interest) plus the areas of the table multipolygons (see
+multipolygons.py). They are read from the database once and projected to Web Mercator; every
+tile of MIN_ZOOM..MAX_ZOOM gets the features that reach into it (plus BUFFER pixels),
+clipped to it and simplified with a tolerance of TOLERANCE pixels of that tile, so the lower
+the zoom the coarser the geometry. Tiles are encoded in a process pool, gzipped and written
+to the MBTiles file (tile_row counts from the south, as in TMS).
+
+Every tile also stores a digest of the features it was made of (table tile_digests). Running
+it again after an update of the database (merge_db.py, reclean.py, a new extract) only encodes
+the tiles whose features changed and removes the tiles left empty:
+
+    python vector_tiles.py [--db TampaFlorida.db] [--out TampaFlorida.mbtiles]
+                           [--min-zoom 10] [--max-zoom 14] [--workers N] [--force]
+"""
+import argparse
+import hashlib
+import json
+import math
+import multiprocessing
+import os
+import sqlite3
+import struct
+import time
+import zlib
+from collections import defaultdict
+
+import numpy as np
+
+import quadtiles
+
+database = "TampaFlorida.db"
+MBTILES_FILE = "TampaFlorida.mbtiles"
+MIN_ZOOM = 10
+MAX_ZOOM = 14
+EXTENT = 4096  # tile coordinates per side
+BUFFER = 64  # tile coordinates around a tile that are kept, so lines join across tiles
+TOLERANCE = 4.0  # Douglas-Peucker tolerance, in tile coordinates
+JOB_TILES = 64  # tiles per job of the pool
+
+# (layer, element, key, values or None for any, first zoom, geometry). An element goes to the
+# layer of the first rule it matches; a 'polygon' that is not closed is drawn as a line.
+LAYERS = [
+    ('water', 'way', 'natural', ['water', 'wetland', 'bay'], 10, 'polygon'),
+    ('waterways', 'way', 'waterway', None, 12, 'line'),
+    ('roads', 'way', 'highway', ['motorway', 'motorway_link', 'trunk', 'trunk_link'], 10,
+     'line'),
+    ('roads', 'way', 'highway', ['primary', 'primary_link', 'secondary', 'secondary_link'], 11,
+     'line'),
+    ('roads', 'way', 'highway', ['tertiary', 'tertiary_link'], 12, 'line'),
+    ('roads', 'way', 'highway', None, 13, 'line'),
+    ('landuse', 'way', 'leisure', None, 12, 'polygon'),
+    ('landuse', 'way', 'landuse', None, 12, 'polygon'),
+    ('buildings', 'way', 'building', None, 14, 'polygon'),
+    ('pois', 'node', 'amenity', None, 14, 'point'),
+    ('pois', 'node', 'shop', None, 14, 'point'),
+    ('pois', 'node', 'tourism', None, 14, 'point'),
+]
+AREAS_LAYER = ('areas', 10)  # the table multipolygons, from this zoom on
+PROPERTIES = ['name', 'ref', 'oneway']  # tags kept on every feature (and its matched tag)
+
+GEOMETRY_TYPES = {'point': 1, 'line': 2, 'polygon': 3}
+
+MBTILES_SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT);',
+    """CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER,
+    tile_row INTEGER, tile_data BLOB, PRIMARY KEY (zoom_level, tile_column, tile_row));""",
+    """CREATE TABLE IF NOT EXISTS tile_digests (zoom_level INTEGER, tile_column INTEGER,
+    tile_row INTEGER, digest TEXT, PRIMARY KEY (zoom_level, tile_column, tile_row));""",
+]
+
+
+################################### Features #################################################
+
+def world_xy(lat, lon):
+    """Web Mercator coordinates in [0, 1) of points in degrees, y growing to the south"""
+    lat = np.radians(np.clip(np.asarray(lat, dtype=np.float64), -quadtiles.MAX_LAT,
+                             quadtiles.MAX_LAT))
+    x = (np.asarray(lon, dtype=np.float64) + 180.0) / 360.0
+    y = (1.0 - np.log(np.tan(lat) + 1.0 / np.cos(lat)) / math.pi) / 2.0
+    return x, y
+
+
+def match_rule(element, tags):
+    """The first rule of LAYERS that the tags ({key: value}) of an element match"""
+    for rule in LAYERS:
+        layer, rule_element, key, values, zoom, geometry = rule
+        if rule_element == element and key in tags and (values is None or
+                                                        tags[key] in values):
+            return rule
+    return None
+
+
+def element_tags(con, table, keys):
+    """{id: {key: value}} of the regular tags in keys of the elements of a tag table"""
+    tags = defaultdict(dict)
+    for element_id, key, value in con.execute(
+            "SELECT id, key, value FROM {0} WHERE type = 'regular' AND key IN ({1});".format(
+                table, ','.join('?' * len(keys))), keys):
+        tags[element_id].setdefault(key, value)
+    return tags
+
+
+def feature(layer, element_id, geometry, min_zoom, properties, parts):
+    """A feature: parts are (x, y) arrays in world coordinates, one per point or line, or
+    one list of them (its rings) per polygon. They are kept as lists, faster than NumPy for
+    the few points of a feature in a tile."""
+    rings = [p for part in parts for p in (part if geometry == 'polygon' else [part])]
+    xs = np.concatenate([r[0] for r in rings])
+    ys = np.concatenate([r[1] for r in rings])
+    digest = hashlib.md5(repr((layer, element_id, geometry, sorted(properties.items()))) +
+                         xs.tobytes() + ys.tobytes()).hexdigest()
+    if geometry == 'polygon':
+        parts = [[(x.tolist(), y.tolist()) for x, y in polygon] for polygon in parts]
+    else:
+        parts = [(x.tolist(), y.tolist()) for x, y in parts]
+    return {'layer': layer, 'id': element_id, 'geometry': geometry, 'min_zoom': min_zoom,
+            'properties': properties, 'parts': parts, 'digest': digest,
+            'bounds': (float(xs.min()), float(ys.min()), float(xs.max()), float(ys.max()))}
+
+
+def load_features(database=database):
+    """Every feature of the layers, read from database"""
+    con = sqlite3.connect(database)
+    keys = sorted(set(r[2] for r in LAYERS) | set(PROPERTIES))
+    features = []
+
+    node_tags = element_tags(con, 'nodes_tags', keys)
+    node_rules = dict((i, match_rule('node', t)) for i, t in node_tags.items())
+    node_rules = dict((i, r) for i, r in node_rules.items() if r is not None)
+    for element_id, lat, lon in con.execute('SELECT id, lat, lon FROM nodes ORDER BY id;'):
+        rule = node_rules.get(element_id)
+        if rule is not None:
+            x, y = world_xy([lat], [lon])
+            features.append(feature(rule[0], element_id, rule[5], rule[4],
+                                    properties(node_tags[element_id], rule), [(x, y)]))
+
+    way_tags = element_tags(con, 'ways_tags', keys)
+    way_rules = dict((i, match_rule('way', t)) for i, t in way_tags.items())
+    way_rules = dict((i, r) for i, r in way_rules.items() if r is not None)
+    ways = defaultdict(list)
+    for way_id, lat, lon in con.execute(
+            """SELECT wn.id, n.lat, n.lon FROM ways_nodes wn JOIN nodes n ON n.id = wn.node_id
+            ORDER BY wn.id, wn.position;"""):
+        if way_id in way_rules:
+            ways[way_id].append((lat, lon))
+    for way_id in sorted(ways):
+        rule = way_rules[way_id]
+        points = ways[way_id]
+        if len(points) < 2:
+            continue
+        x, y = world_xy([p[0] for p in points], [p[1] for p in points])
+        geometry = rule[5]
+        if geometry == 'polygon' and (len(points) < 4 or points[0] != points[-1]):
+            geometry = 'line'
+        parts = [[(x, y)]] if geometry == 'polygon' else [(x, y)]
+        features.append(feature(rule[0], way_id, geometry, rule[4],
+                                properties(way_tags[way_id], rule), parts))
+
+    if con.execute("SELECT 1 FROM sqlite_master WHERE name = 'multipolygons';").fetchone():
+        for area_id, area_type, name, geojson in con.execute(
+                'SELECT id, type, name, geojson FROM multipolygons ORDER BY id;'):
+            parts = []
+            for polygon in json.loads(geojson)['coordinates']:
+                rings = []
+                for ring in polygon:
+                    x, y = world_xy([p[1] for p in ring], [p[0] for p in ring])
+                    rings.append((x, y))
+                parts.append(rings)
+            props = dict((k, v) for k, v in [('type', area_type), ('name', name)] if v)
+            features.append(feature(AREAS_LAYER[0], area_id, 'polygon', AREAS_LAYER[1], props,
+                                    parts))
+    con.close()
+    return features
+
+
+def properties(tags, rule):
+    props = dict((k, tags[k]) for k in PROPERTIES if k in tags)
+    props[rule[2]] = tags[rule[2]]
+    return props
+
+
+def cell(v, n):
+    """Row or column (0..n - 1) of a coordinate in tiles"""
+    return min(n - 1, max(0, int(math.floor(v))))
+
+
+def line_tiles(x, y, zoom):
+    """Tiles of zoom (with their BUFFER) that a line of world coordinates goes through: the
+    tiles around every short segment, the long ones followed column by column"""
+    n = 2 ** zoom
+    margin = float(BUFFER) / EXTENT
+    x, y = np.asarray(x) * n, np.asarray(y) * n
+
+    def cells(v):
+        return np.clip(np.floor(v), 0, n - 1).astype(np.int64)
+    tx0 = cells(np.minimum(x[:-1], x[1:]) - margin)
+    tx1 = cells(np.maximum(x[:-1], x[1:]) + margin)
+    ty0 = cells(np.minimum(y[:-1], y[1:]) - margin)
+    ty1 = cells(np.maximum(y[:-1], y[1:]) + margin)
+    short = (tx1 - tx0 <= 1) & (ty1 - ty0 <= 1)
+    tiles = set()
+    for dx in (0, 1):
+        for dy in (0, 1):
+            ok = short & (tx0 + dx <= tx1) & (ty0 + dy <= ty1)
+            tiles.update(zip((tx0[ok] + dx).tolist(), (ty0[ok] + dy).tolist()))
+    for i in np.nonzero(~short)[0].tolist():
+        (ax, ay), (bx, by) = sorted([(float(x[i]), float(y[i])),
+                                     (float(x[i + 1]), float(y[i + 1]))])
+        slope = (by - ay) / (bx - ax) if bx > ax else None
+        for column in range(int(tx0[i]), int(tx1[i]) + 1):
+            # The part of the segment within the column, and the rows it reaches
+            left, right = max(ax, column - margin), min(bx, column + 1 + margin)
+            if left > right:
+                continue
+            if slope is None:
+                y0, y1 = min(ay, by), max(ay, by)
+            else:
+                y0, y1 = sorted([ay + (left - ax) * slope, ay + (right - ax) * slope])
+            for row in range(cell(y0 - margin, n), cell(y1 + margin, n) + 1):
+                tiles.add((column, row))
+    return tiles
+
+
+def tile_features(features, min_zoom, max_zoom):
+    """{(zoom, x, y): [index of feature]} of every tile that a feature reaches into (every
+    tile of the bounding box of a polygon, which may cover it all)"""
+    tiles = defaultdict(list)
+    margin = float(BUFFER) / EXTENT
+    for i, f in enumerate(features):
+        x0, y0, x1, y1 = f['bounds']
+        for zoom in range(max(min_zoom, f['min_zoom']), max_zoom + 1):
+            n = 2 ** zoom
+            if f['geometry'] == 'line':
+                found = set()
+                for x, y in f['parts']:
+                    found.update(line_tiles(x, y, zoom))
+            else:
+                xs = range(cell(x0 * n - margin, n), cell(x1 * n + margin, n) + 1)
+                ys = range(cell(y0 * n - margin, n), cell(y1 * n + margin, n) + 1)
+                found = [(tx, ty) for tx in xs for ty in ys]
+            for tx, ty in found:
+                tiles[(zoom, tx, ty)].append(i)
+    return tiles
+
+
+def tile_digest(features, indexes):
+    return hashlib.md5(''.join(features[i]['digest'] for i in indexes)).hexdigest()
+
+
+################################### Geometry #################################################
+
+def clip_line(points, lo, hi):
+    """Parts of a line (list of (x, y)) inside the square [lo, hi] (Liang-Barsky)"""
+    parts = []
+    current = []
+    for (x0, y0), (x1, y1) in zip(points[:-1], points[1:]):
+        dx, dy = x1 - x0, y1 - y0
+        t0, t1 = 0.0, 1.0
+        for p, q in ((-dx, x0 - lo), (dx, hi - x0), (-dy, y0 - lo), (dy, hi - y0)):
+            if p == 0:
+                if q < 0:
+                    t0, t1 = 1.0, 0.0
+            elif p < 0:
+                t0 = max(t0, q / p)
+            else:
+                t1 = min(t1, q / p)
+        if t0 > t1:
+            if current:
+                parts.append(current)
+                current = []
+            continue
+        if not current:
+            current = [(x0 + t0 * dx, y0 + t0 * dy)]
+        current.append((x0 + t1 * dx, y0 + t1 * dy))
+        if t1 < 1.0:
+            parts.append(current)
+            current = []
+    if current:
+        parts.append(current)
+    return parts
+
+
+def clip_ring(points, lo, hi):
+    """A closed ring (first point repeated at the end) clipped to the square [lo, hi]
+    (Sutherland-Hodgman)"""
+    ring = points[:-1]
+    for axis, bound, keep in ((0, lo, 1), (0, hi, -1), (1, lo, 1), (1, hi, -1)):
+        if not ring:
+            break
+        clipped = []
+        previous = ring[-1]
+        for point in ring:
+            inside = (point[axis] - bound) * keep >= 0
+            if inside != ((previous[axis] - bound) * keep >= 0):
+                t = (bound - previous[axis]) / (point[axis] - previous[axis])
+                clipped.append((previous[0] + t * (point[0] - previous[0]),
+                                previous[1] + t * (point[1] - previous[1])))
+            if inside:
+                clipped.append(point)
+            previous = point
+        ring = clipped
+    return ring + ring[:1]
+
+
+def simplify(points, tolerance):
+    """Douglas-Peucker simplification of a list of (x, y), keeping its end points"""
+    if len(points) < 3 or tolerance <= 0:
+        return points
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        (ax, ay), (bx, by) = points[first], points[last]
+        dx, dy = bx - ax, by - ay
+        length = math.hypot(dx, dy)
+        best, farthest = tolerance, None
+        for i in range(first + 1, last):
+            px, py = points[i]
+            if length == 0:
+                d = math.hypot(px - ax, py - ay)
+            else:
+                d = abs(dy * px - dx * py + bx * ay - by * ax) / length
+            if d > best:
+                best, farthest = d, i
+        if farthest is not None:
+            keep[farthest] = True
+            stack.append((first, farthest))
+            stack.append((farthest, last))
+    return [p for p, k in zip(points, keep) if k]
+
+
+def to_integers(points):
+    """Points rounded to the integer grid of the tile, repeated points dropped"""
+    result = []
+    for x, y in points:
+        p = (int(round(x)), int(round(y)))
+        if not result or p != result[-1]:
+            result.append(p)
+    return result
+
+
+def ring_area(ring):
+    """Twice the area of a closed ring in tile coordinates, positive if clockwise on screen
+    (y down), which is how MVT wants exterior rings"""
+    return sum(x0 * y1 - x1 * y0 for (x0, y0), (x1, y1) in zip(ring[:-1], ring[1:]))
+
+
+def tile_geometry(f, zoom, tx, ty):
+    """Parts of a feature in the coordinates of tile (zoom, tx, ty), clipped and simplified:
+    lists of integer points (lists of rings for a polygon). Empty if nothing is left."""
+    n = 2 ** zoom
+    lo, hi = -BUFFER, EXTENT + BUFFER
+    x0, y0, x1, y1 = f['bounds']
+    inside = (x0 * n - tx) * EXTENT >= lo and (x1 * n - tx) * EXTENT <= hi and \
+        (y0 * n - ty) * EXTENT >= lo and (y1 * n - ty) * EXTENT <= hi
+
+    scale, dx, dy = n * EXTENT, tx * EXTENT, ty * EXTENT
+
+    def project(xy):
+        return [(x * scale - dx, y * scale - dy) for x, y in zip(*xy)]
+
+    parts = []
+    if f['geometry'] == 'point':
+        for xy in f['parts']:
+            points = to_integers(project(xy))
+            if lo <= points[0][0] <= hi and lo <= points[0][1] <= hi:
+                parts.append(points)
+    elif f['geometry'] == 'line':
+        for xy in f['parts']:
+            points = project(xy)
+            for line in ([points] if inside else clip_line(points, lo, hi)):
+                line = to_integers(simplify(line, TOLERANCE))
+                if len(line) >= 2:
+                    parts.append(line)
+    else:
+        for polygon in f['parts']:
+            rings = []
+            for i, xy in enumerate(polygon):
+                points = project(xy)
+                # A hole cut by the edge of the tile shares that edge with the exterior ring,
+                # which renderers fill correctly (no boolean operations here)
+                ring = points if inside else clip_ring(points, lo, hi)
+                ring = to_integers(simplify(ring, TOLERANCE))
+                if len(ring) < 4 or ring[0] != ring[-1] or not ring_area(ring):
+                    if i == 0:
+                        break  # the exterior ring vanished, and its holes with it
+                    continue
+                # Exterior rings clockwise, holes counterclockwise
+                if (ring_area(ring) > 0) != (i == 0):
+                    ring.reverse()
+                rings.append(ring)
+            if rings:
+                parts.append(rings)
+    return parts
+
+
+################################### Encoding #################################################
+
+def varint(n):
+    if n < 0x80:
+        return chr(n)
+    out = []
+    while n > 0x7f:
+        out.append(chr((n & 0x7f) | 0x80))
+        n >>= 7
+    out.append(chr(n))
+    return ''.join(out)
+
+
+def zigzag(n):
+    return (n << 1) ^ (n >> 63)
+
+
+def field(number, wire_type):
+    return varint(number << 3 | wire_type)
+
+
+def message(number, data):
+    """A length-delimited field"""
+    return field(number, 2) + varint(len(data)) + data
+
+
+def packed(number, values):
+    return message(number, ''.join(varint(v) for v in values))
+
+
+def encode_value(value):
+    if isinstance(value, bool):
+        return field(7, 0) + varint(int(value))
+    if isinstance(value, (int, long)):
+        return field(6, 0) + varint(zigzag(value))
+    if isinstance(value, float):
+        return field(3, 1) + struct.pack('<d', value)
+    if not isinstance(value, unicode):
+        value = str(value).decode('utf-8')
+    return message(1, value.encode('utf-8'))
+
+
+def command(command_id, count):
+    return (command_id & 0x7) | (count << 3)
+
+
+def encode_geometry(geometry, parts):
+    """Command integers of the parts of a feature (MoveTo 1, LineTo 2, ClosePath 7), every
+    coordinate relative to the previous one"""
+    commands = []
+    cursor = [0, 0]
+
+    def move(points, first_command):
+        for j, (x, y) in enumerate(points):
+            if j == 0:
+                commands.append(command(first_command, 1))
+            elif j == 1:
+                commands.append(command(2, len(points) - 1))
+            commands.extend((zigzag(x - cursor[0]), zigzag(y - cursor[1])))
+            cursor[0], cursor[1] = x, y
+
+    if geometry == 'point':
+        commands.append(command(1, len(parts)))
+        for (x, y), in parts:
+            commands.extend((zigzag(x - cursor[0]), zigzag(y - cursor[1])))
+            cursor[0], cursor[1] = x, y
+    elif geometry == 'line':
+        for line in parts:
+            move(line, 1)
+    else:
+        for rings in parts:
+            for ring in rings:
+                move(ring[:-1], 1)
+                commands.append(command(7, 1))
+    return commands
+
+
+def encode_tile(layers):
+    """MVT of {layer name: [(feature id, geometry, parts, properties)]}"""
+    tile = []
+    for name in sorted(layers):
+        keys, values = {}, {}
+        features = []
+        for feature_id, geometry, parts, props in layers[name]:
+            tags = []
+            for k, v in sorted(props.items()):
+                tags.append(keys.setdefault(k, len(keys)))
+                tags.append(values.setdefault((type(v), v), len(values)))
+            data = packed(2, tags) + field(3, 0) + varint(GEOMETRY_TYPES[geometry]) + \
+                packed(4, encode_geometry(geometry, parts))
+            if feature_id >= 0:
+                data = field(1, 0) + varint(feature_id) + data
+            features.append(message(2, data))
+        layer = [field(15, 0) + varint(2), message(1, name)]
+        layer.extend(features)
+        layer.extend(message(3, k.encode('utf-8') if isinstance(k, unicode) else k)
+                     for k, i in sorted(keys.items(), key=lambda item: item[1]))
+        layer.extend(message(4, encode_value(v[1]))
+                     for v, i in sorted(values.items(), key=lambda item: item[1]))
+        layer.append(field(5, 0) + varint(EXTENT))
+        tile.append(message(3, ''.join(layer)))
+    return ''.join(tile)
+
+
+def gzip(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+################################### Generation ###############################################
+
+_features = None  # the features of a worker, set by init_worker
+
+
+def init_worker(features):
+    global _features
+    _features = features
+
+
+def render_tiles(job):
+    """[(zoom, x, y, gzipped tile or None if empty)] of a list of (zoom, x, y, [feature
+    index])"""
+    results = []
+    for zoom, tx, ty, indexes in job:
+        layers = defaultdict(list)
+        for i in indexes:
+            f = _features[i]
+            parts = tile_geometry(f, zoom, tx, ty)
+            if parts:
+                layers[f['layer']].append((f['id'], f['geometry'], parts, f['properties']))
+        results.append((zoom, tx, ty, gzip(encode_tile(layers)) if layers else None))
+    return results
+
+
+def settings(min_zoom, max_zoom):
+    """Digest of everything, besides the features, that the tiles depend on"""
+    return hashlib.md5(repr((LAYERS, AREAS_LAYER, PROPERTIES, EXTENT, BUFFER, TOLERANCE,
+                             min_zoom, max_zoom))).hexdigest()
+
+
+def open_mbtiles(mbtiles, min_zoom, max_zoom, force=False):
+    """Connection to the MBTiles file and {(zoom, x, y): digest} of its tiles; empty (and the
+    file emptied) with force or if it was made with other settings"""
+    con = sqlite3.connect(mbtiles)
+    for sql in MBTILES_SCHEMA:
+        con.execute(sql)
+    row = con.execute("SELECT value FROM metadata WHERE name = 'settings';").fetchone()
+    if force or row is None or row[0] != settings(min_zoom, max_zoom):
+        con.execute('DELETE FROM tiles;')
+        con.execute('DELETE FROM tile_digests;')
+        con.commit()
+        return con, {}
+    digests = {}
+    for zoom, tx, tms_y, digest in con.execute('SELECT * FROM tile_digests;'):
+        digests[(zoom, tx, 2 ** zoom - 1 - tms_y)] = digest
+    return con, digests
+
+
+def write_metadata(con, mbtiles, features, min_zoom, max_zoom):
+    lat, lon = [], []
+    for f in features:
+        x0, y0, x1, y1 = f['bounds']
+        for x, y in ((x0, y0), (x1, y1)):
+            lon.append(x * 360.0 - 180.0)
+            lat.append(math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y)))))
+    bounds = [min(lon), min(lat), max(lon), max(lat)] if features else [-180, -85, 180, 85]
+    layers = defaultdict(set)
+    for f in features:
+        layers[f['layer']].update(f['properties'])
+    vector_layers = [{'id': name, 'fields': dict((k, 'String') for k in sorted(fields))}
+                     for name, fields in sorted(layers.items())]
+    metadata = {'name': os.path.splitext(os.path.basename(mbtiles))[0], 'format': 'pbf',
+                'type': 'overlay', 'version': '2', 'minzoom': str(min_zoom),
+                'maxzoom': str(max_zoom),
+                'bounds': ','.join('{0:.6f}'.format(b) for b in bounds),
+                'center': '{0:.6f},{1:.6f},{2}'.format((bounds[0] + bounds[2]) / 2,
+                                                       (bounds[1] + bounds[3]) / 2, min_zoom),
+                'json': json.dumps({'vector_layers': vector_layers}),
+                'settings': settings(min_zoom, max_zoom)}
+    con.executemany('INSERT OR REPLACE INTO metadata VALUES (?, ?);', metadata.items())
+
+
+def generate(database=database, mbtiles=MBTILES_FILE, min_zoom=MIN_ZOOM, max_zoom=MAX_ZOOM,
+             workers=None, force=False):
+    """Writes (or updates) the tiles of database to mbtiles. Only the tiles whose features
+    changed since the last run are encoded again. Returns statistics."""
+    start = time.time()
+    features = load_features(database)
+    tiles = tile_features(features, min_zoom, max_zoom)
+    digests = dict((t, tile_digest(features, indexes)) for t, indexes in tiles.items())
+    con, old = open_mbtiles(mbtiles, min_zoom, max_zoom, force)
+    todo = [t for t in tiles if old.get(t) != digests[t]]
+    removed = [t for t in old if t not in tiles]
+    # Jobs of neighbouring tiles, so a worker mostly sees the same features
+    todo.sort(key=lambda t: (t[0], int(quadtiles.xy_key(t[1], t[2], t[0]))))
+    jobs = [[t + (tiles[t],) for t in todo[i:i + JOB_TILES]]
+            for i in range(0, len(todo), JOB_TILES)]
+    stats = {'features': len(features), 'tiles': len(tiles), 'encoded': len(todo),
+             'unchanged': len(tiles) - len(todo), 'removed': len(removed), 'empty': 0,
+             'bytes': 0, 'load_seconds': time.time() - start}
+
+    def tms(zoom, tx, ty):
+        return zoom, tx, 2 ** zoom - 1 - ty
+
+    con.executemany('DELETE FROM tiles WHERE zoom_level = ? AND tile_column = ? AND '
+                    'tile_row = ?;', (tms(*t) for t in removed))
+    con.executemany('DELETE FROM tile_digests WHERE zoom_level = ? AND tile_column = ? AND '
+                    'tile_row = ?;', (tms(*t) for t in removed))
+    workers = workers or multiprocessing.cpu_count()
+    if workers == 1 or len(jobs) < 2:
+        init_worker(features)
+        results = (render_tiles(j) for j in jobs)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(min(workers, len(jobs)), init_worker, (features,))
+        results = pool.imap_unordered(render_tiles, jobs)
+    try:
+        for result in results:
+            for zoom, tx, ty, data in result:
+                key = tms(zoom, tx, ty)
+                if data is None:
+                    stats['empty'] += 1
+                    con.execute('DELETE FROM tiles WHERE zoom_level = ? AND tile_column = ? '
+                                'AND tile_row = ?;', key)
+                else:
+                    stats['bytes'] += len(data)
+                    con.execute('INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?);',
+                                key + (sqlite3.Binary(data),))
+                con.execute('INSERT OR REPLACE INTO tile_digests VALUES (?, ?, ?, ?);',
+                            key + (digests[(zoom, tx, ty)],))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    write_metadata(con, mbtiles, features, min_zoom, max_zoom)
+    con.commit()
+    con.close()
+    stats['seconds'] = time.time() - start
+    return stats
+
+
+def read_tile(con, zoom, tx, ty):
+    """Gzipped MVT of tile (zoom, tx, ty) (y from the north, as in the URLs of slippy maps),
+    None if there is none"""
+    row = con.execute('SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? '
+                      'AND tile_row = ?;', (zoom, tx, 2 ** zoom - 1 - ty)).fetchone()
+    return None if row is None else str(row[0])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate the vector tiles of the database')
+    parser.add_argument('--db', default=database)
+    parser.add_argument('--out', default=MBTILES_FILE)
+    parser.add_argument('--min-zoom', type=int, default=MIN_ZOOM)
+    parser.add_argument('--max-zoom', type=int, default=MAX_ZOOM)
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--force', action='store_true', help='encode every tile again')
+    args = parser.parse_args()
+    stats = generate(args.db, args.out, args.min_zoom, args.max_zoom, args.workers,
+                     args.force)
+    print '{0} features in {1} tiles (zoom {2}-{3}), features loaded in {4:.2f}s'.format(
+        stats['features'], stats['tiles'], args.min_zoom, args.max_zoom,
+        stats['load_seconds'])
+    print '{0} tiles encoded ({1} empty), {2} unchanged, {3} removed in {4:.2f}s'.format(
+        stats['encoded'], stats['empty'], stats['unchanged'], stats['removed'],
+        stats['seconds'])
+    if stats['encoded']:
+        print '{0:.1f} kB per tile on average, {1:.0f} tiles/s'.format(
+            stats['bytes'] / 1024.0 / max(1, stats['encoded'] - stats['empty']),
+            stats['encoded'] / max(stats['seconds'] - stats['load_seconds'], 1e-6))